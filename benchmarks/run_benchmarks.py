@@ -0,0 +1,337 @@
+"""
+Benchmark the pipeline stages on a synthetic forecast, fully offline.
+
+A synthetic ECMWF-like ensemble (see synthetic_forecast.py) is run through
+the pipeline from the named storm filter to the report, first end-to-end and
+then one stage at a time, each stage rerun on the outputs of the end-to-end
+run. Centroids and exposures come from a synthetic stand-in for the CLIMADA
+Data API client and country codes from the synthetic countries, so nothing is
+downloaded. Maps are drawn with BASEMAP_OFFLINE, i.e. the cached basemap tiles
+or the Natural Earth fallback, whose data must already be cached.
+
+The pipeline runs in a temporary working directory. Results are written as
+JSON: the wall times of every run of every benchmark, their summary
+statistics, the per-operation breakdown of the end-to-end runs from the stage
+metrics, and the configuration and environment. Results from two commits
+are comparable if their configurations match:
+
+    python benchmarks/run_benchmarks.py -o baseline.json
+    (change things)
+    python benchmarks/run_benchmarks.py -o new.json --compare baseline.json
+
+The comparison exits with status 1 if any benchmark's median is slower than
+the baseline by more than the threshold.
+"""
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from datetime import datetime, timezone
+
+os.environ.setdefault("BASEMAP_OFFLINE", "1")
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from synthetic_forecast import BASINS, SyntheticClient, make_synthetic_tracks, get_country_code
+
+from displacement_forecast import (
+    download_tracks,
+    analyse_tracks,
+    calculate_windfields,
+    analyse_windfields,
+    calculate_impacts,
+    analyse_impacts,
+    build_report,
+    hazard_func
+)
+from displacement_forecast.tc_tracks_func import filter_storm
+from displacement_forecast.manifest_func import PIPELINE_STAGES
+from displacement_forecast.metrics_func import stage_timer, read_metrics, METRICS_FILE_NAME
+
+TIME_STR = "20240701000000"
+"""Forecast time of the synthetic forecast."""
+
+STAGES = {
+    'download_tracks': None,    # the BUFR files can't be decoded offline: filter_tracks instead
+    'analyse_tracks': analyse_tracks.analyse_tracks,
+    'calculate_windfields': calculate_windfields.calculate_windfields,
+    'analyse_windfields': analyse_windfields.analyse_windfields,
+    'calculate_impacts': calculate_impacts.calculate_impacts,
+    'analyse_impacts': analyse_impacts.analyse_impacts,
+    'build_report': build_report.build_report,
+}
+
+DEFAULT_THRESHOLD = 0.1
+"""Relative slowdown of a benchmark's median that counts as a regression."""
+
+MIN_DIFFERENCE_S = 0.1
+"""Slowdowns smaller than this many seconds are never regressions, whatever the ratio."""
+
+
+def use_working_dir(working_dir):
+    """
+    Point the pipeline at another working directory: every module-level path
+    of the displacement_forecast modules under the configured working directory
+    is moved under working_dir.
+    """
+    original = calculate_windfields.WORKING_DIR
+    for name, module in list(sys.modules.items()):
+        if not name.startswith('displacement_forecast') or module is None:
+            continue
+        for attr, value in list(vars(module).items()):
+            if isinstance(value, (str, Path)) and attr.isupper() and str(value).startswith(original):
+                new_value = str(working_dir) + str(value)[len(original):]
+                setattr(module, attr, Path(new_value) if isinstance(value, Path) else new_value)
+
+
+def use_synthetic_data(client):
+    """Serve centroids, exposures and country codes from the synthetic client instead of the Data API"""
+    calculate_windfields.client = client
+    calculate_impacts.client = client
+    hazard_func.get_country_code = lambda lat, lon, *args, **kwargs: get_country_code(lat, lon, client.basin)
+
+
+def filter_tracks(tr_fcast, time_str):
+    """The part of download_tracks.process_bufr after decoding: filter to named storms and save"""
+    forecast_dir = Path(download_tracks.WORKING_DIR, time_str)
+    os.makedirs(forecast_dir, exist_ok=True)
+    with stage_timer(forecast_dir, 'download_tracks'):
+        tr_filter = filter_storm(tr_fcast)
+        if len(tr_filter.data) > 0:
+            download_tracks.write_forecast_tracks(tr_filter, time_str)
+
+
+def run_stage(stage, tr_fcast, time_str, n_workers):
+    """Run one stage with overwrite, returning its wall time in seconds"""
+    start = time.perf_counter()
+    if stage == 'download_tracks':
+        filter_tracks(copy.deepcopy(tr_fcast), time_str)
+    elif stage in ['calculate_impacts', 'analyse_impacts']:
+        STAGES[stage](time_str, overwrite=True, n_workers=n_workers)
+    else:
+        STAGES[stage](time_str, overwrite=True)
+    return time.perf_counter() - start
+
+
+def summarise_times(times):
+    return {
+        'times_s': [round(t, 4) for t in times],
+        'first_s': round(times[0], 4),
+        'min_s': round(float(np.min(times)), 4),
+        'median_s': round(float(np.median(times)), 4),
+        'mean_s': round(float(np.mean(times)), 4),
+    }
+
+
+def operation_breakdown(metrics):
+    """Median wall time and count of every stage operation over the end-to-end runs, from the stage metrics"""
+    if len(metrics) == 0:
+        return {}
+    metrics = metrics[metrics['status'] == 'ok']
+    per_run = metrics.groupby(['run', 'stage', 'operation'])['wall_s'].agg(['sum', 'count']).reset_index()
+    summary = per_run.groupby(['stage', 'operation']).agg(median_s=('sum', 'median'), count=('count', 'median'))
+    return {f"{stage}.{operation}": {'median_s': round(row['median_s'], 4), 'count': int(row['count'])}
+            for (stage, operation), row in summary.iterrows()}
+
+
+def run_benchmarks(n_storms=2, n_members=51, lead_hours=144, basin='NA', resolution=0.1,
+                   exposure_resolution=0.04, stages=None, repeat=3, n_workers=1, seed=0, keep=None):
+    """
+    Benchmark the pipeline on a synthetic forecast.
+
+    Parameters
+    ----------
+    n_storms, n_members, lead_hours, basin, seed:
+        The synthetic forecast, see synthetic_forecast.make_synthetic_tracks.
+    resolution, exposure_resolution: float
+        Grid spacing in degrees of the centroids and the exposures.
+    stages: list
+        Stages to benchmark in isolation. Default: all. The end-to-end runs
+        always include every stage.
+    repeat: int
+        Runs of the end-to-end pipeline and of each stage.
+    n_workers: int
+        Worker processes of calculate_impacts and analyse_impacts.
+    keep: str
+        Keep the working directory of the runs here. Default: a temporary
+        directory, deleted afterwards.
+
+    Returns
+    -------
+    results: dict
+    """
+    config = {
+        'n_storms': n_storms, 'n_members': n_members, 'lead_hours': lead_hours, 'basin': basin,
+        'resolution': resolution, 'exposure_resolution': exposure_resolution, 'repeat': repeat,
+        'n_workers': n_workers, 'seed': seed
+    }
+    stages = stages or PIPELINE_STAGES
+    working_dir = keep or tempfile.mkdtemp(prefix="displacement_benchmark_")
+    os.makedirs(working_dir, exist_ok=True)
+    forecast_dir = Path(working_dir, TIME_STR)
+    print(f"Benchmarking in {working_dir} with {config}")
+
+    use_working_dir(working_dir)
+    client = SyntheticClient(basin, resolution, exposure_resolution, seed)
+    use_synthetic_data(client)
+
+    tr_fcast = make_synthetic_tracks(datetime.strptime(TIME_STR, '%Y%m%d%H0000'), n_storms=n_storms,
+                                     n_members=n_members, lead_hours=lead_hours, basin=basin, seed=seed)
+    # generate the centroids and exposures up front, so that the first run isn't charged for them
+    client.get_centroids()
+    for _, iso_num, *_ in BASINS[basin]['countries']:
+        client.get_exposures(properties={'country_iso3num': [str(iso_num)]})
+
+    benchmarks = {}
+    metrics_frames = []
+    try:
+        print("--- End to end ---")
+        e2e_times = []
+        stage_times = {stage: [] for stage in PIPELINE_STAGES}
+        for i in range(repeat):
+            shutil.rmtree(forecast_dir, ignore_errors=True)
+            start = time.perf_counter()
+            for stage in PIPELINE_STAGES:
+                stage_times[stage].append(run_stage(stage, tr_fcast, TIME_STR, n_workers))
+            e2e_times.append(time.perf_counter() - start)
+            print(f"[{i + 1}/{repeat}] {e2e_times[-1]:.2f}s")
+            metrics_frames.append(read_metrics(Path(forecast_dir, METRICS_FILE_NAME)).assign(run=i))
+        benchmarks['end_to_end'] = summarise_times(e2e_times)
+        for stage in PIPELINE_STAGES:
+            benchmarks[f"end_to_end.{stage}"] = summarise_times(stage_times[stage])
+
+        for stage in stages:
+            print(f"--- {stage} ---")
+            times = []
+            for i in range(repeat):
+                times.append(run_stage(stage, tr_fcast, TIME_STR, n_workers))
+                print(f"[{i + 1}/{repeat}] {times[-1]:.2f}s")
+            benchmarks[f"stage.{stage}"] = summarise_times(times)
+    finally:
+        if keep is None:
+            shutil.rmtree(working_dir, ignore_errors=True)
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': get_environment(),
+        'config': config,
+        'benchmarks': benchmarks,
+        'operations': operation_breakdown(pd.concat(metrics_frames, ignore_index=True)),
+    }
+
+
+def get_environment():
+    """Code version and machine, to tell whether two results are comparable"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip() or None
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, cwd=Path(__file__).parent).stdout.strip() != ''
+    except OSError:
+        commit, dirty = None, None
+    return {
+        'git_commit': commit,
+        'git_dirty': dirty,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.node(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare_results(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare two benchmark results.
+
+    Returns
+    -------
+    rows: list of dict
+        One per benchmark in both results: the medians, their ratio and
+        whether it is a regression.
+    """
+    if baseline['config'] != current['config']:
+        print(f"Warning: the configurations differ, the timings are not comparable:\n"
+              f"  baseline: {baseline['config']}\n  current:  {current['config']}")
+    for key in ['machine', 'cpu_count', 'python']:
+        if baseline['environment'].get(key) != current['environment'].get(key):
+            print(f"Warning: {key} differs: {baseline['environment'].get(key)} vs {current['environment'].get(key)}")
+
+    rows = []
+    for name, result in current['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        base_s, new_s = baseline['benchmarks'][name]['median_s'], result['median_s']
+        ratio = new_s / base_s if base_s > 0 else float('inf')
+        rows.append({
+            'benchmark': name,
+            'baseline_s': base_s,
+            'current_s': new_s,
+            'ratio': round(ratio, 3),
+            'regression': ratio > 1 + threshold and new_s - base_s > MIN_DIFFERENCE_S,
+        })
+    return rows
+
+
+def print_comparison(rows, baseline, current):
+    print(f"Baseline {baseline['environment'].get('git_commit')} ({baseline['created']}) vs "
+          f"current {current['environment'].get('git_commit')} ({current['created']}), median wall times:")
+    width = max([len(row['benchmark']) for row in rows] + [9])
+    for row in rows:
+        flag = "  REGRESSION" if row['regression'] else ""
+        print(f"  {row['benchmark']:<{width}} {row['baseline_s']:9.2f}s {row['current_s']:9.2f}s "
+              f"{row['ratio']:6.2f}x{flag}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on a synthetic forecast, offline.")
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help="Results file")
+    parser.add_argument('--storms', type=int, default=2, help="Named storms in the forecast")
+    parser.add_argument('--members', type=int, default=51, help="Ensemble members per storm")
+    parser.add_argument('--lead-hours', type=int, default=144, help="Longest lead time of the tracks")
+    parser.add_argument('--basin', default='NA', choices=['NA', 'WP'], help="Basin of the storms")
+    parser.add_argument('--resolution', type=float, default=0.1, help="Centroid spacing in degrees")
+    parser.add_argument('--exposure-resolution', type=float, default=0.04, help="Exposure spacing in degrees")
+    parser.add_argument('--stages', nargs='+', choices=PIPELINE_STAGES, help="Stages to benchmark in isolation")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of each benchmark")
+    parser.add_argument('-j', '--workers', type=int, default=1, help="Workers of the impact stages")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the synthetic forecast")
+    parser.add_argument('--keep', help="Keep the pipeline outputs in this directory")
+    parser.add_argument('--compare', metavar='BASELINE', help="Compare with an earlier results file")
+    parser.add_argument('--load', metavar='RESULTS',
+                        help="With --compare: compare this results file instead of running the benchmarks")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="Relative slowdown counted as a regression. Default: 0.1")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.load is not None:
+        with open(args.load, 'r') as f:
+            results = json.load(f)
+    else:
+        results = run_benchmarks(n_storms=args.storms, n_members=args.members, lead_hours=args.lead_hours,
+                                 basin=args.basin, resolution=args.resolution,
+                                 exposure_resolution=args.exposure_resolution, stages=args.stages,
+                                 repeat=args.repeat, n_workers=args.workers, seed=args.seed, keep=args.keep)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f"Results written to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        rows = compare_results(baseline, results, threshold=args.threshold)
+        print_comparison(rows, baseline, results)
+        n_regressions = sum(row['regression'] for row in rows)
+        if n_regressions > 0:
+            print(f"{n_regressions} benchmarks are more than {args.threshold:.0%} slower than the baseline.")
+            sys.exit(1)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic ECMWF-like forecasts for benchmarking the pipeline offline.
+
+Generates TCTracks ensembles shaped like the decoded BUFR forecasts (51
+ensemble members per named storm, a deterministic track and unnamed
+disturbances that the named storm filter drops), a regular grid of centroids
+over a basin, and population exposures on a few countries of the basin. The
+countries are boxes roughly where the real countries are, with their real
+ISO codes, so that the impact functions and reports treat them as usual.
+
+Everything is generated from a seed, so two runs with the same arguments
+produce the same forecast.
+
+@author: Chris Fairless
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+from datetime import datetime, timedelta
+from geopandas import GeoDataFrame, points_from_xy
+
+from climada.hazard import TCTracks, Centroids
+from climada.hazard.tc_tracks import set_category
+from climada.entity import Exposures
+from climada.util.constants import DEF_CRS
+
+N_ENSEMBLE = 51
+
+STORM_NAMES = ['ALPHA', 'BETA', 'GAMMA', 'DELTA', 'EPSILON', 'ZETA', 'ETA', 'THETA', 'IOTA', 'KAPPA']
+
+BASINS = {
+    'NA': {
+        'sid_suffix': 'L',
+        'genesis': (-58., 13.),          # lon, lat of the first storm's genesis
+        'genesis_offset': (4., 1.5),     # shift of each further storm's genesis
+        'motion': (-0.15, 0.055),        # deg/h, west-northwest
+        'extent': (-100., -50., 5., 35.),
+        'countries': [
+            # iso3, iso numeric, lon_min, lon_max, lat_min, lat_max
+            ('CUB', 192, -85., -74., 20., 23.),
+            ('JAM', 388, -78.5, -76., 17.5, 18.5),
+            ('HTI', 332, -74.5, -71.6, 18., 20.),
+            ('DOM', 214, -71.6, -68.3, 18., 20.),
+            ('BHS', 44, -79., -73., 23.5, 26.5),
+        ],
+    },
+    'WP': {
+        'sid_suffix': 'W',
+        'genesis': (142., 11.),
+        'genesis_offset': (4., 2.),
+        'motion': (-0.16, 0.05),
+        'extent': (100., 155., 0., 35.),
+        'countries': [
+            ('PHL', 608, 119., 126.5, 6., 18.5),
+            ('TWN', 158, 120., 122., 22., 25.3),
+            ('VNM', 704, 102., 109.5, 9., 22.),
+            ('CHN', 156, 109.5, 120., 21., 28.),
+        ],
+    },
+}
+"""Basins available for synthetic forecasts."""
+
+TIME_STEP_H = 6
+"""Time step of the synthetic tracks, as in the ECMWF BUFR forecasts."""
+
+
+def make_synthetic_tracks(forecast_time: datetime,
+                          n_storms: int = 2,
+                          n_members: int = N_ENSEMBLE,
+                          lead_hours: int = 144,
+                          basin: str = 'NA',
+                          n_unnamed: int = 1,
+                          seed: int = 0):
+    """
+    Synthetic forecast tracks, as decoded from the ECMWF BUFR files.
+
+    Each named storm has n_members ensemble members, whose paths and
+    intensities spread out with lead time, and one deterministic track.
+    Members end at different lead times, as they do in real forecasts.
+
+    Parameters
+    ----------
+    forecast_time: datetime
+        Initialisation time of the forecast.
+    n_storms: int
+        Number of named storms. At most len(STORM_NAMES).
+    n_members: int
+        Ensemble members per storm. Default: 51
+    lead_hours: int
+        Longest lead time of the tracks in hours.
+    basin: str
+        One of BASINS.
+    n_unnamed: int
+        Number of unnamed disturbances (e.g. 91L), which the pipeline filters out.
+    seed: int
+        Random seed.
+
+    Returns
+    -------
+    tracks: TCTracks
+    """
+    if n_storms > len(STORM_NAMES):
+        raise ValueError(f"At most {len(STORM_NAMES)} named storms are supported, got {n_storms}")
+    basin_info = BASINS[basin]
+    rng = np.random.default_rng(seed)
+
+    names = STORM_NAMES[:n_storms] + [f"{91 + i}{basin_info['sid_suffix']}" for i in range(n_unnamed)]
+    tracks = []
+    for i_storm, name in enumerate(names):
+        genesis = np.array(basin_info['genesis']) + i_storm * np.array(basin_info['genesis_offset'])
+        peak_wind = rng.uniform(35., 65.)
+        for ensemble_number in range(n_members + 1):
+            is_ensemble = ensemble_number < n_members
+            tracks.append(_make_member_track(
+                rng, forecast_time, name, f"{i_storm + 1:02d}{basin_info['sid_suffix']}",
+                genesis, np.array(basin_info['motion']), peak_wind, lead_hours, basin,
+                ensemble_number=ensemble_number + 1 if is_ensemble else 0,
+                is_ensemble=is_ensemble,
+                id_no=i_storm * 100 + ensemble_number
+            ))
+    return TCTracks(data=tracks)
+
+
+def _make_member_track(rng, forecast_time, name, sid, genesis, motion, peak_wind, lead_hours, basin,
+                       ensemble_number, is_ensemble, id_no):
+    """One ensemble member: a perturbed random walk around the storm's mean motion"""
+    n_steps = lead_hours // TIME_STEP_H + 1
+    if is_ensemble:
+        n_steps = max(3, int(n_steps * rng.uniform(0.6, 1.)))
+    lead = np.arange(n_steps) * TIME_STEP_H
+
+    # the spread of the members grows with lead time
+    spread = 1. if is_ensemble else 0.
+    velocity = motion + spread * rng.normal(0., 0.02, size=2)
+    steps = velocity * TIME_STEP_H + spread * rng.normal(0., 0.15, size=(n_steps, 2))
+    steps[0] = 0.
+    lon, lat = (genesis + np.cumsum(steps, axis=0)).T
+
+    # intensify to a peak at 60% of the lead time, then weaken
+    member_peak = peak_wind * (1. + spread * rng.normal(0., 0.1))
+    t_rel = lead / max(lead_hours, 1)
+    wind = 18. + (member_peak - 18.) * np.where(t_rel < 0.6, t_rel / 0.6, 1. - 0.8 * (t_rel - 0.6))
+    wind = np.clip(wind + spread * rng.normal(0., 1.5, size=n_steps), 10., None)
+    wind_kn = wind / 0.514444
+    pressure = 1010. - (wind_kn / 6.7) ** (1 / 0.644)    # Atkinson and Holliday (1977) wind-pressure relation
+
+    track = xr.Dataset(
+        {
+            'time_step': ('time', np.full(n_steps, float(TIME_STEP_H))),
+            'max_sustained_wind': ('time', wind),
+            'central_pressure': ('time', pressure),
+            'radius_max_wind': ('time', np.full(n_steps, rng.uniform(15., 40.))),
+            'radius_oci': ('time', np.full(n_steps, rng.uniform(150., 300.))),
+            'environmental_pressure': ('time', np.full(n_steps, 1010.)),
+            'basin': ('time', np.full(n_steps, basin, dtype='<U2')),
+        },
+        coords={
+            'time': pd.to_datetime(forecast_time) + pd.to_timedelta(lead, unit='h'),
+            'lat': ('time', lat),
+            'lon': ('time', lon),
+        },
+        attrs={
+            'max_sustained_wind_unit': 'm/s',
+            'central_pressure_unit': 'mb',
+            'name': name,
+            'sid': sid,
+            'orig_event_flag': False,
+            'data_provider': 'ECMWF',
+            'id_no': id_no,
+            'ensemble_number': ensemble_number,
+            'is_ensemble': is_ensemble,
+            'run_datetime': forecast_time.isoformat(),
+        }
+    )
+    track.attrs['category'] = set_category(wind, 'm/s')
+    return track
+
+
+def make_synthetic_centroids(basin: str = 'NA', resolution: float = 0.1):
+    """
+    A regular grid of centroids over a basin, standing in for the global
+    centroids of the CLIMADA Data API.
+
+    Parameters
+    ----------
+    basin: str
+        One of BASINS.
+    resolution: float
+        Grid spacing in degrees. Default: 0.1
+
+    Returns
+    -------
+    centroids: Centroids
+    """
+    lon_min, lon_max, lat_min, lat_max = BASINS[basin]['extent']
+    lon, lat = np.meshgrid(np.arange(lon_min, lon_max, resolution) + resolution / 2,
+                           np.arange(lat_min, lat_max, resolution) + resolution / 2)
+    return Centroids(lat=lat.ravel(), lon=lon.ravel(), crs=DEF_CRS)
+
+
+def get_country_code(lat, lon, basin: str = 'NA'):
+    """
+    Numeric ISO code of the synthetic country at each coordinate, 0 at sea.
+    Stands in for climada.util.coordinates.get_country_code.
+    """
+    lat, lon = np.asarray(lat), np.asarray(lon)
+    region_id = np.zeros(lat.shape, dtype=int)
+    for _, iso_num, lon_min, lon_max, lat_min, lat_max in BASINS[basin]['countries']:
+        inside = (region_id == 0) & (lon >= lon_min) & (lon < lon_max) & (lat >= lat_min) & (lat < lat_max)
+        region_id[inside] = iso_num
+    return region_id
+
+
+def make_synthetic_exposures(iso_num: int, basin: str = 'NA', resolution: float = 0.04, seed: int = 0):
+    """
+    Population exposure of a synthetic country: a grid of points over its box
+    with log-normally distributed population, like the LitPop exposures of
+    the CLIMADA Data API (150 arcsec, about 0.04 degrees).
+
+    Returns
+    -------
+    exp: Exposures
+        With impact function id 1 for tropical cyclones.
+    """
+    countries = {c[1]: c for c in BASINS[basin]['countries']}
+    _, _, lon_min, lon_max, lat_min, lat_max = countries[iso_num]
+    lon, lat = np.meshgrid(np.arange(lon_min, lon_max, resolution) + resolution / 2,
+                           np.arange(lat_min, lat_max, resolution) + resolution / 2)
+    rng = np.random.default_rng(seed + iso_num)
+    gdf = GeoDataFrame({
+        'value': rng.lognormal(mean=6., sigma=1.5, size=lat.size),
+        'impf_TC': 1,
+        'region_id': iso_num,
+    }, geometry=points_from_xy(lon.ravel(), lat.ravel()), crs=DEF_CRS)
+    return Exposures(gdf, value_unit='people')
+
+
+class SyntheticClient:
+    """
+    Offline stand-in for climada.util.api_client.Client serving synthetic
+    centroids and exposures for one basin.
+
+    Exposures are generated once per country and copied on every request.
+    """
+
+    class NoResult(Exception):
+        """No dataset matches the request, as raised by the Data API client"""
+
+    def __init__(self, basin: str = 'NA', resolution: float = 0.1, exposure_resolution: float = 0.04, seed: int = 0):
+        self.basin = basin
+        self.resolution = resolution
+        self.exposure_resolution = exposure_resolution
+        self.seed = seed
+        self._centroids = None
+        self._exposures = {}
+
+    def get_centroids(self, **kwargs):
+        if self._centroids is None:
+            self._centroids = make_synthetic_centroids(self.basin, self.resolution)
+        return self._centroids
+
+    def get_exposures(self, exposures_type='litpop', properties=None, **kwargs):
+        iso_num = int(properties['country_iso3num'][0])
+        if iso_num not in {c[1] for c in BASINS[self.basin]['countries']}:
+            raise self.NoResult(f"No synthetic exposures for country {iso_num}")
+        if iso_num not in self._exposures:
+            self._exposures[iso_num] = make_synthetic_exposures(iso_num, self.basin, self.exposure_resolution,
+                                                                self.seed)
+        return self._exposures[iso_num].copy()
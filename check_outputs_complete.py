@@ -1,292 +1,320 @@
 from displacement_forecast import (
     download_tracks,
-    analyse_tracks,
-    calculate_windfields,
-    # analyse_windfields,
-    calculate_impacts,
-    analyse_impacts,
-    build_report,
     build_index_page
 )
+from displacement_forecast.manifest_func import (
+    PIPELINE_STAGES,
+    read_stage_manifest, write_stage_manifest, check_stage_files, list_stage_files
+)
+from regenerate_all_reports import regenerate_forecast
 import os
 import sys
+import json
+import time
+import argparse
 from pathlib import Path
-from traceback import print_tb
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from climada import CONFIG
 
 WORKING_DIR = CONFIG.forecast_sandbox.dir.str()
 
-
-
-def check_outputs_complete(fix=False):
-    forecasts = []
-
-    # Download list of current forecasts
-    forecast_time_list_ftp = download_tracks.get_available_forecast_times()
-    print(f"There are {len(forecast_time_list_ftp)} forecast times available.")
-
+STAGE_INPUTS = {
+    'download_tracks': [],
+    'analyse_tracks': ['download_tracks'],
+    'calculate_windfields': ['download_tracks'],
+    'analyse_windfields': ['calculate_windfields'],
+    'calculate_impacts': ['calculate_windfields'],
+    'analyse_impacts': ['calculate_impacts'],
+    'build_report': ['analyse_tracks', 'calculate_impacts', 'analyse_impacts'],
+}
+"""Stages whose outputs each stage reads: a stage is stale if any of them ran after it."""
+
+CONSISTENCY_CHECKS = [
+    ('analyse_tracks', 'calculate_windfields', 'storms'),
+    ('analyse_windfields', 'calculate_windfields', 'storms'),
+    ('calculate_impacts', 'calculate_windfields', 'storms'),
+    ('analyse_impacts', 'calculate_impacts', 'impacts'),
+    ('build_report', 'calculate_windfields', 'storms'),
+]
+"""(stage, other stage, key): the two stages' manifests must expect the same set of values for key."""
+
+FAILED_STATUSES = ['missing', 'invalid', 'stale', 'inconsistent']
+"""Statuses fixed with --fix. 'unverified' outputs, from before stages wrote manifests, are left alone."""
+
+
+def get_local_forecast_times():
     forecast_time_list_local = os.listdir(WORKING_DIR)
     forecast_time_list_local = [p for p in forecast_time_list_local if os.path.isdir(Path(WORKING_DIR, p))]
-    forecast_time_list_local = [p for p in forecast_time_list_local if p[0].isdigit() and len(p) == 14]
-    print(f"There are {len(forecast_time_list_local)} forecast times available locally.")
-
-    all_times = set(forecast_time_list_ftp) | set(forecast_time_list_local)
-    forecast_dict = {}
-
-    for time_str in all_times:
-        print("\n---------------------")
-        print("FORECAST TIME: " + time_str)
-        print("---------------------\n")
-
-        forecast = {}
-        FORECAST_DIR = Path(WORKING_DIR, time_str)
-
-        forecast['time_str'] = time_str
-        forecast['dir'] = {
-            'root': FORECAST_DIR,
-            'bufr': Path(FORECAST_DIR, "bufr"),
-            'tracks': Path(FORECAST_DIR, "tracks"),
-            'tracks_analysis': Path(FORECAST_DIR, "analysis_tracks"),
-            'wind_fields': Path(FORECAST_DIR, "wind_fields"),
-            'impacts': Path(FORECAST_DIR, "impacts"),
-            'analysis_impacts': Path(FORECAST_DIR, "analysis_impacts"),
-            'report': Path(FORECAST_DIR, "report")
-        }
-        forecast['exists_local'] = True if forecast['time_str'] in forecast_time_list_local else False
-        forecast['exists_ftp'] = True if forecast['time_str'] in forecast_time_list_ftp else False
-        forecast['success_download'] = False
-        forecast['success_write_tracks'] = False
-        forecast['success_track_plots'] = False
-        forecast['success_wind_fields'] = False
-        forecast['success_impacts'] = False
-        forecast['success_impact_plots'] = False
-        forecast['success_report'] = False
-        forecast['final_step'] = None
-        forecast['errors'] = []
-
-        print("--- STEP 1: Downloads ---")
-        try:
-            forecast = check_downloads(forecast, fix=fix)
-        except Exception as e:
-            print(f"Error checking downloads for {time_str}: {str(sys.exc_info())}")
-            print_tb(sys.exc_info()[2])
-            forecast['errors'].append(f"Error checking downloads: {str(sys.exc_info())}")
+    return sorted([p for p in forecast_time_list_local if p[0].isdigit() and len(p) == 14])
+
+
+def check_forecast(time_str, verify_checksums=False):
+    """
+    Check the outputs of every stage of a forecast against the stage manifests.
+
+    Each stage gets one of the statuses
+        'ok': outputs match the manifest
+        'not_needed': no manifest, but the forecast has no named storms
+        'unverified': no manifest, but there are outputs, e.g. written before
+            stages wrote manifests: run with backfill to record them
+        'missing': no manifest and no outputs, i.e. the stage never ran
+        'invalid': outputs missing, changed or added since the manifest was written,
+            or no tracks file although the forecast has named storms
+        'stale': a stage whose outputs it reads ran after it
+        'inconsistent': expects different storms or impacts than the stage it follows
+
+    Returns
+    -------
+    rows: list of dict
+        One per stage, in pipeline order.
+    """
+    FORECAST_DIR = Path(WORKING_DIR, time_str)
+    manifests = {stage: read_stage_manifest(FORECAST_DIR, stage) for stage in PIPELINE_STAGES}
+    download = manifests['download_tracks']
+    if download is not None:
+        no_storms = len(download['expected'].get('storms', [])) == 0
+    else:
+        no_storms = has_downloaded_tracks(time_str) and len(get_named_storms(time_str)) == 0
+
+    rows = []
+    for stage in PIPELINE_STAGES:
+        manifest = manifests[stage]
+        row = {'time_str': time_str, 'stage': stage, 'status': 'ok', 'created': None,
+               'n_files': 0, 'n_bytes': 0, 'problems': []}
+        rows.append(row)
+        if stage == 'download_tracks' and has_bufr(time_str) and not has_tracks(time_str):
+            # e.g. cleared by delete_intermediates.sh: every later stage needs the tracks
+            row['status'], row['problems'] = 'invalid', ["no tracks file, but the forecast has named storms"]
             continue
-
-        print("--- STEP 2: Analysing forecast tracks ---")
-        try:
-            forecast = check_track_plots(forecast, fix=fix)
-        except Exception as e:
-            print(f"Error checking track plots for {time_str}: {str(sys.exc_info())}")
-            print_tb(sys.exc_info()[2])
-            forecast['errors'].append(f"Error checking track plots: {str(sys.exc_info())}")
+        if manifest is None:
+            if no_storms and stage != 'download_tracks':
+                row['status'] = 'not_needed'
+            elif len(list_stage_files(FORECAST_DIR, stage)) > 0:
+                row['status'] = 'unverified'
+            else:
+                row['status'] = 'missing'
             continue
 
-        print("--- STEP 3: Generating wind fields ---")
-        try:
-            forecast = check_wind_fields(forecast, fix=fix)
-        except Exception as e:
-            print(f"Error checking wind fields for {time_str}: {str(sys.exc_info())}")
-            print_tb(sys.exc_info()[2])
-            forecast['errors'].append(f"Error checking wind fields: {str(sys.exc_info())}")
-            continue
+        row['created'] = manifest['created']
+        row['n_files'] = len(manifest['files'])
+        row['n_bytes'] = sum(entry['size'] for entry in manifest['files'].values())
 
-        print("--- STEP 4: Calculating impacts ---")
-        try:
-            forecast = check_impacts(forecast, fix=fix)
-        except Exception as e:
-            print(f"Error checking impacts for {time_str}: {str(sys.exc_info())}")
-            print_tb(sys.exc_info()[2])
-            forecast['errors'].append(f"Error checking impacts: {str(sys.exc_info())}")
+        problems = check_stage_files(FORECAST_DIR, manifest, verify_checksums=verify_checksums)
+        if len(problems) > 0:
+            row['status'], row['problems'] = 'invalid', problems
             continue
 
-        print("--- STEP 5: Analysing impacts ---")
-        try:
-            forecast = check_impact_plots(forecast, fix=fix)
-        except Exception as e:
-            print(f"Error checking impact plots for {time_str}: {str(sys.exc_info())}")
-            print_tb(sys.exc_info()[2])
-            forecast['errors'].append(f"Error checking impact plots: {str(sys.exc_info())}")
+        newer_inputs = [s for s in STAGE_INPUTS[stage]
+                        if manifests[s] is not None and manifests[s]['created'] > manifest['created']]
+        if len(newer_inputs) > 0:
+            row['status'] = 'stale'
+            row['problems'] = [f"{s} ran after this stage" for s in newer_inputs]
             continue
 
-        print("--- STEP 6: Building report ---")
-        try:
-            forecast = check_report(forecast, fix=fix)
-        except Exception as e:
-            print(f"Error checking report for {time_str}: {str(sys.exc_info())}")
-            print_tb(sys.exc_info()[2])
-            forecast['errors'].append(f"Error checking report: {str(sys.exc_info())}")
+        for check_stage, other_stage, key in CONSISTENCY_CHECKS:
+            other = manifests[other_stage]
+            if check_stage != stage or other is None:
+                continue
+            if key not in manifest['expected'] or key not in other['expected']:
+                continue
+            if set(manifest['expected'][key]) != set(other['expected'][key]):
+                row['status'] = 'inconsistent'
+                row['problems'].append(
+                    f"{key} {manifest['expected'][key]} differ from {other_stage}: {other['expected'][key]}")
+    return rows
+
+
+def get_named_storms(time_str):
+    """Named storms of a forecast from its BUFR files, empty if there are none"""
+    try:
+        return download_tracks.list_named_storms(time_str)
+    except FileNotFoundError:
+        return []
+
+
+def has_bufr(time_str):
+    """Whether a forecast's BUFR files are downloaded"""
+    bufr_files = list_stage_files(Path(WORKING_DIR, time_str), 'download_tracks')
+    return any(f.startswith('bufr/') for f in bufr_files)
+
+
+def has_tracks(time_str):
+    """Whether a forecast's BUFR files are decoded: the tracks file exists, unless there are no named storms"""
+    tracks_path = Path(WORKING_DIR, time_str, "tracks", "ECMWF_TC_tracks.h5")
+    return os.path.exists(tracks_path) or len(get_named_storms(time_str)) == 0
+
+
+def has_downloaded_tracks(time_str):
+    """Whether a forecast's BUFR files are downloaded and decoded"""
+    return has_bufr(time_str) and has_tracks(time_str)
+
+
+def first_stage_to_fix(time_str, failed_stages):
+    """
+    The stage to rerun a forecast's pipeline from, given its failed stages in
+    pipeline order. The forecast is never downloaded again if its tracks are
+    already there, since rerunning download_tracks means fetching it from the
+    FTP server. None if nothing is left to fix.
+    """
+    if failed_stages[0] == 'download_tracks' and has_downloaded_tracks(time_str):
+        failed_stages = failed_stages[1:]
+    return failed_stages[0] if len(failed_stages) > 0 else None
+
+
+def decode_tracks(time_str, overwrite=True):
+    """Decode the downloaded BUFR files of a forecast again and record the download_tracks manifest"""
+    download_tracks.process_bufr(time_str, overwrite=overwrite)
+    write_stage_manifest(Path(WORKING_DIR, time_str), 'download_tracks',
+                         expected={'storms': download_tracks.list_named_storms(time_str)})
+
+
+def backfill_manifests(time_str, checksums=False):
+    """
+    Write manifests, without expected storms or impacts, for the stages of a
+    forecast processed before stages wrote manifests. Only stages with
+    outputs and no manifest are recorded, with file checksums if asked for.
+    """
+    FORECAST_DIR = Path(WORKING_DIR, time_str)
+    written = []
+    for stage in PIPELINE_STAGES:
+        if read_stage_manifest(FORECAST_DIR, stage) is not None:
             continue
-
-        forecast_dict[time_str] = forecast
-
-    if fix:
-        print("--- STEP 7: Rebuilding index page ---")
-        try:
-            build_index_page.build_index_page()
-        except Exception as e:
-            print(f"Error updating index page: {str(sys.exc_info())}")
-            print_tb(sys.exc_info()[2])
+        if len(list_stage_files(FORECAST_DIR, stage)) == 0:
+            continue
+        write_stage_manifest(FORECAST_DIR, stage, checksums=checksums)
+        written.append(stage)
+    return written
+
+
+def fix_forecast(time_str, first_stage):
+    """
+    Rerun the pipeline of a forecast from first_stage, stopping at the first
+    error. If the BUFR files are there, download_tracks only decodes them again.
+    """
+    results = []
+    for stage in PIPELINE_STAGES[PIPELINE_STAGES.index(first_stage):]:
+        if stage == 'download_tracks' and has_bufr(time_str):
+            result = regenerate_forecast(stage, time_str, overwrite=True, stage_func=decode_tracks)
+        else:
+            result = regenerate_forecast(stage, time_str, overwrite=True)
+        results.append(result)
+        if result['error'] is not None:
+            break
+        if stage == 'download_tracks' and download_tracks.count_named_storms(time_str) == 0:
+            break
+    return results
+
+
+def check_outputs_complete(fix=False, n_workers=4, verify_checksums=False, check_ftp=False, backfill=False):
+    """
+    Check the outputs of all forecasts from their stage manifests, in parallel.
+
+    Parameters
+    ----------
+    fix: bool
+        Rerun the pipeline of every forecast with a failed stage, from that
+        stage on, in a pool of n_workers processes, then rebuild the index pages.
+    n_workers: int
+        Number of worker processes for checking and fixing.
+    verify_checksums: bool
+        Compare the checksum of every output file whose manifest records one,
+        not only its size and modification time. With backfill, record the
+        checksums in the backfilled manifests.
+    check_ftp: bool
+        Also list the forecasts on the ECMWF FTP server, so that forecasts not
+        yet downloaded are reported (and downloaded with fix).
+    backfill: bool
+        First write manifests for outputs written before stages recorded them.
+
+    Returns
+    -------
+    out: DataFrame
+        One row per forecast and stage. Also written to check_outputs.json and
+        check_outputs.parquet in the working directory.
+    """
+    start = time.perf_counter()
+    forecast_time_list_local = get_local_forecast_times()
+    print(f"There are {len(forecast_time_list_local)} forecast times available locally.")
+    all_times = set(forecast_time_list_local)
+
+    if check_ftp:
+        forecast_time_list_ftp = download_tracks.get_available_forecast_times()
+        print(f"There are {len(forecast_time_list_ftp)} forecast times available.")
+        all_times |= set(forecast_time_list_ftp)
+    all_times = sorted(all_times)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        if backfill:
+            backfilled = pool.map(backfill_manifests, forecast_time_list_local,
+                                  [verify_checksums] * len(forecast_time_list_local))
+            for time_str, written in zip(forecast_time_list_local, backfilled):
+                if len(written) > 0:
+                    print(f"Wrote manifests for {time_str}: {', '.join(written)}")
+        results = dict(zip(all_times, pool.map(check_forecast, all_times, [verify_checksums] * len(all_times),
+                                                chunksize=16)))
+    out = pd.DataFrame([row for time_str in all_times for row in results[time_str]])
+
+    print(f"Checked {len(all_times)} forecasts in {time.perf_counter() - start:.1f}s")
+    print(out.pivot_table(index='stage', columns='status', values='time_str', aggfunc='count', fill_value=0)
+          .reindex(PIPELINE_STAGES))
+
+    failed = out[out['status'].isin(FAILED_STATUSES)]
+    failed_stages = failed.groupby('time_str', sort=True)['stage'].agg(list)
+    first_failed = pd.Series({time_str: first_stage_to_fix(time_str, stages)
+                              for time_str, stages in failed_stages.items()}, dtype=object).dropna()
+
+    if fix and len(first_failed) > 0:
+        print(f"--- Fixing {len(first_failed)} forecasts ---")
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {
+                time_str: pool.submit(fix_forecast, time_str, stage)
+                for time_str, stage in first_failed.items()
+            }
+            for time_str, future in futures.items():
+                for result in future.result():
+                    status = "fixed" if result['error'] is None else f"FAILED: {result['error']}"
+                    print(f"{time_str} {result['stage']}: {status}")
+
+        print("--- Rebuilding index page ---")
+        build_index_page.build_index_page()
+
+        # report the state after fixing
+        for time_str in first_failed.index:
+            results[time_str] = check_forecast(time_str, verify_checksums)
+        out = pd.DataFrame([row for time_str in all_times for row in results[time_str]])
 
     print("Writing output")
-    output_path = Path(WORKING_DIR, 'check_outputs.csv')
+    output_path = Path(WORKING_DIR, 'check_outputs.json')
+    with open(output_path, 'w') as f:
+        json.dump({
+            time_str: {row['stage']: {k: row[k] for k in ['status', 'created', 'n_files', 'n_bytes', 'problems']}
+                       for row in rows.to_dict('records')}
+            for time_str, rows in out.groupby('time_str')
+        }, f, indent=1)
+    out.assign(problems=out['problems'].apply('; '.join)).to_parquet(output_path.with_suffix('.parquet'), index=False)
     print(output_path)
-    out = pd.DataFrame(forecast_dict).T
-    print(out)
-    out.to_csv(output_path, index=False)
-
-
-
-def check_downloads(forecast, fix=False):    
-    if fix and not forecast['exists_local']:
-        if forecast['exists_ftp']:
-            print(f"Missing download: downloading forecast {forecast['time_str']}...")
-            download_tracks.download_and_process_forecast(forecast['time_str'], overwrite=True)      
-
-    if not os.path.exists(forecast['dir']['bufr']):
-        forecast['errors'].append(f"No downloaded data found")
-        return forecast
-
-    downloaded_files = os.listdir(forecast['dir']['bufr'])
-
-    for file in downloaded_files:
-        if not file.endswith('.bin'):
-            forecast['errors'].append(f"Unexpected non .bin download: {file}")
-        if forecast['time_str'] not in str(file):
-            forecast['errors'].append(f"Downloaded filename does not contain the expected time string {forecast['time_str']}:  {file}")    
-        if 'tropical_cyclone_track' not in str(file):
-            forecast['errors'].append(f"Downloaded filename does not contain the string 'tropical_cyclone': {file}")
-
-    forecast['storm_ids'] = [s.split('_')[8] for s in downloaded_files]
-    forecast['named_storms'] = [s for s in forecast['storm_ids'] if not s[0].isdigit()]
-    forecast['number_storms'] = len(forecast['named_storms'])
-    forecast['success_download'] = len(downloaded_files) > 0
-    if forecast['number_storms'] == 0:
-        forecast['final_step'] = 'download_tracks'
-        return forecast
-    
-    if forecast['number_storms'] == 0:
-        forecast['final_step'] = 'download_tracks'
-        return forecast
-
-    if fix and not os.path.exists(forecast['dir']['tracks']):
-        print(f"Missing tracks folder: reprocessing forecast {forecast['time_str']}...")
-        download_tracks.process_bufr(forecast['time_str'], overwrite=True)
-    
-    tracks_path = Path(forecast['dir']['tracks'], "ECMWF_TC_tracks.h5")
-    if fix and not os.path.exists(tracks_path):
-        print(f"Missing tracks file: reprocessing forecast {forecast['time_str']}...")
-        download_tracks.process_bufr(forecast['time_str'], overwrite=True)
-
-    if not os.path.exists(tracks_path):
-        forecast['errors'].append(f"No tracks file found at {tracks_path}.")
-        return forecast
-
-    forecast['success_write_tracks'] = True
-    return forecast
-
-
-def check_track_plots(forecast, fix=False):
-    if not forecast['success_write_tracks']:
-        return forecast
-
-    if fix and not os.path.exists(forecast['dir']['tracks_analysis']):
-        analyse_tracks.analyse_tracks(forecast['time_str'], overwrite=True)
-    if fix and len(os.listdir(forecast['dir']['tracks_analysis'])) == 0:
-        analyse_tracks.analyse_tracks(forecast['time_str'], overwrite=True)
-
-    track_plots = os.listdir(forecast['dir']['tracks_analysis'])
-    if len(track_plots) == 0:
-        forecast['errors'].append("No track plots found.")
-        return forecast
-
-    forecast['success_track_plots'] = True
-    return forecast
-
-
-def check_wind_fields(forecast, fix=False):
-    if not forecast['success_write_tracks']:
-        return forecast
-
-    if fix and not os.path.exists(forecast['dir']['wind_fields']):
-        calculate_windfields.calculate_windfields(forecast['time_str'], overwrite=True)
-    if fix and len(os.listdir(forecast['dir']['wind_fields'])) == 0:
-        calculate_windfields.calculate_windfields(forecast['time_str'], overwrite=True)
-
-    if len(os.listdir(forecast['dir']['wind_fields'])) == 0:
-        forecast['errors'].append(f"No wind fields calculated despite names storms")
-        return forecast
-
-    forecast['success_wind_fields'] = True
-    return forecast
-
-
-def check_impacts(forecast, fix=False):
-    if not forecast['success_wind_fields']:
-        return forecast
-    
-    if fix and not os.path.exists(forecast['dir']['impacts']):
-        calculate_impacts.calculate_impacts(forecast['time_str'], overwrite=True)
-    
-    impact_files = os.listdir(forecast['dir']['impacts'])
-    forecast['has_impacts'] = False
-    forecast['has_affected'] = False
-    forecast['has_displaced'] = False
-
-    if len(impact_files) == 0:
-        forecast['final_step'] = 'calculate_windfields'
-        return forecast
-
-    for impact_file in impact_files:
-        if 'affected' in impact_file:
-            forecast['has_impacts'] = True
-            forecast['has_affected'] = True
-        if 'displaced' in impact_file:
-            forecast['has_displaced'] = True
-            break
-
-    forecast['success_impacts'] = True
-    forecast['final_step'] = 'calculate_impact'
-    return forecast
-
-
-def check_impact_plots(forecast, fix=False):
-    if not forecast['success_impacts']:
-        return forecast
-
-    if fix and not os.path.exists(forecast['dir']['analysis_impacts']):
-        analyse_impacts.analyse_impacts(forecast['time_str'], overwrite=True)
-    if fix and len(os.listdir(forecast['dir']['analysis_impacts'])) == 0:
-        analyse_impacts.analyse_impacts(forecast['time_str'], overwrite=True)
-    
-    impact_plots = os.listdir(forecast['dir']['analysis_impacts'])
-    if len(impact_plots) == 0:
-        forecast['errors'].append("No impact plots found.")
-        return forecast
-    
-    forecast['success_impact_plots'] = True
-    return forecast
-
-
-def check_report(forecast, fix=False):
-    if not forecast['success_download']:
-        return forecast
 
-    report_path = Path(forecast['dir']['report'], 'report.html')
+    n_failed = out[out['status'].isin(FAILED_STATUSES)]['time_str'].nunique()
+    print(f"{n_failed} of {len(all_times)} forecasts have missing or invalid outputs.")
+    return out
 
-    if fix and not os.path.exists(forecast['dir']['report']):
-        build_report.build_report(forecast['time_str'], overwrite=True)
-    if fix and not os.path.exists(report_path):
-        build_report.build_report(forecast['time_str'], overwrite=True)
 
-    if not os.path.exists(report_path):
-        forecast['errors'].append("No report files found.")
-        return forecast
-    
-    forecast['success_report'] = True
-    return forecast
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Check the outputs of all forecasts against the stage manifests.")
+    parser.add_argument('--fix', action='store_true', help="Rerun failed stages and the stages after them")
+    parser.add_argument('-j', '--workers', type=int, default=4, help="Worker processes")
+    parser.add_argument('--verify', action='store_true',
+                        help="Verify the checksum of every file whose manifest records one. "
+                             "With --backfill, record checksums in the new manifests")
+    parser.add_argument('--ftp', action='store_true', help="Include forecasts on the ECMWF FTP server")
+    parser.add_argument('--backfill', action='store_true',
+                        help="Write manifests for outputs from before stages recorded them")
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    check_outputs_complete(fix=False)
+    args = parse_args()
+    out = check_outputs_complete(fix=args.fix, n_workers=args.workers, verify_checksums=args.verify,
+                                 check_ftp=args.ftp, backfill=args.backfill)
+    sys.exit(1 if out['status'].isin(FAILED_STATUSES).any() else 0)
@@ -18,6 +18,11 @@ rm -v ${OUTPUT_ROOT}*/analysis_tracks/*.png
 
 # Delete the wind fields
 rm -v ${OUTPUT_ROOT}*/wind_fields/*.hdf5
+rm -v ${OUTPUT_ROOT}*/wind_fields/*.h5
+rm -rv ${OUTPUT_ROOT}*/wind_fields/*.csr
+
+# Delete the wind field probability products
+rm -v ${OUTPUT_ROOT}*/analysis_wind_fields/*.h5
 
 # Delete the Impact objects
 rm -v ${OUTPUT_ROOT}*/impacts/*.h5
@@ -26,3 +31,7 @@ rm -v ${OUTPUT_ROOT}*/impacts/*.h5
 rm -v ${OUTPUT_ROOT}*/analysis_impacts/*.png
 rm -v ${OUTPUT_ROOT}*/analysis_impacts/*.csv
 rm -v ${OUTPUT_ROOT}*/analysis_impacts/*.json
+
+# The stage manifests are kept: check_outputs_complete.py reports the stages
+# cleared above as invalid, as their files are gone, and --fix reruns them
+# from download_tracks, which decodes the kept BUFR files again
@@ -22,21 +22,40 @@ from displacement_forecast.impact_calc_func import (
     round_to_previous_12h_utc, get_forecast_times,
     summarize_forecast,
     save_forecast_summary, save_average_impact_geospatial_points,
-    save_impact_at_event
+    save_average_impact_geospatial_grid,
+    impact_points_frame, save_impact_points,
+    save_impact_at_event,
+    list_impacts, iter_impacts, build_impact_analysis, impact_keys,
+    POINT_FORMATS
     )
+from displacement_forecast.archive_func import (
+    at_event_frame, make_summary_tables, save_summary_tables, append_to_archive,
+    ARCHIVE_DB_NAME, SUMMARY_FORMATS
+)
 from displacement_forecast.plot_func import (
     plot_imp_map_exposed,
     plot_imp_map_displacement,
     plot_map_cat,
     plot_histogram,
     make_save_map_file_name,
-    make_save_histogram_file_name
+    make_save_histogram_file_name,
+    plot_inputs,
+    render_plots
 )
+from displacement_forecast.manifest_func import write_stage_manifest
+from displacement_forecast.metrics_func import instrument_stage, add_info
 
 WORKING_DIR = CONFIG.forecast_sandbox.dir.str()
+ARCHIVE_DIR = Path(WORKING_DIR, "archive")
 
 
-def analyse_impacts(time_str=None, overwrite=False):
+@instrument_stage('analyse_impacts')
+def analyse_impacts(time_str=None, overwrite=False, n_workers=None, point_format='geojson',
+                    summary_format='geojson'):
+    if point_format not in POINT_FORMATS:
+        raise ValueError(f"Unknown point format {point_format}: use one of {list(POINT_FORMATS)}")
+    if summary_format not in SUMMARY_FORMATS:
+        raise ValueError(f"Unknown summary format {summary_format}: use one of {SUMMARY_FORMATS}")
 
     FORECAST_DIR = Path(WORKING_DIR, time_str)
     IMPACT_DIR = Path(FORECAST_DIR, "impacts")
@@ -50,32 +69,32 @@ def analyse_impacts(time_str=None, overwrite=False):
 
     if len(os.listdir(IMPACT_ANALYSIS_DIR)) > 0 and not overwrite:
         print(f"Analyses for forecast {time_str} already computed, skipping.")
+        add_info(skipped=True)
         return
 
-    impact_files = os.listdir(IMPACT_DIR)
-    if len(impact_files) == 0:
+    impact_list = list_impacts(IMPACT_DIR)
+    if len(impact_list) == 0:
         print(f"No impacts found at {time_str}. No impacts to analyse.")
+    add_info(storms=impact_list['tc_name'].nunique(), countries=impact_list['country_iso3'].nunique(),
+             impacts=len(impact_list))
 
-    # Start the impact calculation for all the storms
-    for impact_file in impact_files:
+    forecast_time = datetime.strptime(time_str, '%Y%m%d%H0000')
+    formatted_datetime = forecast_time.strftime('%Y-%m-%d_%HUTC')
 
-        if impact_file == '.DS_Store':
-            continue  # ugh
+    # Plots are collected as jobs while going through the impacts and rendered together at the end.
+    # Jobs hold only the data they draw (see plot_inputs), not the impacts
+    plot_jobs = []
+    # Impact points of all storms and countries, saved to one file at the end (unless saved as GeoJSON per impact)
+    point_frames = []
+    # Summaries and per-member impacts, archived and (unless saved per impact) saved to one table each at the end
+    summaries = []
+    at_event_frames = []
 
-        # extract tc_name and country from the hdf file
-        tc_base_file_name = os.path.basename(impact_file)
-        tc_name = tc_base_file_name.split('_')[0]
-        country_iso3 = tc_base_file_name.split('_')[1]
-        impact_type = tc_base_file_name.split('_')[2]
+    # Start the impact calculation for all the storms
+    for tc_name, country_iso3, impact_type, impact in iter_impacts(IMPACT_DIR, impact_list):
         print(f"Analysing {impact_type} impacts for storm {tc_name} in country {country_iso3}...")
 
-        forecast_time = datetime.strptime(time_str, '%Y%m%d%H0000')
-        formatted_datetime = forecast_time.strftime('%Y-%m-%d_%HUTC')
-
-        # read the hdf file
-        impact = Impact.from_hdf5(Path(IMPACT_DIR, impact_file))
-
-        if impact.imp_mat.shape[1] == 1:
+        if impact.eai_exp.size == 1:
             print("Skipping a country with just one centroid: fix this!")   # TODO
             continue
 
@@ -86,48 +105,94 @@ def analyse_impacts(time_str=None, overwrite=False):
             tc_name=tc_name,
             impact=impact)
 
+        # exposure GeoDataFrame, map grid and statistics, shared by all outputs below
+        impact_analysis = build_impact_analysis(
+            impact, reduce='max' if impact_type in ["cat1", "cat3"] else 'sum')
+
         if impact_type in ["exposed", "displaced"]:
-            save_forecast_summary(
-                IMPACT_ANALYSIS_DIR,
-                imp_summary)
-            save_average_impact_geospatial_points(
-                IMPACT_ANALYSIS_DIR,
-                imp_summary,
-                impact)
-            save_impact_at_event(
+            if summary_format == 'geojson':
+                save_forecast_summary(
+                    IMPACT_ANALYSIS_DIR,
+                    imp_summary)
+                save_impact_at_event(
+                    IMPACT_ANALYSIS_DIR,
+                    imp_summary,
+                    impact)
+            summaries.append(imp_summary)
+            at_event_frames.append(at_event_frame(imp_summary, impact))
+            if point_format == 'geojson':
+                save_average_impact_geospatial_points(
+                    IMPACT_ANALYSIS_DIR,
+                    imp_summary,
+                    impact,
+                    impact_analysis=impact_analysis)
+            else:
+                point_frames.append(impact_points_frame(
+                    imp_summary,
+                    impact,
+                    impact_analysis=impact_analysis))
+            save_average_impact_geospatial_grid(
                 IMPACT_ANALYSIS_DIR,
                 imp_summary,
-                impact)
-
-        try:
-            if impact_type == "cat1":
-                # create affected area maps
-                ax_map_cat1 = plot_map_cat(imp_summary, impact, 1)
-                ax_map_cat1.figure.savefig(Path(IMPACT_ANALYSIS_DIR, make_save_map_file_name(imp_summary)))
-
-            if impact_type == "cat3":
-                # create affected area maps
-                ax_map_cat3 = plot_map_cat(imp_summary, impact, 3)
-                ax_map_cat3.figure.savefig(Path(IMPACT_ANALYSIS_DIR, make_save_map_file_name(imp_summary)))
-
-            if impact_type == "exposed":
-                # create impact maps
-                ax_map_exposed = plot_imp_map_exposed(imp_summary, impact)
-                ax_map_exposed.figure.savefig(Path(IMPACT_ANALYSIS_DIR, make_save_map_file_name(imp_summary)))
-
-                # create histogram
-                ax_hist_exposed = plot_histogram(imp_summary, impact)
-                ax_hist_exposed.figure.savefig(Path(IMPACT_ANALYSIS_DIR, make_save_histogram_file_name(imp_summary)))
-
-            if impact_type == "displaced":
-                # create impact maps
-                ax_map_displacement = plot_imp_map_displacement(imp_summary, impact)
-                ax_map_displacement.figure.savefig(Path(IMPACT_ANALYSIS_DIR, make_save_map_file_name(imp_summary)))
-
-                # create histogram
-                ax_hist_displacement = plot_histogram(imp_summary, impact)
-                ax_hist_displacement.figure.savefig(Path(IMPACT_ANALYSIS_DIR, make_save_histogram_file_name(imp_summary)))
-        
-        except Exception as e:
-            print(f"Could not create plots for {impact_type} impacts for storm {tc_name} in country {country_iso3}. Error: {e}")
-            raise e
\ No newline at end of file
+                impact,
+                impact_analysis=impact_analysis)
+
+        plot_analysis = plot_inputs(impact_analysis)
+
+        if impact_type == "cat1":
+            # create affected area maps
+            plot_jobs.append((plot_map_cat, (imp_summary, None, 1, plot_analysis),
+                              Path(IMPACT_ANALYSIS_DIR, make_save_map_file_name(imp_summary))))
+
+        if impact_type == "cat3":
+            # create affected area maps
+            plot_jobs.append((plot_map_cat, (imp_summary, None, 3, plot_analysis),
+                              Path(IMPACT_ANALYSIS_DIR, make_save_map_file_name(imp_summary))))
+
+        if impact_type == "exposed":
+            # create impact maps
+            plot_jobs.append((plot_imp_map_exposed, (imp_summary, None, plot_analysis),
+                              Path(IMPACT_ANALYSIS_DIR, make_save_map_file_name(imp_summary))))
+
+            # create histogram
+            plot_jobs.append((plot_histogram, (imp_summary, None, plot_analysis),
+                              Path(IMPACT_ANALYSIS_DIR, make_save_histogram_file_name(imp_summary))))
+
+        if impact_type == "displaced":
+            # create impact maps
+            plot_jobs.append((plot_imp_map_displacement, (imp_summary, None, plot_analysis),
+                              Path(IMPACT_ANALYSIS_DIR, make_save_map_file_name(imp_summary))))
+
+            # create histogram
+            plot_jobs.append((plot_histogram, (imp_summary, None, plot_analysis),
+                              Path(IMPACT_ANALYSIS_DIR, make_save_histogram_file_name(imp_summary))))
+
+    summary_table, at_event_table = make_summary_tables(time_str, summaries, at_event_frames)
+    if summary_format == 'parquet':
+        save_summary_tables(
+            IMPACT_ANALYSIS_DIR,
+            formatted_datetime,
+            summary_table,
+            at_event_table)
+    # also without any summaries, so that a forecast that lost its impacts is removed from the archive
+    append_to_archive(Path(ARCHIVE_DIR, ARCHIVE_DB_NAME), time_str, summary_table, at_event_table)
+
+    if len(point_frames) > 0:
+        save_impact_points(
+            IMPACT_ANALYSIS_DIR,
+            formatted_datetime,
+            point_frames,
+            point_format=point_format)
+
+    print(f"Rendering {len(plot_jobs)} plots...")
+    add_info(plots=len(plot_jobs))
+    failures = render_plots(plot_jobs, n_workers=n_workers)
+    for save_path, e in failures:
+        print(f"Could not create plot {os.path.basename(save_path)}. Error: {e}")
+    if len(failures) > 0:
+        raise failures[0][1]
+
+    write_stage_manifest(FORECAST_DIR, 'analyse_impacts', expected={
+        'storms': set(impact_list['tc_name']),
+        'impacts': impact_keys(impact_list)
+    })
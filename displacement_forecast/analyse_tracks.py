@@ -26,16 +26,23 @@ from matplotlib.colors import BoundaryNorm, ListedColormap
 from climada_petals.hazard import TCForecast
 from climada.hazard import TCTracks
 from climada import CONFIG
-from displacement_forecast.tc_tracks_func import filter_storm, _correct_max_sustained_wind_speed
+from displacement_forecast.tc_tracks_func import (
+    filter_storm, _correct_max_sustained_wind_speed,
+    get_peak_category, get_category_probabilities
+)
 from displacement_forecast.plot_func import (
     plot_global_tracks, plot_empty_base_map, 
-    plot_interactive_map, plot_empty_interactive_map
+    plot_interactive_map, plot_empty_interactive_map,
+    render_plots
 )
-from displacement_forecast.calculate_windfields import get_forecast_tracks
+from displacement_forecast.calculate_windfields import get_forecast_tracks, N_ENSEMBLE
+from displacement_forecast.manifest_func import write_stage_manifest
+from displacement_forecast.metrics_func import instrument_stage, add_info
 
 WORKING_DIR = CONFIG.forecast_sandbox.dir.str()
 
 
+@instrument_stage('analyse_tracks')
 def analyse_tracks(time_str, overwrite=False):
 
     FORECAST_DIR = Path(WORKING_DIR, time_str)
@@ -50,14 +57,56 @@ def analyse_tracks(time_str, overwrite=False):
 
     if len(os.listdir(TRACK_ANALYSIS_DIR)) > 0 and not overwrite:
         print(f"Forecast track analysis for {time_str} already computed, skipping.")
+        add_info(skipped=True)
         return
 
     # retrieve the forecast (already downloaded)
     tr_filter = get_forecast_tracks(time_str)
+    add_info(storms=len({tr.name for tr in tr_filter.data}), members=len(tr_filter.data))
     forecast_time = datetime.strptime(time_str, '%Y%m%d%H0000')
     formatted_datetime = forecast_time.strftime('%Y-%m-%d %H:%M UTC')
 
     # plotting the global overview in .png
+    print(f"Plotting {len(tr_filter.data)} named storms.")
+    failures = render_plots(
+        [(plot_tracks_overview, (tr_filter, formatted_datetime),
+          Path(TRACK_ANALYSIS_DIR, f"ECMWF_TC_tracks_{time_str}.png"))],
+        n_workers=1
+    )
+    if failures:
+        raise failures[0][1]
+
+    # Saffir-Simpson category statistics for each storm's ensemble
+    if len(tr_filter.data) > 0:
+        peak_category = get_peak_category(tr_filter)
+        peak_category.to_csv(Path(TRACK_ANALYSIS_DIR, f"ECMWF_TC_peak_category_{time_str}.csv"), index=False)
+
+        for tr_name in peak_category['name'].unique():
+            cat_probabilities = get_category_probabilities(
+                tr_filter.subset({'name': tr_name}),
+                forecast_time,
+                n_ensemble=N_ENSEMBLE
+            )
+            cat_probabilities.to_csv(Path(TRACK_ANALYSIS_DIR, f"ECMWF_TC_category_probabilities_{tr_name}_{time_str}.csv"))
+
+    # plotting the global overview in interactive map
+    print("Skipping interactive map for now...")
+    # if len(tr_filter.data)==0:
+    #     fig_interactive = plot_empty_interactive_map()
+    # else:
+    #     fig_interactive = plot_interactive_map(tr_filter)
+
+    # fig_interactive.write_html(
+    #     Path(TRACK_ANALYSIS_DIR, f"ECMWF_TC_tracks_interactive_map_{formatted_datetime}.html"),
+    #     full_html=False,  # for embedding in other HTML files
+    #     include_plotlyjs='cdn'
+    # )
+
+    write_stage_manifest(FORECAST_DIR, 'analyse_tracks', expected={'storms': {tr.name for tr in tr_filter.data}})
+
+
+def plot_tracks_overview(tr_filter, formatted_datetime):
+    """Global map of all forecast tracks, or an empty map if there are no named storms"""
     if len(tr_filter.data)==0:
         print("No named storms. Generating empty plot.")
         axis_png = plot_empty_base_map()
@@ -66,7 +115,6 @@ def analyse_tracks(time_str, overwrite=False):
             f"Current number of active storms: 0",
             fontdict={"fontsize": 14})
     else:
-        print(f"Plotting {len(tr_filter.data)} named storms.")
         tr_unique_storm_id = [tr.sid for tr in tr_filter.data]
         tr_storm_id_list = list(set(tr_unique_storm_id))
 
@@ -75,18 +123,4 @@ def analyse_tracks(time_str, overwrite=False):
             f"Forecast time: {formatted_datetime}\n"
             f"Current number of active storms: {str(len(tr_storm_id_list))}",
             fontdict={"fontsize": 14})
-
-    axis_png.figure.savefig(Path(TRACK_ANALYSIS_DIR, f"ECMWF_TC_tracks_{time_str}.png"))
-
-    # plotting the global overview in interactive map
-    print("Skipping interactive map for now...")
-    # if len(tr_filter.data)==0:
-    #     fig_interactive = plot_empty_interactive_map()
-    # else:
-    #     fig_interactive = plot_interactive_map(tr_filter)
-
-    # fig_interactive.write_html(
-    #     Path(TRACK_ANALYSIS_DIR, f"ECMWF_TC_tracks_interactive_map_{formatted_datetime}.html"),
-    #     full_html=False,  # for embedding in other HTML files
-    #     include_plotlyjs='cdn'
-    # )
\ No newline at end of file
+    return axis_png
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ensemble probability products computed directly from the forecast wind fields.
+Output: per-centroid probability of exceeding a list of wind thresholds, in .h5 format
+
+@author: Chris Fairless
+"""
+import warnings
+warnings.filterwarnings("ignore")
+
+import os
+from pathlib import Path
+
+from climada import CONFIG
+
+from displacement_forecast.hazard_func import (
+    EXCEEDANCE_THRESHOLDS, list_wind_field_files, read_wind_field,
+    exceedance_probability, write_exceedance_probability
+)
+from displacement_forecast.manifest_func import write_stage_manifest
+from displacement_forecast.metrics_func import instrument_stage, add_info
+
+WORKING_DIR = CONFIG.forecast_sandbox.dir.str()
+
+
+@instrument_stage('analyse_windfields')
+def analyse_windfields(time_str, overwrite=False, thresholds=EXCEEDANCE_THRESHOLDS):
+
+    FORECAST_DIR = Path(WORKING_DIR, time_str)
+    WIND_DIR = Path(FORECAST_DIR, "wind_fields")
+    WIND_ANALYSIS_DIR = Path(FORECAST_DIR, "analysis_wind_fields")
+
+    if not os.path.exists(FORECAST_DIR):
+        raise FileNotFoundError(f"Directory {str(FORECAST_DIR)} does not exist. Please download the forecast first and calculate wind fields.")
+    if not os.path.exists(WIND_DIR):
+        raise FileNotFoundError(f"Directory {str(WIND_DIR)} does not exist. Please calculate wind fields first.")
+    os.makedirs(WIND_ANALYSIS_DIR, exist_ok=True)
+
+    if len(os.listdir(WIND_ANALYSIS_DIR)) > 0 and not overwrite:
+        print(f"Wind field analysis for forecast {time_str} already computed, skipping.")
+        add_info(skipped=True)
+        return
+
+    tc_wind_files = list_wind_field_files(WIND_DIR)
+    if len(tc_wind_files) == 0:
+        print(f"No TC activities found at {time_str}. No wind fields to analyse.")
+    add_info(storms=len(tc_wind_files))
+
+    for tc_file in tc_wind_files:
+        tc_name = os.path.basename(tc_file).split('_')[2]
+        print(f"Computing wind exceedance probabilities for storm {tc_name}")
+
+        tc_haz, _ = read_wind_field(Path(WIND_DIR, tc_file))
+        probability = exceedance_probability(tc_haz, thresholds)
+        write_exceedance_probability(
+            Path(WIND_ANALYSIS_DIR, f"wind_exceedance_{tc_name}_{time_str}.h5"),
+            tc_haz,
+            probability,
+            thresholds
+        )
+
+    write_stage_manifest(FORECAST_DIR, 'analyse_windfields',
+                         expected={'storms': [os.path.basename(f).split('_')[2] for f in tc_wind_files]})
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Consolidated impact summary tables and the archive across forecasts.
+
+With the 'parquet' summary format, each forecast gets two Parquet tables in
+its impact analysis directory instead of per-impact GeoJSON and CSV files:
+    impact-summary_TC_ECMWF_ens_<time>.parquet   one row per storm, country and impact type
+    impact-at-event_TC_ECMWF_ens_<time>.parquet  one row per storm, country, impact type and member
+
+Whatever the format, the same tables are appended to the archive across
+forecasts, a SQLite database in the archive directory, indexed by storm,
+country, impact type and forecast time. Re-running a forecast replaces its rows, so the archive never
+holds duplicates, and a forecast without impacts anymore is removed from it.
+read_archive returns the archived rows of a storm, country, impact type or
+period, and query_impact_evolution the ensemble statistics of an impact
+across forecasts, both from an index lookup however many forecasts have been
+archived.
+
+@author: Chris Fairless
+"""
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from datetime import datetime
+from typing import Union
+
+from climada.engine import Impact
+
+ARCHIVE_TABLES = ['summary', 'at_event']
+"""Tables of the archive: impact summaries and per-member impacts."""
+
+KEY_COLUMNS = ['eventName', 'countryISO3', 'impactType']
+
+SUMMARY_FORMATS = ['geojson', 'parquet']
+"""Formats of the per-forecast summaries: per-impact GeoJSON and CSV files, or the two Parquet tables."""
+
+ARCHIVE_DB_NAME = "impact_archive.sqlite"
+"""File name of the SQLite archive database in the archive directory."""
+
+SUMMARY_DB_COLUMNS = {
+    'mean': 'mean', 'median': 'median',
+    '05perc': 'p05', '25perc': 'p25', '75perc': 'p75', '95perc': 'p95',
+    'hazardType': 'hazard_type', 'weatherModel': 'weather_model', 'impactUnit': 'impact_unit'
+}
+"""Summary statistics stored in the database, and their column names there."""
+
+ARCHIVE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS summary (
+    event_name TEXT NOT NULL,
+    country_iso3 TEXT NOT NULL,
+    impact_type TEXT NOT NULL,
+    forecast_timestamp TEXT NOT NULL,
+    time_str TEXT NOT NULL,
+    mean REAL, median REAL, p05 REAL, p25 REAL, p75 REAL, p95 REAL,
+    hazard_type TEXT, weather_model TEXT, impact_unit TEXT,
+    PRIMARY KEY (event_name, country_iso3, impact_type, forecast_timestamp)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS summary_country_time ON summary (country_iso3, impact_type, forecast_timestamp);
+CREATE INDEX IF NOT EXISTS summary_time ON summary (time_str);
+CREATE TABLE IF NOT EXISTS at_event (
+    event_name TEXT NOT NULL,
+    country_iso3 TEXT NOT NULL,
+    impact_type TEXT NOT NULL,
+    forecast_timestamp TEXT NOT NULL,
+    time_str TEXT NOT NULL,
+    ensemble_id INTEGER NOT NULL,
+    at_event REAL,
+    PRIMARY KEY (event_name, country_iso3, impact_type, forecast_timestamp, ensemble_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS at_event_country_time ON at_event (country_iso3, impact_type, forecast_timestamp);
+CREATE INDEX IF NOT EXISTS at_event_time ON at_event (time_str);
+"""
+
+TIME_COLUMN = 'forecast_timestamp'
+"""Column holding the forecast initialisation time in every consolidated and archived table."""
+
+
+def at_event_frame(imp_summary_dict: dict, impact: Impact):
+    """
+    Impact of each ensemble member of one impact, labelled with the storm,
+    country and impact type.
+
+    Returns
+    -------
+    df: DataFrame with columns eventName, countryISO3, impactType, ensemble_id, at_event
+    """
+    return pd.DataFrame({
+        'eventName': imp_summary_dict["eventName"],
+        'countryISO3': imp_summary_dict["countryISO3"],
+        'impactType': imp_summary_dict["impactType"],
+        'ensemble_id': np.asarray(impact.event_id),
+        'at_event': np.asarray(impact.at_event),
+    })
+
+
+def make_save_table_filename(table: str, forecast_time: str):
+    """File name of a consolidated table of a forecast"""
+    table_name = table.replace('_', '-')
+    return f'impact-{table_name}_TC_ECMWF_ens_{forecast_time}.parquet'
+
+
+def _with_forecast_time(df: pd.DataFrame, time_str: str):
+    """Add the forecast time as a timestamp column, for queries across forecasts"""
+    df = df.copy()
+    df.insert(0, TIME_COLUMN, pd.Timestamp(datetime.strptime(time_str, '%Y%m%d%H0000')))
+    return df
+
+
+def make_summary_tables(time_str: str,
+                        summaries: list,
+                        at_event_frames: list):
+    """
+    The summaries and per-member impacts of all storms, countries and impact
+    types of a forecast as one table each, as saved by save_summary_tables
+    and archived by append_to_archive.
+
+    Parameters
+    ----------
+    time_str: str
+        Forecast time as in the forecast directory name, e.g. 20250811000000.
+
+    summaries: list
+        Summary dictionaries from summarize_forecast.
+
+    at_event_frames: list
+        DataFrames from at_event_frame.
+
+    Returns
+    -------
+    summary, at_event: DataFrame
+    """
+    summary = pd.DataFrame(summaries)
+    if len(summary) > 0:
+        summary = summary.sort_values(KEY_COLUMNS, ignore_index=True)
+    at_event = pd.concat(at_event_frames, ignore_index=True) if len(at_event_frames) > 0 else \
+        pd.DataFrame(columns=KEY_COLUMNS + ['ensemble_id', 'at_event'])
+    if len(at_event) > 0:
+        at_event = at_event.sort_values(KEY_COLUMNS + ['ensemble_id'], ignore_index=True)
+
+    return _with_forecast_time(summary, time_str), _with_forecast_time(at_event, time_str)
+
+
+def save_summary_tables(save_dir: Union[str, Path],
+                        forecast_time: str,
+                        summary: pd.DataFrame,
+                        at_event: pd.DataFrame):
+    """
+    Save the summary and per-member impact tables of a forecast, from
+    make_summary_tables, as Parquet.
+
+    Parameters
+    ----------
+    save_dir: Union[str, Path],
+        Directory where the output is saved to.
+
+    forecast_time: str
+        Forecast initialisation time as in the summaries, used in file names.
+
+    summary, at_event: DataFrame
+        Tables from make_summary_tables.
+    """
+    summary.to_parquet(Path(save_dir, make_save_table_filename('summary', forecast_time)), index=False)
+    at_event.to_parquet(Path(save_dir, make_save_table_filename('at_event', forecast_time)), index=False)
+
+
+def read_summary_table(save_dir: Union[str, Path],
+                       forecast_time: str,
+                       table: str = 'summary'):
+    """Read a consolidated table ('summary' or 'at_event') of one forecast"""
+    return pd.read_parquet(Path(save_dir, make_save_table_filename(table, forecast_time)))
+
+
+def connect_archive_db(db_path: Union[str, Path]):
+    """Open the archive database, creating its tables and indices if needed"""
+    os.makedirs(Path(db_path).parent, exist_ok=True)
+    con = sqlite3.connect(db_path, timeout=60)
+    # readers are not blocked while a forecast is being written
+    con.execute("PRAGMA journal_mode=WAL")
+    con.executescript(ARCHIVE_DB_SCHEMA)
+    return con
+
+
+def append_to_archive(db_path: Union[str, Path],
+                      time_str: str,
+                      summary: pd.DataFrame,
+                      at_event: pd.DataFrame):
+    """
+    Store the summaries and per-member impacts of one forecast in the archive,
+    replacing anything stored for that forecast before. With empty tables the
+    forecast is just removed. The forecast is written in a single transaction.
+
+    Parameters
+    ----------
+    db_path: Union[str, Path]
+        Path of the archive database.
+
+    time_str: str
+        Forecast time as in the forecast directory name, e.g. 20250811000000.
+
+    summary, at_event: DataFrame
+        Tables from make_summary_tables.
+    """
+    timestamp = str(pd.Timestamp(datetime.strptime(time_str, '%Y%m%d%H0000')))
+    summary_rows = [
+        (row['eventName'], row['countryISO3'], row['impactType'], timestamp, time_str,
+         *[row[col] for col in SUMMARY_DB_COLUMNS])
+        for row in summary.to_dict('records')
+    ]
+    at_event_rows = list(zip(
+        at_event['eventName'], at_event['countryISO3'], at_event['impactType'],
+        [timestamp] * len(at_event), [time_str] * len(at_event),
+        at_event['ensemble_id'].astype(int).tolist(), at_event['at_event'].astype(float).tolist()
+    ))
+
+    summary_placeholders = ', '.join(['?'] * (5 + len(SUMMARY_DB_COLUMNS)))
+    con = connect_archive_db(db_path)
+    try:
+        with con:
+            con.execute("DELETE FROM summary WHERE time_str = ?", (time_str,))
+            con.execute("DELETE FROM at_event WHERE time_str = ?", (time_str,))
+            con.executemany(
+                f"INSERT INTO summary (event_name, country_iso3, impact_type, forecast_timestamp, time_str, "
+                f"{', '.join(SUMMARY_DB_COLUMNS.values())}) VALUES ({summary_placeholders})",
+                summary_rows)
+            con.executemany(
+                "INSERT INTO at_event VALUES (?, ?, ?, ?, ?, ?, ?)",
+                at_event_rows)
+    finally:
+        con.close()
+
+
+def _where_clause(tc_name, country_iso3, impact_type, start, end):
+    """SQL conditions and parameters for a storm/country/impact type/time query"""
+    conditions, params = [], []
+    for col, value in [('event_name', tc_name), ('country_iso3', country_iso3), ('impact_type', impact_type)]:
+        if value is not None:
+            conditions.append(f"{col} = ?")
+            params.append(value)
+    if start is not None:
+        conditions.append("forecast_timestamp >= ?")
+        params.append(str(pd.Timestamp(start)))
+    if end is not None:
+        conditions.append("forecast_timestamp <= ?")
+        params.append(str(pd.Timestamp(end)))
+    where = f"WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ""
+    return where, params
+
+
+def read_archive(db_path: Union[str, Path],
+                 table: str = 'summary',
+                 tc_name: str = None,
+                 country_iso3: str = None,
+                 impact_type: str = None,
+                 start: Union[str, datetime] = None,
+                 end: Union[str, datetime] = None):
+    """
+    Query an archive table by storm, country, impact type and forecast time.
+
+    Parameters
+    ----------
+    db_path: Union[str, Path]
+        Path of the archive database.
+
+    table: str
+        One of ARCHIVE_TABLES. Default: 'summary'
+
+    tc_name, country_iso3, impact_type: str
+        Only return rows of this storm, country or impact type.
+
+    start, end: str or datetime
+        Only return forecasts initialised in [start, end].
+
+    Returns
+    -------
+    df: DataFrame with the database columns, sorted by forecast time, empty
+        if nothing has been archived yet.
+    """
+    if table not in ARCHIVE_TABLES:
+        raise ValueError(f"Unknown archive table {table}: use one of {ARCHIVE_TABLES}")
+    if not os.path.exists(db_path):
+        return pd.DataFrame()
+    where, params = _where_clause(tc_name, country_iso3, impact_type, start, end)
+
+    con = sqlite3.connect(db_path, timeout=60)
+    try:
+        df = pd.read_sql_query(f"SELECT * FROM {table} {where} ORDER BY forecast_timestamp", con, params=params)
+    finally:
+        con.close()
+    df['forecast_timestamp'] = pd.to_datetime(df['forecast_timestamp'])
+    return df
+
+
+def query_impact_evolution(db_path: Union[str, Path],
+                           tc_name: str = None,
+                           country_iso3: str = None,
+                           impact_type: str = 'displaced',
+                           start: Union[str, datetime] = None,
+                           end: Union[str, datetime] = None,
+                           quantiles: list = None,
+                           n_ensemble: int = 51):
+    """
+    Ensemble statistics of an impact across successive forecasts.
+
+    Parameters
+    ----------
+    db_path: Union[str, Path]
+        Path of the archive database.
+
+    tc_name, country_iso3, impact_type: str
+        Storm, country and impact type to query. None matches all.
+        Default impact type: 'displaced'
+
+    start, end: str or datetime
+        Only forecasts initialised in [start, end].
+
+    quantiles: list
+        Quantiles (0-1) of the ensemble to compute from the stored member
+        impacts, e.g. [0.1, 0.5, 0.9]. Default: None, which returns the stored
+        summary statistics (mean, median, 5th, 25th, 75th, 95th percentiles)
+        without reading the members.
+
+    n_ensemble: int
+        Ensemble size. Members missing from a forecast count as zero impact,
+        as in the forecast summaries. Default: 51
+
+    Returns
+    -------
+    df: DataFrame
+        One row per storm, country, impact type and forecast, sorted by
+        forecast time, with column forecast_timestamp and the statistics.
+    """
+    if not os.path.exists(db_path):
+        return pd.DataFrame()
+    where, params = _where_clause(tc_name, country_iso3, impact_type, start, end)
+    key_cols = ['event_name', 'country_iso3', 'impact_type', 'forecast_timestamp']
+
+    con = sqlite3.connect(db_path, timeout=60)
+    try:
+        if quantiles is None:
+            df = pd.read_sql_query(
+                f"SELECT {', '.join(key_cols)}, mean, median, p05, p25, p75, p95 FROM summary {where} "
+                f"ORDER BY forecast_timestamp", con, params=params)
+            df['forecast_timestamp'] = pd.to_datetime(df['forecast_timestamp'])
+            return df
+        members = pd.read_sql_query(
+            f"SELECT {', '.join(key_cols)}, at_event FROM at_event {where}", con, params=params)
+    finally:
+        con.close()
+
+    rows = []
+    for key, group in members.groupby(key_cols, sort=False):
+        values = group['at_event'].to_numpy()
+        if len(values) < n_ensemble:
+            values = np.pad(values, (0, n_ensemble - len(values)))
+        rows.append((*key, values.mean(), *np.quantile(values, quantiles)))
+    df = pd.DataFrame(rows, columns=key_cols + ['mean'] + [f"q{q:g}" for q in quantiles])
+    df['forecast_timestamp'] = pd.to_datetime(df['forecast_timestamp'])
+    return df.sort_values('forecast_timestamp', ignore_index=True)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Base maps for the impact maps, served from a local tile cache.
+
+Raster tiles are stored as {tile dir}/{provider}/{z}/{x}/{y}.png. Tiles
+missing from the cache are downloaded once, unless offline mode is on, in
+which case (or if a download fails) the map falls back to a Natural Earth
+vector base map drawn with cartopy. Seed the cache for the countries of
+interest with seed_tile_cache (seed_basemap_tiles.py, or --seed-tiles in the
+pipeline scripts) before running on machines without network access.
+
+Environment variables:
+    BASEMAP_TILE_DIR: tile cache directory.
+        Default: ~/.cache/displacement_forecast/basemap_tiles
+    BASEMAP_OFFLINE: if set to 1/true/yes, never download tiles.
+
+@author: Chris Fairless
+"""
+import os
+import io
+import numpy as np
+from pathlib import Path
+from typing import Union
+
+import requests
+import mercantile
+from PIL import Image
+import geopandas as gpd
+import cartopy.feature as cf
+from shapely.geometry import box
+import contextily as ctx
+
+import climada.util.coordinates as u_coord
+
+BASEMAP_PROVIDER = ctx.providers.CartoDB.Positron
+"""Default raster tile provider for the impact maps."""
+
+BASEMAP_TILE_DIR = Path(os.environ.get(
+    "BASEMAP_TILE_DIR",
+    Path(Path.home(), ".cache", "displacement_forecast", "basemap_tiles")
+))
+
+BASEMAP_OFFLINE = os.environ.get("BASEMAP_OFFLINE", "").lower() in ("1", "true", "yes")
+
+TILES_ACROSS = 3
+"""Approximate number of tiles spanning the map width when choosing a zoom level."""
+
+MAX_ZOOM = 12
+"""Highest zoom level used or seeded."""
+
+MAX_LAT = 85.0511
+"""Latitude limit of the Web Mercator tile grid."""
+
+DOWNLOAD_TIMEOUT = 20
+
+EARTH_CIRCUMFERENCE = 2 * np.pi * 6378137.
+"""Width of the Web Mercator world in metres."""
+
+VECTOR_SCALE = "50m"
+"""Natural Earth resolution of the fallback vector base map."""
+
+
+def tile_path(provider: dict, z: int, x: int, y: int, tile_dir: Union[str, Path] = None):
+    """Path of a tile in the local cache"""
+    tile_dir = BASEMAP_TILE_DIR if tile_dir is None else tile_dir
+    return Path(tile_dir, provider['name'], str(z), str(x), f"{y}.png")
+
+
+def get_tile(provider: dict, z: int, x: int, y: int,
+             tile_dir: Union[str, Path] = None, offline: bool = None):
+    """
+    Get a tile from the local cache, downloading it first if needed.
+
+    Parameters
+    ----------
+    provider: dict
+        A contextily/xyzservices tile provider.
+    z, x, y: int
+        Tile coordinates.
+    tile_dir: str or Path
+        Tile cache directory. Default: BASEMAP_TILE_DIR
+    offline: bool
+        Never download. Default: BASEMAP_OFFLINE
+
+    Returns
+    -------
+    path: Path or None
+        Path of the cached tile, None if it is not cached and can't be downloaded.
+    """
+    offline = BASEMAP_OFFLINE if offline is None else offline
+    path = tile_path(provider, z, x, y, tile_dir)
+    if path.exists():
+        return path
+    if offline:
+        return None
+
+    try:
+        response = requests.get(provider.build_url(x=x, y=y, z=z), timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        # check it's an image before it goes in the cache
+        Image.open(io.BytesIO(response.content)).verify()
+    except Exception as e:
+        print(f"Could not download tile {z}/{x}/{y} from {provider['name']}: {e}")
+        return None
+
+    # write to a temporary file so that parallel workers never read a partial tile
+    os.makedirs(path.parent, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(response.content)
+    os.replace(tmp_path, path)
+    return path
+
+
+def choose_zoom(extent):
+    """
+    Zoom level for a map extent, so that about TILES_ACROSS tiles span its width.
+
+    Parameters
+    ----------
+    extent: tuple
+        (xmin, xmax, ymin, ymax) in Web Mercator (EPSG:3857).
+    """
+    width = max(extent[1] - extent[0], 1.)
+    zoom = int(np.floor(np.log2(TILES_ACROSS * EARTH_CIRCUMFERENCE / width)))
+    return int(np.clip(zoom, 0, MAX_ZOOM))
+
+
+def _extent_to_lonlat(extent):
+    """(west, south, east, north) in degrees of a Web Mercator extent (xmin, xmax, ymin, ymax)"""
+    west, south = mercantile.lnglat(extent[0], extent[2])
+    east, north = mercantile.lnglat(extent[1], extent[3])
+    return (max(west, -180.), max(south, -MAX_LAT), min(east, 180.), min(north, MAX_LAT))
+
+
+def _lon_range(geometry):
+    """
+    (west, east) in degrees of a geometry, east beyond 180 if the geometry is
+    narrower when its parts in the western hemisphere are moved across the
+    antimeridian, e.g. for Fiji or Russia
+    """
+    parts = geometry.geoms if hasattr(geometry, 'geoms') else [geometry]
+    part_bounds = np.array([part.bounds for part in parts if not part.is_empty])
+    west, east = part_bounds[:, 0], part_bounds[:, 2]
+    shift = np.where(east <= 0, 360., 0.)
+    if (east + shift).max() - (west + shift).min() < east.max() - west.min():
+        return (west + shift).min(), (east + shift).max()
+    return west.min(), east.max()
+
+
+def split_antimeridian(bounds):
+    """
+    Split (west, south, east, north) in degrees, with west below -180 or east
+    beyond 180, into boxes on either side of the antimeridian
+    """
+    west, south, east, north = bounds
+    if east - west >= 360:
+        return [(-180., south, 180., north)]
+    if west < -180:
+        west, east = west + 360, east + 360
+    if east <= 180:
+        return [(west, south, east, north)]
+    return [(west, south, 180., north), (-180., south, east - 360, north)]
+
+
+def _bounds_tiles(bounds, zoom):
+    """All tiles at a zoom level covering (west, south, east, north) in degrees"""
+    west, south, east, north = bounds
+    return list(mercantile.tiles(
+        max(west, -180.), max(south, -MAX_LAT), min(east, 180.), min(north, MAX_LAT), zoom
+    ))
+
+
+def build_mosaic(extent, zoom: int = None, provider: dict = None,
+                 tile_dir: Union[str, Path] = None, offline: bool = None):
+    """
+    Assemble the cached tiles covering a map extent into a single image.
+
+    Parameters
+    ----------
+    extent: tuple
+        (xmin, xmax, ymin, ymax) in Web Mercator (EPSG:3857).
+    zoom: int
+        Zoom level. Default: choose_zoom(extent)
+    provider: dict
+        Tile provider. Default: BASEMAP_PROVIDER
+    tile_dir: str or Path
+        Tile cache directory. Default: BASEMAP_TILE_DIR
+    offline: bool
+        Never download. Default: BASEMAP_OFFLINE
+
+    Returns
+    -------
+    image, image_extent: np.ndarray, tuple
+        RGBA image and its (xmin, xmax, ymin, ymax) in Web Mercator, or
+        (None, None) if any tile is unavailable.
+    """
+    provider = BASEMAP_PROVIDER if provider is None else provider
+    zoom = choose_zoom(extent) if zoom is None else zoom
+
+    tiles = _bounds_tiles(_extent_to_lonlat(extent), zoom)
+    if len(tiles) == 0:
+        return None, None
+    xs = sorted({t.x for t in tiles})
+    ys = sorted({t.y for t in tiles})
+
+    mosaic = None
+    for tile in tiles:
+        path = get_tile(provider, tile.z, tile.x, tile.y, tile_dir, offline)
+        if path is None:
+            return None, None
+        img = np.asarray(Image.open(path).convert('RGBA'))
+        if mosaic is None:
+            tile_h, tile_w = img.shape[:2]
+            mosaic = np.zeros((len(ys) * tile_h, len(xs) * tile_w, 4), dtype=np.uint8)
+        row, col = ys.index(tile.y), xs.index(tile.x)
+        mosaic[row * tile_h:(row + 1) * tile_h, col * tile_w:(col + 1) * tile_w] = img
+
+    top_left = mercantile.xy_bounds(xs[0], ys[0], zoom)
+    bottom_right = mercantile.xy_bounds(xs[-1], ys[-1], zoom)
+    image_extent = (top_left.left, bottom_right.right, bottom_right.bottom, top_left.top)
+    return mosaic, image_extent
+
+
+def add_vector_basemap(ax):
+    """
+    Draw a Natural Earth land, coastline and border base map on an axis in Web
+    Mercator coordinates. Needs no tiles: the Natural Earth data are read from
+    the cartopy data directory.
+    """
+    extent = ax.axis()
+    west, south, east, north = _extent_to_lonlat(extent)
+    bbox = box(west, south, east, north)
+
+    def clipped(feature):
+        geoms = [g.intersection(bbox) for g in feature.intersecting_geometries((west, east, south, north))]
+        geoms = [g for g in geoms if not g.is_empty]
+        return gpd.GeoSeries(geoms, crs="EPSG:4326").to_crs(epsg=3857)
+
+    ax.set_facecolor("#f2f2f0")
+    land = clipped(cf.LAND.with_scale(VECTOR_SCALE))
+    if len(land) > 0:
+        land.plot(ax=ax, facecolor="#fafaf8", edgecolor="none", zorder=0)
+    coast = clipped(cf.COASTLINE.with_scale(VECTOR_SCALE))
+    if len(coast) > 0:
+        coast.plot(ax=ax, color="#b0b0b0", lw=.5, zorder=0)
+    borders = clipped(cf.BORDERS.with_scale(VECTOR_SCALE))
+    if len(borders) > 0:
+        borders.plot(ax=ax, color="#c8c8c8", lw=.4, linestyle="--", zorder=0)
+    ax.axis(extent)
+
+
+def add_basemap(ax, zoom: int = None, provider: dict = None,
+                tile_dir: Union[str, Path] = None, offline: bool = None):
+    """
+    Add a base map beneath the data on an axis in Web Mercator coordinates.
+
+    A drop-in replacement for contextily.add_basemap that reads tiles from the
+    local cache and falls back to add_vector_basemap if any tile is unavailable.
+
+    Parameters
+    ----------
+    ax: matplotlib axis
+        Axis with limits set, in Web Mercator (EPSG:3857).
+    zoom: int
+        Zoom level. Default: choose_zoom for the axis extent
+    provider: dict
+        Tile provider. Default: BASEMAP_PROVIDER
+    tile_dir: str or Path
+        Tile cache directory. Default: BASEMAP_TILE_DIR
+    offline: bool
+        Never download. Default: BASEMAP_OFFLINE
+    """
+    extent = ax.axis()
+    image, image_extent = build_mosaic(extent, zoom, provider, tile_dir, offline)
+    if image is None:
+        add_vector_basemap(ax)
+        return
+
+    ax.imshow(image, extent=image_extent, interpolation='bilinear', zorder=0)
+    ax.axis(extent)
+
+    provider = BASEMAP_PROVIDER if provider is None else provider
+    if 'attribution' in provider:
+        ctx.add_attribution(ax, provider['attribution'])
+
+
+def seed_tile_cache(iso3_list: list, zooms=None, provider: dict = None,
+                    tile_dir: Union[str, Path] = None, buffer_deg: float = 3.):
+    """
+    Download all tiles covering a list of countries into the local cache, and
+    make sure the Natural Earth data for the vector fallback are available.
+
+    Parameters
+    ----------
+    iso3_list: list
+        ISO3 codes of the countries to seed.
+    zooms: iterable of int
+        Zoom levels to seed. Default: 3 up to 7, the levels choose_zoom picks
+        for maps between continental scale and the minimum impact map extent.
+    provider: dict
+        Tile provider. Default: BASEMAP_PROVIDER
+    tile_dir: str or Path
+        Tile cache directory. Default: BASEMAP_TILE_DIR
+    buffer_deg: float
+        Buffer in degrees around each country's bounding box.
+
+    Returns
+    -------
+    n_missing: int
+        Number of tiles that could not be downloaded.
+    """
+    provider = BASEMAP_PROVIDER if provider is None else provider
+    zooms = range(3, 8) if zooms is None else zooms
+
+    for feature in (cf.LAND, cf.COASTLINE, cf.BORDERS):
+        _ = list(feature.with_scale(VECTOR_SCALE).geometries())
+
+    countries = u_coord.get_country_geometries(country_names=list(iso3_list))
+    n_missing = 0
+    for iso3, geometry in zip(countries['ISO_A3'], countries.geometry):
+        west, east = _lon_range(geometry)
+        _, south, _, north = geometry.bounds
+        boxes = split_antimeridian((west - buffer_deg, south - buffer_deg, east + buffer_deg, north + buffer_deg))
+        for zoom in zooms:
+            tiles = {tile for bounds in boxes for tile in _bounds_tiles(bounds, zoom)}
+            print(f"Seeding {len(tiles)} tiles for {iso3} at zoom {zoom}")
+            for tile in tiles:
+                if get_tile(provider, tile.z, tile.x, tile.y, tile_dir, offline=False) is None:
+                    n_missing += 1
+
+    if n_missing > 0:
+        print(f"{n_missing} tiles could not be downloaded")
+    return n_missing
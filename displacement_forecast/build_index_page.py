@@ -4,73 +4,128 @@ warnings.filterwarnings("ignore")
 import os
 import glob
 import json
+import calendar
 import numpy as np
 import pandas as pd
 from pathlib import Path
-import subprocess
 import shutil
 from datetime import datetime, timedelta
 
 from climada import CONFIG
 
+from displacement_forecast.report_func import (
+    write_html, update_report_catalog, read_report_catalog, list_catalog_months,
+    read_catalog_meta, write_catalog_meta, REPORT_CATALOG_NAME
+)
+from displacement_forecast.build_performance_page import PERFORMANCE_PAGE_NAME
+
 
 WORKING_DIR = CONFIG.forecast_sandbox.dir.str()
+ARCHIVE_DIR = Path(WORKING_DIR, "archive")
+CATALOG_PATH = Path(ARCHIVE_DIR, REPORT_CATALOG_NAME)
 TEMPLATE_DIR = Path(Path(__file__).parent.parent, 'reporting_templates', 'home')
 
 
-def build_index_page():
+def build_index_page(time_str=None, html_renderer='markdown'):
+    """
+    Build the home page and the monthly forecast archive pages from the report catalog.
+
+    The home page lists the forecasts of the latest month and links to one
+    page per month. With time_str, only the page of that forecast's month is
+    rebuilt (with the home page), otherwise all monthly pages are.
+    """
     print("Building home page...")
     os.makedirs(WORKING_DIR, exist_ok=True)
 
-    forecast_dir_list = [p for p in os.listdir(WORKING_DIR) if os.path.isdir(Path(WORKING_DIR, p))]
-    forecast_dir_list = [p for p in forecast_dir_list if os.path.exists(Path(WORKING_DIR, p, 'report', 'report.md'))]
-    forecast_dir_list = [p for p in forecast_dir_list if os.path.exists(Path(WORKING_DIR, p, 'report', 'summary_stats.json'))]
-    results_dir_list = [Path(WORKING_DIR, p, 'report') for p in forecast_dir_list]
+    # build_report creates the catalog with its own report, so whether the
+    # older reports were added is recorded in the catalog, not told by its existence
+    if read_catalog_meta(CATALOG_PATH, 'backfilled') is None:
+        catalog_existing_reports()
 
-    summary_stats = pd.DataFrame(load_json(Path(p, 'summary_stats.json')) for p in results_dir_list)
-    summary_stats['url'] = [str(Path(p, 'report', 'report.html')) for p in forecast_dir_list]
-    summary_stats['link_markdown'] = [f'[{p["forecast_time"]}]({p["url"]})' for _, p in summary_stats.iterrows()]
-    summary_stats['storm_names_str'] = summary_stats['storm_names'].apply(lambda x: ', '.join(x))
+    months = list_catalog_months(CATALOG_PATH)
+    if time_str is not None:
+        months_to_build = [m for m in months if (m[0], m[1]) == (int(time_str[:4]), int(time_str[4:6]))]
+    else:
+        months_to_build = months
 
-    output_stats = pd.DataFrame({
-        'Forecast Time': summary_stats['link_markdown'],
-        'Number of Named Storms': summary_stats['number_active'],
-        'Storms': summary_stats['storm_names_str'],
-        'Number Affecting People': summary_stats['number_affecting_people'],
-        'Number Displacing People': summary_stats['number_displacing_people']
-    }).sort_values(by='Forecast Time', ascending=False)
-
-    index_file = Path(WORKING_DIR, 'home.md')
-    shutil.copy(Path(TEMPLATE_DIR, 'home.md'), index_file)
-
-    index_components = [index_file]
-
-    summary_file = Path(WORKING_DIR, 'summary_of_forecasts.md')
-    shutil.copy(Path(TEMPLATE_DIR, 'summary_of_forecasts.md'), summary_file)
-    with open(summary_file, "a") as f:
-        output_stats.to_markdown(f, index=False, tablefmt="github", floatfmt=".2f")
-    index_components.append(summary_file)
- 
-    # List of input files to combine
-    index_components = [str(f) for f in index_components]
-    output_file = Path(WORKING_DIR, 'index.md')
+    for year, month, _ in months_to_build:
+        build_month_page(year, month, html_renderer=html_renderer)
 
-    with open(output_file, 'w', encoding='utf-8') as outfile:
-        for fname in index_components:
-            with open(fname, 'r', encoding='utf-8') as infile:
-                outfile.write(infile.read())
-                outfile.write('\n')
+    with open(Path(TEMPLATE_DIR, 'home.md'), 'r', encoding='utf-8') as f:
+        index_md = f.read() + '\n'
+
+    with open(Path(TEMPLATE_DIR, 'summary_of_forecasts.md'), 'r', encoding='utf-8') as f:
+        index_md += f.read()
+
+    if len(months) > 0:
+        year, month, _ = months[0]
+        index_md += f"\n## Latest forecasts: {calendar.month_name[month]} {year}\n\n"
+        index_md += forecast_table_markdown(read_report_catalog(CATALOG_PATH, year=year, month=month))
+        index_md += "\n\n## All forecasts by month\n\n"
+        index_md += ''.join(
+            f"- [{calendar.month_name[m]} {y}]({make_month_page_filename(y, m, '.html')}) ({n} forecasts)\n"
+            for y, m, n in months
+        )
+
+    # the performance page is built on its own (see build_performance_page), not with every index
+    if os.path.exists(Path(WORKING_DIR, f"{PERFORMANCE_PAGE_NAME}.html")):
+        index_md += f"\n[Pipeline performance]({PERFORMANCE_PAGE_NAME}.html)\n"
+
+    output_file = Path(WORKING_DIR, 'index.md')
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write(index_md)
 
-    # Build the pandoc command
     output_html = Path(WORKING_DIR, 'index.html')
-    cmd = ['pandoc', output_file, '-o', output_html]
+    write_html(output_file, output_html, renderer=html_renderer, text=index_md)
+
+
+def build_month_page(year, month, html_renderer='markdown'):
+    """Build the archive page listing all forecasts of one month"""
+    with open(Path(TEMPLATE_DIR, 'summary_of_forecasts.md'), 'r', encoding='utf-8') as f:
+        month_md = f.read()
+    month_md += f"\n## {calendar.month_name[month]} {year}\n\n[Home](index.html)\n\n"
+    month_md += forecast_table_markdown(read_report_catalog(CATALOG_PATH, year=year, month=month))
+
+    output_file = Path(WORKING_DIR, make_month_page_filename(year, month, '.md'))
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write(month_md)
+    write_html(output_file, output_file.with_suffix('.html'), renderer=html_renderer, text=month_md)
 
-    # Run the command
-    subprocess.run(cmd, check=True)
 
-    # Remove intermediate files
-    for f in index_components:
-        os.remove(f)
+def make_month_page_filename(year, month, suffix):
+    return f"forecasts_{year:04d}_{month:02d}{suffix}"
+
+
+def forecast_table_markdown(catalog):
+    """Markdown table of catalog entries, newest first"""
+    output_stats = pd.DataFrame({
+        'Forecast Time': '[' + catalog['forecast_time'] + '](' + catalog['url'] + ')',
+        'Number of Named Storms': catalog['number_active'],
+        'Storms': catalog['storm_names'].apply(', '.join),
+        'Number Affecting People': catalog['number_affecting_people'],
+        'Number Displacing People': catalog['number_displacing_people']
+    })
+    return output_stats.to_markdown(index=False, tablefmt="github", floatfmt=".2f") + '\n'
+
+
+def catalog_existing_reports():
+    """
+    Add reports built before the catalog existed to the catalog, from their
+    summary_stats.json. Only needed once: build_report catalogs new reports.
+    Reports already in the catalog are left as they are.
+    """
+    print("Cataloguing existing reports...")
+    catalogued = set(read_report_catalog(CATALOG_PATH)['time_str'])
+    for p in sorted(os.listdir(WORKING_DIR)):
+        report_dir = Path(WORKING_DIR, p, 'report')
+        if not os.path.exists(Path(report_dir, 'report.md')):
+            continue
+        if not os.path.exists(Path(report_dir, 'summary_stats.json')):
+            continue
+        if p in catalogued:
+            continue
+        update_report_catalog(CATALOG_PATH, p, load_json(Path(report_dir, 'summary_stats.json')))
+    write_catalog_meta(CATALOG_PATH, 'backfilled', datetime.now().isoformat(timespec='seconds'))
 
 
 def load_json(path):
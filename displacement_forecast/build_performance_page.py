@@ -0,0 +1,127 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import os
+import pandas as pd
+from pathlib import Path
+
+from climada import CONFIG
+
+from displacement_forecast.metrics_func import collect_metrics, latest_stage_runs, find_outliers
+from displacement_forecast.manifest_func import PIPELINE_STAGES
+from displacement_forecast.plot_func import plot_stage_durations, plot_windfield_scaling, render_plot
+from displacement_forecast.report_func import write_html
+
+
+WORKING_DIR = CONFIG.forecast_sandbox.dir.str()
+PERFORMANCE_DIR = Path(WORKING_DIR, "performance")
+PERFORMANCE_PAGE_NAME = "performance"
+N_LATEST = 14
+
+
+def build_performance_page(html_renderer='markdown'):
+    """
+    Build a page of pipeline performance across all forecasts from the stage
+    metrics (see metrics_func): duration trends per stage, scaling of the wind
+    field calculation, the latest forecasts and the outlying runs.
+
+    Reading every forecast's metrics takes a while, so the page is not rebuilt
+    with every index page but by process_all_forecasts and
+    regenerate_all_reports, or by running this module.
+    """
+    print("Building performance page...")
+    os.makedirs(PERFORMANCE_DIR, exist_ok=True)
+    metrics = collect_metrics(WORKING_DIR)
+
+    page_md = "# Pipeline performance\n\n[Home](index.html)\n\n"
+    if len(metrics) == 0:
+        page_md += "No stage metrics have been recorded yet.\n"
+    else:
+        stage_runs = latest_stage_runs(metrics)
+        totals = stage_runs.groupby(['time_str', 'forecast_time'], as_index=False)[['wall_s', 'cpu_s']].sum()
+        stage_runs_and_totals = pd.concat([stage_runs, totals.assign(stage='total')], ignore_index=True)
+        stages = [s for s in PIPELINE_STAGES if s in set(stage_runs['stage'])]
+
+        page_md += f"Metrics of {stage_runs['time_str'].nunique()} forecasts.\n\n"
+
+        page_md += "## Stage durations\n\n"
+        page_md += stage_summary_markdown(stage_runs_and_totals, stages + ['total']) + "\n"
+        render_plot(plot_stage_durations, (stage_runs_and_totals, stages + ['total']),
+                    Path(PERFORMANCE_DIR, "stage_durations.png"))
+        page_md += "![Stage durations](performance/stage_durations.png)\n\n"
+
+        page_md += f"## Latest {N_LATEST} forecasts\n\nWall time in minutes.\n\n"
+        page_md += latest_forecasts_markdown(stage_runs_and_totals, stages + ['total']) + "\n"
+
+        wind_runs = operation_runs(metrics, 'from_tracks', ['members', 'centroids'])
+        if len(wind_runs) > 0:
+            page_md += "## Wind field scaling\n\n"
+            render_plot(plot_windfield_scaling, (wind_runs,), Path(PERFORMANCE_DIR, "windfield_scaling.png"))
+            page_md += "![Wind field scaling](performance/windfield_scaling.png)\n\n"
+
+        page_md += "## Outliers\n\nRuns much slower than usual for their stage.\n\n"
+        outliers = find_outliers(stage_runs_and_totals)
+        if len(outliers) == 0:
+            page_md += "None.\n"
+        else:
+            page_md += outliers_markdown(outliers) + "\n"
+
+    output_file = Path(WORKING_DIR, f"{PERFORMANCE_PAGE_NAME}.md")
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write(page_md)
+    write_html(output_file, output_file.with_suffix('.html'), renderer=html_renderer, text=page_md)
+
+
+def operation_runs(metrics, operation, info_columns):
+    """Successful runs of an inner operation with the given info values as columns"""
+    runs = metrics[(metrics['operation'] == operation) & (metrics['status'] == 'ok')].reset_index(drop=True)
+    for col in info_columns:
+        runs[col] = runs['info'].apply(lambda info: info.get(col))
+    return runs.dropna(subset=info_columns)
+
+
+def stage_summary_markdown(stage_runs, stages):
+    """Markdown table of wall time statistics and peak memory per stage"""
+    grouped = stage_runs.groupby('stage')
+    summary = pd.DataFrame({
+        'Forecasts': grouped['wall_s'].count(),
+        'Median (min)': grouped['wall_s'].median() / 60,
+        '90th percentile (min)': grouped['wall_s'].quantile(0.9) / 60,
+        'Max (min)': grouped['wall_s'].max() / 60,
+        'Median peak memory (MB)': grouped['peak_rss_mb'].median(),
+    }).reindex(stages)
+    summary.index.name = 'Stage'
+    return summary.reset_index().to_markdown(index=False, tablefmt="github", floatfmt=".1f") + '\n'
+
+
+def latest_forecasts_markdown(stage_runs, stages):
+    """Markdown table of the wall time of each stage of the latest forecasts, newest first"""
+    latest = sorted(stage_runs['time_str'].unique())[-N_LATEST:][::-1]
+    table = (stage_runs[stage_runs['time_str'].isin(latest)]
+             .pivot_table(index='time_str', columns='stage', values='wall_s', aggfunc='sum')
+             .reindex(index=latest, columns=stages) / 60)
+    table.index = [f"[{t}]({Path(t, 'report', 'report.html')})" for t in table.index]
+    table.index.name = 'Forecast'
+    return table.reset_index().to_markdown(index=False, tablefmt="github", floatfmt=".1f") + '\n'
+
+
+def outliers_markdown(outliers):
+    """Markdown table of outlying stage runs"""
+    table = pd.DataFrame({
+        'Forecast': [f"[{t}]({Path(t, 'report', 'report.html')})" for t in outliers['time_str']],
+        'Stage': outliers['stage'].values,
+        'Wall time (min)': outliers['wall_s'].values / 60,
+        'Stage median (min)': outliers['median_wall_s'].values / 60,
+        'Times median': outliers['ratio'].values,
+        'Peak memory (MB)': outliers['peak_rss_mb'].values,
+        'Counts': [
+            ', '.join(f"{k}: {v}" for k, v in info.items() if isinstance(v, (int, float)) and not isinstance(v, bool))
+            if isinstance(info, dict) else ''
+            for info in outliers['info']
+        ],
+    })
+    return table.to_markdown(index=False, tablefmt="github", floatfmt=".1f") + '\n'
+
+
+if __name__ == "__main__":
+    build_performance_page()
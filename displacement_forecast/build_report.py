@@ -7,7 +7,6 @@ import json
 import numpy as np
 import pandas as pd
 from pathlib import Path
-import subprocess
 import shutil
 import pycountry
 from datetime import datetime, timedelta
@@ -17,17 +16,27 @@ from climada.util.coordinates import get_country_code, country_to_iso
 
 from displacement_forecast.impact_calc_func import (
     round_to_previous_12h_utc, get_forecast_times,
-    summarize_forecast
+    summarize_forecast, list_impacts
     )
 from displacement_forecast.plot_func import (
     make_save_map_file_name, make_save_histogram_file_name
 )
+from displacement_forecast.hazard_func import list_wind_field_files
+from displacement_forecast.manifest_func import write_stage_manifest
+from displacement_forecast.metrics_func import instrument_stage, add_info
+from displacement_forecast.report_func import (
+    report_section, write_report, write_html, add_report_asset,
+    update_report_catalog, REPORT_CATALOG_NAME
+)
 
 WORKING_DIR = CONFIG.forecast_sandbox.dir.str()
+ARCHIVE_DIR = Path(WORKING_DIR, "archive")
+ASSET_STORE_DIR = Path(WORKING_DIR, "assets")
 TEMPLATE_DIR = Path(Path(__file__).parent.parent, 'reporting_templates', 'report')
 
 
-def build_report(time_str, overwrite=False):
+@instrument_stage('build_report')
+def build_report(time_str, overwrite=False, html_renderer='markdown', asset_mode='hardlink'):
 
     # Plotting directories
     FORECAST_DIR = Path(WORKING_DIR, time_str)
@@ -46,18 +55,18 @@ def build_report(time_str, overwrite=False):
 
     if os.path.exists(Path(REPORT_DIR, 'report.md')) and not overwrite:
         print(f"Report for forecast {time_str} already built, skipping.")
+        add_info(skipped=True)
         return
 
     report_file = Path(REPORT_DIR, 'report.md')
-    shutil.copy(Path(TEMPLATE_DIR, 'index.md'), report_file)
-    find_replace = {}
+    sections = [report_section('index.md')]
 
     # load data
     forecast_time = datetime.strptime(time_str, '%Y%m%d%H0000')
     forecast_time_str = forecast_time.strftime('%Y-%m-%d %H:%M UTC')
-    tc_wind_files = os.listdir(WIND_DIR)
-    find_replace['XX_date_XX'] = forecast_time_str
-    find_replace['XX_number_active_XX'] = str(len(tc_wind_files))
+    tc_wind_files = list_wind_field_files(WIND_DIR)
+    impact_list = list_impacts(IMPACT_DIR)
+    add_info(storms=len(tc_wind_files), impacts=len(impact_list))
 
     summary_stats['forecast_time'] = forecast_time_str
     summary_stats['number_active'] = len(tc_wind_files)
@@ -68,13 +77,14 @@ def build_report(time_str, overwrite=False):
     summary_stats['storms_displacing_people'] = set()
 
     print("Adding overview")
-    overview_file = Path(TEMPLATE_DIR, 'tracks_overview.md')
-    append_file(report_file, overview_file)
-
     track_plot_filename = f"ECMWF_TC_tracks_{time_str}.png"
     track_plot_path = Path(TRACK_ANALYSIS_DIR, track_plot_filename)
-    shutil.copy(track_plot_path, Path(REPORT_DIR, track_plot_filename))
-    find_replace['XX_tracks_plot_XX'] = track_plot_filename
+    add_report_asset(track_plot_path, Path(REPORT_DIR, track_plot_filename), asset_mode, ASSET_STORE_DIR)
+    sections.append(report_section(
+        'tracks_overview.md',
+        date=forecast_time_str,
+        number_active=str(len(tc_wind_files)),
+        tracks_plot=track_plot_filename))
 
     # This section was for the interactive map plot. Not using that for now, going static instead.
 
@@ -102,22 +112,17 @@ def build_report(time_str, overwrite=False):
         # extract the tc_name from the hdf file
         tc_base_file_name = os.path.basename(tc_file)
         tc_name = tc_base_file_name.split('_')[2]
-        find_replace['XX_name_XX'] = tc_name
         summary_stats['storm_names'].append(tc_name)
 
-        impact_files = os.listdir(IMPACT_DIR)
-        impact_files = [f for f in impact_files if f.startswith(tc_name)]
-        country_code_all = [f.split('_')[1] for f in impact_files]
+        country_code_all = impact_list.loc[impact_list['tc_name'] == tc_name, 'country_iso3']
         country_code_unique = np.unique(country_code_all)
         forecast_time = datetime.strptime(time_str, '%Y%m%d%H0000')
         formatted_datetime = forecast_time.strftime('%Y-%m-%d_%HUTC')
 
         if len(country_code_unique) == 0:
             print(f"No affected countries found for storm {tc_name}.")
-            append_file(report_file, Path(TEMPLATE_DIR, 'exposed_none.md'))
-            append_file(report_file, Path(TEMPLATE_DIR, 'displaced_none.md'))
-            find_replace['XX_country_XX'] = "All countries"
-            find_replace_in_file(report_file, find_replace)
+            sections.append(report_section('exposed_none.md', name=tc_name, country="All countries"))
+            sections.append(report_section('displaced_none.md', name=tc_name, country="All countries"))
             continue
 
         for country_code in country_code_unique:
@@ -131,7 +136,7 @@ def build_report(time_str, overwrite=False):
                 continue
 
             country_name = country_data.name
-            find_replace['XX_country_XX'] = country_name
+            storm_context = {'name': tc_name, 'country': country_name}
 
             storm_dict = {
                 "eventName": tc_name,
@@ -142,13 +147,12 @@ def build_report(time_str, overwrite=False):
             storm_dict["impactType"] = "cat1"
             cat1_map_filename = make_save_map_file_name(storm_dict)
             cat1_map_path = Path(IMPACT_ANALYSIS_DIR, cat1_map_filename)
-            find_replace['XX_cat1_map_path_XX'] = cat1_map_filename
 
             if os.path.exists(cat1_map_path):
                 print("processing " + str(cat1_map_path))
-                append_file(report_file, Path(TEMPLATE_DIR, 'affected_by_cat1.md'))
-                find_replace_in_file(report_file, find_replace)
-                shutil.copy(cat1_map_path, Path(REPORT_DIR, cat1_map_filename))
+                sections.append(report_section(
+                    'affected_by_cat1.md', **storm_context, cat1_map_path=cat1_map_filename))
+                add_report_asset(cat1_map_path, Path(REPORT_DIR, cat1_map_filename), asset_mode, ASSET_STORE_DIR)
             else:
                 print("No map of cat 1 affected areas found at " + str(cat1_map_filename))
                 continue
@@ -156,13 +160,12 @@ def build_report(time_str, overwrite=False):
             storm_dict["impactType"] = "cat3"
             cat3_map_filename = make_save_map_file_name(storm_dict)
             cat3_map_path = Path(IMPACT_ANALYSIS_DIR, cat3_map_filename)
-            find_replace['XX_cat3_map_path_XX'] = cat3_map_filename
 
             if os.path.exists(cat3_map_path):
                 print("processing " + str(cat3_map_path))
-                append_file(report_file, Path(TEMPLATE_DIR, 'affected_by_cat3.md'))
-                find_replace_in_file(report_file, find_replace)
-                shutil.copy(cat3_map_path, Path(REPORT_DIR, cat3_map_filename))
+                sections.append(report_section(
+                    'affected_by_cat3.md', **storm_context, cat3_map_path=cat3_map_filename))
+                add_report_asset(cat3_map_path, Path(REPORT_DIR, cat3_map_filename), asset_mode, ASSET_STORE_DIR)
             else:
                 print("No map of cat 3 affected areas found at " + str(cat1_map_filename))
 
@@ -171,15 +174,15 @@ def build_report(time_str, overwrite=False):
             exposed_hist_filename = make_save_histogram_file_name(storm_dict)
             exposed_map_path = Path(IMPACT_ANALYSIS_DIR, exposed_map_filename)
             exposed_hist_path = Path(IMPACT_ANALYSIS_DIR, exposed_hist_filename)
-            find_replace['XX_exposed_map_path_XX'] = exposed_map_filename
-            find_replace['XX_exposed_hist_path_XX'] = exposed_hist_filename
 
             if os.path.exists(exposed_map_path):
                 print("processing " + str(exposed_map_path))
-                append_file(report_file, Path(TEMPLATE_DIR, 'exposed.md'))
-                find_replace_in_file(report_file, find_replace)
-                shutil.copy(exposed_map_path, Path(REPORT_DIR, exposed_map_filename))
-                shutil.copy(exposed_hist_path, Path(REPORT_DIR, exposed_hist_filename))
+                sections.append(report_section(
+                    'exposed.md', **storm_context,
+                    exposed_map_path=exposed_map_filename,
+                    exposed_hist_path=exposed_hist_filename))
+                add_report_asset(exposed_map_path, Path(REPORT_DIR, exposed_map_filename), asset_mode, ASSET_STORE_DIR)
+                add_report_asset(exposed_hist_path, Path(REPORT_DIR, exposed_hist_filename), asset_mode, ASSET_STORE_DIR)
                 summary_stats['storms_affecting_people'].add(tc_name)
             else:
                 print("No exposed population found at " + str(exposed_map_path))
@@ -190,19 +193,19 @@ def build_report(time_str, overwrite=False):
             displacement_hist_filename = make_save_histogram_file_name(storm_dict)
             displacement_map_path = Path(IMPACT_ANALYSIS_DIR, displacement_map_filename)
             displacement_hist_path = Path(IMPACT_ANALYSIS_DIR, displacement_hist_filename)
-            find_replace['XX_displacement_map_path_XX'] = displacement_map_filename
-            find_replace['XX_displacement_hist_path_XX'] = displacement_hist_filename
 
             if os.path.exists(displacement_map_path):
                 print("processing " + str(displacement_map_path))
-                append_file(report_file, Path(TEMPLATE_DIR, 'displaced.md'))
-                find_replace_in_file(report_file, find_replace)
-                shutil.copy(displacement_map_path, Path(REPORT_DIR, displacement_map_filename))
-                shutil.copy(displacement_hist_path, Path(REPORT_DIR, displacement_hist_filename))
+                sections.append(report_section(
+                    'displaced.md', **storm_context,
+                    displacement_map_path=displacement_map_filename,
+                    displacement_hist_path=displacement_hist_filename))
+                add_report_asset(displacement_map_path, Path(REPORT_DIR, displacement_map_filename), asset_mode, ASSET_STORE_DIR)
+                add_report_asset(displacement_hist_path, Path(REPORT_DIR, displacement_hist_filename), asset_mode, ASSET_STORE_DIR)
                 summary_stats['storms_displacing_people'].add(tc_name)
             else:
                 print("No displaced population found at " + str(displacement_map_path))
-                append_file(report_file, Path(TEMPLATE_DIR, 'displaced_none.md'))
+                sections.append(report_section('displaced_none.md', **storm_context))
 
     summary_stats['storms_affecting_people'] = list(summary_stats['storms_affecting_people'])
     summary_stats['storms_displacing_people'] = list(summary_stats['storms_displacing_people'])
@@ -211,32 +214,13 @@ def build_report(time_str, overwrite=False):
     json.dump(summary_stats, open(Path(REPORT_DIR, 'summary_stats.json'), 'w', encoding='utf-8'))
 
     print("Combining report components")
-    find_replace_in_file(report_file, find_replace)
+    report_md = write_report(report_file, sections, TEMPLATE_DIR)
 
-    # Build the pandoc command
-    # cmd = ['pandoc', *report_components, '-o', output_file]
-
-    # Build the pandoc command
     report_html = Path(REPORT_DIR, 'report.html')
-    cmd = ['pandoc', report_file, '-o', report_html]
-
-    # Run the command
-    subprocess.run(cmd, check=True)
-
-
-def find_replace_in_file(file_path, find_replace_dict):
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
-
-    for key, value in find_replace_dict.items():
-        content = content.replace(key, value)
+    write_html(report_file, report_html, renderer=html_renderer, text=report_md)
 
-    with open(file_path, 'w', encoding='utf-8') as file:
-        file.write(content)
+    # the report is complete: list it in the catalog the index pages are built from
+    update_report_catalog(Path(ARCHIVE_DIR, REPORT_CATALOG_NAME), time_str, summary_stats)
 
+    write_stage_manifest(FORECAST_DIR, 'build_report', expected={'storms': summary_stats['storm_names']})
 
-def append_file(file1, file2):
-    with open(file1, 'a') as f1:
-        with open(file2, 'r') as f2:
-            shutil.copyfileobj(f2, f1)
-            f1.write('\n')
\ No newline at end of file
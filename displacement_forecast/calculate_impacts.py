@@ -19,6 +19,7 @@ import pandas as pd
 import geopandas as gpd
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from geopandas import GeoDataFrame, points_from_xy
 
 from climada import CONFIG
@@ -35,15 +36,39 @@ from displacement_forecast.impact_calc_func import (
     round_to_previous_12h_utc, get_forecast_times,
     summarize_forecast,
     save_forecast_summary, save_average_impact_geospatial_points,
-    save_impact_at_event
+    save_impact_at_event,
+    compact_impact, write_compact_impacts, list_impacts, remove_impacts, impact_keys,
+    COMPACT_IMPACT_SUFFIX, IMPACT_FILE_SUFFIXES
     )
+from displacement_forecast.manifest_func import write_stage_manifest
+from displacement_forecast.metrics_func import instrument_stage, timed, add_info
+from displacement_forecast.hazard_func import (
+    exceedance_impact, list_wind_field_files,
+    get_wind_field_format, read_wind_field, read_wind_field_regions, exposure_bounds
+)
 
 
 WORKING_DIR = CONFIG.forecast_sandbox.dir.str()
 EXPOSED_TO_WIND_THRESHOLD = 32.92 # threshold for people exposed to wind in m/s   # TODO move this to the config
 
 
-def calculate_impacts(time_str=None, overwrite=False):
+@instrument_stage('calculate_impacts')
+def calculate_impacts(time_str=None, overwrite=False, n_workers=1, compact=True, top_k=None):
+    """
+    Calculate impacts for every storm and affected country in a forecast.
+
+    By default the impacts of each storm, for all countries and impact types,
+    are saved in one compact file <tc_name>_impacts.h5 holding at_event per
+    member and the ensemble mean eai_exp with coordinates, plus the imp_mat
+    rows of the top_k members if requested. With compact=False one full
+    Impact file is written per country and impact type instead.
+
+    With n_workers > 1 the countries of each storm are processed in a pool
+    of worker processes. Each worker opens the wind field itself, so with
+    the 'memmap' wind field format all workers share one copy of the hazard
+    in the page cache, and with the 'tiled' format each reads only its
+    country's tiles.
+    """
     FORECAST_DIR = Path(WORKING_DIR, time_str)
     WIND_DIR = Path(FORECAST_DIR, "wind_fields")
     IMPACT_DIR = Path(FORECAST_DIR, "impacts")
@@ -56,11 +81,16 @@ def calculate_impacts(time_str=None, overwrite=False):
 
     if len(os.listdir(IMPACT_DIR)) > 0 and not overwrite:
         print(f"Impacts for forecast {time_str} already computed, skipping.")
+        add_info(skipped=True)
         return
+    # files of both layouts from an earlier run would otherwise be listed next to the new ones
+    remove_impacts(IMPACT_DIR)
 
-    tc_wind_files = os.listdir(WIND_DIR)
+    tc_wind_files = list_wind_field_files(WIND_DIR)
     if len(tc_wind_files) == 0:
         print(f"No TC activities found at {time_str}. No impacts to calculate.")
+    add_info(storms=len(tc_wind_files))
+    n_countries = 0
 
     # Start the impact calculations for all the storms
     for tc_file in tc_wind_files:
@@ -70,86 +100,134 @@ def calculate_impacts(time_str=None, overwrite=False):
         tc_name = tc_base_file_name.split('_')[2]
         print(f"Calculating impacts for storm {tc_name}...")
 
-        # read the hdf file
-        tc_haz = Hazard.from_hdf5(Path(WIND_DIR, tc_file))
- 
-        # get the country code where the wind speed >0
-        idx_non_zero_wind = tc_haz.intensity.max(axis=0).nonzero()[1]
-        country_code_all = get_country_code(
-                                tc_haz.centroids.lat[idx_non_zero_wind], 
-                                tc_haz.centroids.lon[idx_non_zero_wind]
-                            )
-        country_code_unique = np.trim_zeros(np.unique(country_code_all))
-
-        # generate a flat exposure from the hazard, to be used to show affected areas
-        flat_gdf = gpd.GeoDataFrame({
-            'lat': tc_haz.centroids.lat[idx_non_zero_wind],
-            'lon': tc_haz.centroids.lon[idx_non_zero_wind],
-            'value': 1,
-            'impf_TC': 1,
-            'region_id': country_code_all
-        })
-        flat_gdf['geometry'] = points_from_xy(x=flat_gdf['lon'], y=flat_gdf['lat'], crs=DEF_CRS)
-
-        flat_exposure_all = Exposures(
-            data=flat_gdf,
-            value_unit="unitless"
-        )
+        # get the country codes where the wind speed >0. Wind fields that support
+        # partial reads are opened per country, the others are read once here
+        wind_path = Path(WIND_DIR, tc_file)
+        partial_read = get_wind_field_format(wind_path) in ['tiled', 'memmap']
+        if partial_read:
+            tc_haz, centroid_region_id = None, None
+            country_code_unique = read_wind_field_regions(wind_path)
+        else:
+            tc_haz, centroid_region_id = read_wind_field(wind_path)
+            country_code_unique = np.trim_zeros(np.unique(centroid_region_id))
+        n_countries += len(country_code_unique)
+        add_info(countries=n_countries)
 
         # now run impact for each country
-        for country_code in country_code_unique:
-            country_iso3 = country_to_iso(country_code, "alpha3")
-            print(f"   ...{country_iso3}")
-
-            # Calculate areas affected by cat 1 and cat 3
-            impf_cat1 = impf_set_exposed_pop(threshold = 32.92) # Hurricane winds
-            impf_cat3 = impf_set_exposed_pop(threshold = 50) # Cat 3 winds
-
-            exp_flat = Exposures(
-                data=flat_exposure_all.gdf[flat_exposure_all.gdf['region_id'] == country_code],
-                value_unit="unitless"
-            )
-            assert exp_flat.gdf.shape[0] > 0
-
-            impact_cat1 = ImpactCalc(exp_flat, impf_cat1, tc_haz).impact()
-            if impact_cat1.aai_agg == 0.: # do not save the files if impact is 0.
-                print(f"No land affected by Cat 1 winds for country {country_code} with storm {tc_name}.")
-                continue
-            else:
-                impact_cat1.write_hdf5(Path(IMPACT_DIR, f"{tc_name}_{country_iso3}_cat1_affected.h5"))
-
-            impact_cat3 = ImpactCalc(exp_flat, impf_cat3, tc_haz).impact()
-            if impact_cat3.aai_agg == 0.:
-                print(f"No land affected by Cat 3 winds for country {country_code} with storm {tc_name}.")
-            else:
-                impact_cat3.write_hdf5(Path(IMPACT_DIR, f"{tc_name}_{country_iso3}_cat3_affected.h5"))
-
-            try:
-                exp = client.get_exposures(
-                    exposures_type='litpop',
-                    properties={'country_iso3num':[str(country_code).zfill(3)],
-                                'exponents':'(0,1)',
-                                'fin_mode':'pop',
-                                'version':'v2'
-                                }
-                    )
-            except client.NoResult:
-                print(f"there is no matching dataset in Data API. Country code: {country_code}. Skipping this calculation")
-                continue
-
-            # run impact calc for people exposed to cat. 1 wind speed or above
-            impf_exposed = impf_set_exposed_pop(threshold=EXPOSED_TO_WIND_THRESHOLD)
-            impact_exposed = ImpactCalc(exp, impf_exposed, tc_haz).impact()
-            if impact_exposed.aai_agg == 0.: # do not save the files if impact is 0.
-                print(f"No exposed population for country {country_code} with storm {tc_name}.")
-                continue
-            else:
-                impact_exposed.write_hdf5(Path(IMPACT_DIR, f"{tc_name}_{country_iso3}_exposed_population.h5"))
-
-            # run the same impact calc but for displacement
-            impf_displacement = impf_set_displacement(country_iso3)
-            impact_displacement = ImpactCalc(exp, impf_displacement, tc_haz).impact()
-            if impact_displacement.aai_agg == 0.: # do not save the files if impact is 0.
-                print(f"No displaced population for country {country_code} with storm {tc_name}.")
-            else:
-                impact_displacement.write_hdf5(Path(IMPACT_DIR, f"{tc_name}_{country_iso3}_displaced_population.h5"))
+        compact_impacts = {}
+        if n_workers > 1 and partial_read:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                futures = [
+                    pool.submit(calculate_country_impacts, tc_name, country_code, IMPACT_DIR, wind_path,
+                                compact=compact, top_k=top_k)
+                    for country_code in country_code_unique
+                ]
+                for future in futures:
+                    compact_impacts.update(future.result())
+        else:
+            for country_code in country_code_unique:
+                compact_impacts.update(calculate_country_impacts(
+                    tc_name, country_code, IMPACT_DIR, wind_path, tc_haz, centroid_region_id,
+                    compact=compact, top_k=top_k
+                ))
+
+        if len(compact_impacts) > 0:
+            write_compact_impacts(Path(IMPACT_DIR, f"{tc_name}{COMPACT_IMPACT_SUFFIX}"), compact_impacts)
+
+    write_stage_manifest(FORECAST_DIR, 'calculate_impacts', expected={
+        'storms': [os.path.basename(f).split('_')[2] for f in tc_wind_files],
+        'impacts': impact_keys(list_impacts(IMPACT_DIR))
+    })
+
+
+def calculate_country_impacts(tc_name, country_code, impact_dir, wind_path,
+                              tc_haz=None, centroid_region_id=None,
+                              compact=True, top_k=None):
+    """
+    Calculate the impacts of one storm on one country.
+
+    The wind field is read from wind_path, for this country only where the
+    format allows, unless an already loaded hazard is passed as tc_haz with
+    the country code of each of its centroids. With a partial read, the
+    impacts on the exposures are calculated on the tiles around the
+    exposure points, so that every point is assigned the same centroid as
+    with the full wind field.
+
+    Returns a dict mapping (country_iso3, impact_type) to compact impacts for
+    the caller to save. With compact=False the full Impacts are saved here
+    and the dict is empty.
+    """
+    country_iso3 = country_to_iso(country_code, "alpha3")
+    print(f"   ...{country_iso3}")
+    compact_impacts = {}
+
+    def save_impact(impact, impact_type):
+        if compact:
+            compact_impacts[(country_iso3, impact_type)] = compact_impact(impact, top_k)
+        else:
+            impact.write_hdf5(Path(impact_dir, f"{tc_name}_{country_iso3}_{IMPACT_FILE_SUFFIXES[impact_type]}.h5"))
+
+    partial_read = tc_haz is None
+    if partial_read:
+        tc_haz, centroid_region_id = read_wind_field(wind_path, region_id=country_code)
+
+    # Calculate areas affected by cat 1 and cat 3 on a flat exposure at the
+    # country's centroids, straight from the sparse intensity matrix
+    idx_country = np.flatnonzero(centroid_region_id == country_code)
+    assert idx_country.size > 0
+
+    impact_cat1 = exceedance_impact(tc_haz, idx_country, threshold=32.92) # Hurricane winds
+    if impact_cat1.aai_agg == 0.: # do not save the files if impact is 0.
+        print(f"No land affected by Cat 1 winds for country {country_code} with storm {tc_name}.")
+        return compact_impacts
+    else:
+        save_impact(impact_cat1, "cat1")
+
+    impact_cat3 = exceedance_impact(tc_haz, idx_country, threshold=50) # Cat 3 winds
+    if impact_cat3.aai_agg == 0.:
+        print(f"No land affected by Cat 3 winds for country {country_code} with storm {tc_name}.")
+    else:
+        save_impact(impact_cat3, "cat3")
+
+    try:
+        with timed('get_exposures', country=country_iso3):
+            exp = client.get_exposures(
+                exposures_type='litpop',
+                properties={'country_iso3num':[str(country_code).zfill(3)],
+                            'exponents':'(0,1)',
+                            'fin_mode':'pop',
+                            'version':'v2'
+                            }
+                )
+            add_info(points=exp.gdf.shape[0])
+    except client.NoResult:
+        print(f"there is no matching dataset in Data API. Country code: {country_code}. Skipping this calculation")
+        return compact_impacts
+
+    if partial_read:
+        # the country's windy tiles can miss the centroids nearest to its exposure points
+        tc_haz, _ = read_wind_field(wind_path, bounds=exposure_bounds(exp.gdf.geometry.y.values,
+                                                                      exp.gdf.geometry.x.values))
+
+    # run impact calc for people exposed to cat. 1 wind speed or above
+    impf_exposed = impf_set_exposed_pop(threshold=EXPOSED_TO_WIND_THRESHOLD)
+    with timed('impact_calc', storm=tc_name, country=country_iso3, impact_type='exposed',
+               points=exp.gdf.shape[0], members=tc_haz.size):
+        impact_exposed = ImpactCalc(exp, impf_exposed, tc_haz).impact()
+    if impact_exposed.aai_agg == 0.: # do not save the files if impact is 0.
+        print(f"No exposed population for country {country_code} with storm {tc_name}.")
+        return compact_impacts
+    else:
+        save_impact(impact_exposed, "exposed")
+
+    # run the same impact calc but for displacement
+    impf_displacement = impf_set_displacement(country_iso3)
+    with timed('impact_calc', storm=tc_name, country=country_iso3, impact_type='displaced',
+               points=exp.gdf.shape[0], members=tc_haz.size):
+        impact_displacement = ImpactCalc(exp, impf_displacement, tc_haz).impact()
+    if impact_displacement.aai_agg == 0.: # do not save the files if impact is 0.
+        print(f"No displaced population for country {country_code} with storm {tc_name}.")
+    else:
+        save_impact(impact_displacement, "displaced")
+
+    return compact_impacts
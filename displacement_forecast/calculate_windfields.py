@@ -17,19 +17,38 @@ import warnings
 warnings.filterwarnings("ignore")
 
 from climada import CONFIG
-from climada.hazard import TropCyclone
+from scipy import sparse
+from climada.hazard import TropCyclone, TCTracks
 from climada_petals.hazard import TCForecast
 from climada.util.api_client import Client
 client = Client()
 
 from displacement_forecast.tc_tracks_func import filter_storm, _correct_max_sustained_wind_speed
 from displacement_forecast.download_tracks import get_forecast_tracks
+from displacement_forecast.hazard_func import (
+    WIND_FILE_PREFIX, ARRIVAL_FILE_PREFIX,
+    windfield_arrival_time, write_arrival_times, write_wind_field
+)
+from displacement_forecast.manifest_func import write_stage_manifest
+from displacement_forecast.metrics_func import instrument_stage, timed, add_info
 
 WORKING_DIR = CONFIG.forecast_sandbox.dir.str()
 N_ENSEMBLE = 51
 
 
-def calculate_windfields(time_str, overwrite=False):
+@instrument_stage('calculate_windfields')
+def calculate_windfields(time_str, overwrite=False, arrival_threshold=None, wind_format='tiled'):
+    """
+    Compute the wind fields of all named storms in a forecast.
+
+    Wind fields are saved in wind_format, one of hazard_func.WIND_FIELD_FORMATS.
+    The default 'tiled' format lets later stages read one country at a time;
+    'memmap' lets parallel workers share one in-memory copy of the hazard.
+
+    If arrival_threshold (m/s) is given, the lead time at which each member
+    first brings winds of that strength to each centroid is recorded in the
+    same pass and saved next to the hazard file.
+    """
 
     time_start = time.time()
 
@@ -42,6 +61,7 @@ def calculate_windfields(time_str, overwrite=False):
 
     if len(os.listdir(WIND_DIR)) > 0 and not overwrite:
         print(f"Wind fields for forecast {time_str} already computed, skipping.")
+        add_info(skipped=True)
         return
 
     # retrieve the forecast (already downloaded)
@@ -51,6 +71,7 @@ def calculate_windfields(time_str, overwrite=False):
 
     if len(tr_filter.data) != 0:
         tr_name_unique = set([tr.name for tr in tr_filter.data])
+        add_info(storms=len(tr_name_unique), members=len(tr_filter.data))
 
         # retrieve the Centroids
         glob_centroids = client.get_centroids()
@@ -66,16 +87,66 @@ def calculate_windfields(time_str, overwrite=False):
             centroids_refine = glob_centroids.select(extent=storm_extent)
 
             # compute the windfield for each storm
-            tc_wind_one_storm = TropCyclone.from_tracks(tr_one_storm, centroids_refine,
-                                                        model="H1980")
+            with timed('from_tracks', storm=tr_name, members=len(tr_one_storm.data),
+                       centroids=centroids_refine.size):
+                if arrival_threshold is None:
+                    tc_wind_one_storm = TropCyclone.from_tracks(tr_one_storm, centroids_refine,
+                                                                model="H1980")
+                else:
+                    tc_wind_one_storm, arrival = windfields_with_arrival_time(
+                        tr_one_storm, centroids_refine, forecast_time, arrival_threshold
+                    )
+            if arrival_threshold is not None:
+                write_arrival_times(
+                    Path(WIND_DIR, f'{ARRIVAL_FILE_PREFIX}{tr_name}_{time_str}.hdf5'),
+                    arrival,
+                    tc_wind_one_storm.event_id,
+                    arrival_threshold,
+                    time_str
+                )
             tc_wind_one_storm.frequency = np.ones(len(tc_wind_one_storm.event_id))/N_ENSEMBLE
-            tc_wind_one_storm.write_hdf5(Path(WIND_DIR, f'tc_wind_{tr_name}_{time_str}.hdf5'))
+            with timed('write_wind_field', storm=tr_name, wind_format=wind_format):
+                write_wind_field(
+                    Path(WIND_DIR, f'{WIND_FILE_PREFIX}{tr_name}_{time_str}'),
+                    tc_wind_one_storm,
+                    wind_format
+                )
     else:
         print(f"There is no active storm forecasted at {formatted_datetime}")
 
+    write_stage_manifest(FORECAST_DIR, 'calculate_windfields', expected={'storms': {tr.name for tr in tr_filter.data}})
+
     # record the time
     time_end = time.time()
 
     print("TC wind computation complete. Time: " +str(time_end-time_start))
 
 
+def windfields_with_arrival_time(tr_one_storm, centroids, forecast_time, threshold):
+    """
+    Compute a storm's wind fields and the first arrival of threshold winds in one pass.
+
+    Each ensemble member is modelled separately with its full wind fields kept
+    just long enough to find, per centroid, the first track position reaching
+    the threshold. Only the per-event maximum is retained in the hazard, so
+    peak memory is one member's wind fields rather than the whole ensemble's.
+
+    Returns
+    -------
+    tc_wind_one_storm : climada.hazard.TropCyclone
+        The storm's hazard, identical to TropCyclone.from_tracks on all members.
+    arrival : scipy.sparse.csr_matrix
+        Arrival lead times in hours, shape (n_events, n_centroids).
+    """
+    forecast_time = np.datetime64(forecast_time)
+    tc_members = []
+    arrival_members = []
+    for track in tr_one_storm.data:
+        tc_member = TropCyclone.from_tracks(TCTracks(data=[track]), centroids,
+                                            model="H1980", store_windfields=True)
+        lead_hours = (track.time.values - forecast_time) / np.timedelta64(1, 'h')
+        arrival_members.append(windfield_arrival_time(tc_member.windfields[0], lead_hours, threshold))
+        tc_member.windfields = []
+        tc_members.append(tc_member)
+
+    return TropCyclone.concat(tc_members), sparse.vstack(arrival_members, format='csr')
@@ -11,6 +11,8 @@ from climada_petals.hazard import TCForecast
 from climada.util.api_client import Client
 
 from displacement_forecast.tc_tracks_func import filter_storm, _correct_max_sustained_wind_speed
+from displacement_forecast.manifest_func import write_stage_manifest, read_stage_manifest
+from displacement_forecast.metrics_func import instrument_stage, timed, add_info
 
 client = Client()
 ECMWF_FTP = CONFIG.hazard.tc_tracks_forecast.resources.ecmwf
@@ -37,6 +39,10 @@ def get_forecast_tracks(time_str):
 
 
 def count_named_storms(time_str):
+    return len(list_named_storms(time_str))
+
+
+def list_named_storms(time_str):
     FORECAST_DIR = Path(WORKING_DIR, time_str)
     BUFR_DIR = Path(FORECAST_DIR, "bufr")
     downloaded_files = [f for f in os.listdir(BUFR_DIR) if os.path.getsize(os.path.join(BUFR_DIR, f)) > 1024]
@@ -44,13 +50,18 @@ def count_named_storms(time_str):
         raise FileNotFoundError(f"No BUFR files found in {BUFR_DIR}. Please download the forecast first.")
     storm_ids = [s.split('_')[8] for s in downloaded_files]
     named_storms = [s for s in storm_ids if not s[0].isdigit()]
-    return len(named_storms)
+    return named_storms
 
 
+@instrument_stage('download_tracks')
 def download_and_process_forecast(time_str, overwrite=False):
     download_forecast(time_str, overwrite=overwrite)
     process_bufr(time_str, overwrite=overwrite)
 
+    FORECAST_DIR = Path(WORKING_DIR, time_str)
+    if overwrite or read_stage_manifest(FORECAST_DIR, 'download_tracks') is None:
+        write_stage_manifest(FORECAST_DIR, 'download_tracks', expected={'storms': list_named_storms(time_str)})
+
 
 def download_forecast(time_str, overwrite=False):
     # Forecast time string must be in the format '%Y%m%d%H0000'
@@ -84,14 +95,18 @@ def process_bufr(time_str, overwrite=False):
 
     if len(os.listdir(TRACKS_DIR)) > 0 and not overwrite:
         print(f"Tracks for forecast {time_str} already exist, skipping.")
+        add_info(skipped=True)
         return
 
     # read forecast
     tr_fcast = TCForecast()
-    tr_fcast.fetch_ecmwf(path=BUFR_DIR)
+    with timed('decode_bufr', files=len(os.listdir(BUFR_DIR))):
+        tr_fcast.fetch_ecmwf(path=BUFR_DIR)
+        add_info(members=len(tr_fcast.data))
 
     # filter to named storms
     tr_filter = filter_storm(tr_fcast)
+    add_info(storms=len({tr.name for tr in tr_filter.data}), members=len(tr_filter.data))
 
     # Consistency check: ensure the number of named storms matches the BUFR count
     # I thought this was a valid check but it looks like maybe there are sometimes empty forecasts for named storms?
@@ -104,6 +119,18 @@ def process_bufr(time_str, overwrite=False):
         print(f"No named storms found in forecast {time_str}.")
         return
 
+    write_forecast_tracks(tr_filter, time_str)
+
+
+def write_forecast_tracks(tr_filter, time_str):
+    """
+    Interpolate the named storm tracks of a forecast to 10-minute time steps,
+    correct their wind speeds and save them to the forecast's tracks directory.
+    The tracks are modified in place.
+    """
+    TRACKS_DIR = Path(WORKING_DIR, time_str, "tracks")
+    os.makedirs(TRACKS_DIR, exist_ok=True)
+
     # interpolate to 10-minute timesteps
     tr_filter.equal_timestep(1/6)
 
@@ -112,7 +139,7 @@ def process_bufr(time_str, overwrite=False):
 
     # write tracks to file
     tr_filter.write_hdf5(Path(TRACKS_DIR, "ECMWF_TC_tracks.h5"))
-    
+
 
 
 def download_and_process_latest_forecast(overwrite=False):
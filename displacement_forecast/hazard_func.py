@@ -0,0 +1,665 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Useful functions for working with the forecast wind field hazards.
+
+@author: Chris Fairless
+"""
+import os
+import json
+import h5py
+import numpy as np
+from pathlib import Path
+from typing import Union
+from scipy import sparse
+
+from climada.hazard import Hazard, Centroids
+from climada.engine import Impact
+from climada.util.coordinates import get_country_code, lon_normalize
+
+from displacement_forecast.tc_tracks_func import SAFFIR_SIM_CAT
+from displacement_forecast.metrics_func import timed
+
+WIND_FILE_PREFIX = "tc_wind_"
+ARRIVAL_FILE_PREFIX = "tc_arrival_"
+
+WIND_FIELD_FORMATS = {
+    'hdf5': '.hdf5',   # climada Hazard.write_hdf5, read in full
+    'tiled': '.h5',    # compressed spatial tiles with a region index, read partially
+    'memmap': '.csr',  # directory of raw .npy arrays, memory-mapped and shared between processes
+}
+"""Wind field storage formats and their file suffixes."""
+
+TILE_SIZE_DEG = 5.
+"""Edge length in degrees of the spatial tiles of the tiled wind field format."""
+
+TILE_COMPRESSION = {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}
+
+ASSIGNMENT_DISTANCE_KM = 100.
+"""Largest distance at which ImpactCalc assigns an exposure point to a centroid (climada's default)."""
+
+EXCEEDANCE_THRESHOLDS = SAFFIR_SIM_CAT[:-1]
+"""Default wind thresholds (m/s) for exceedance probabilities: the lower bound of each category from Tropical Storm up."""
+
+
+def list_wind_field_files(wind_dir: Union[str, Path]):
+    """
+    List the wind field hazard files in a forecast's wind field directory,
+    ignoring any other outputs stored alongside them.
+    """
+    return sorted(f for f in os.listdir(wind_dir) if f.startswith(WIND_FILE_PREFIX))
+
+
+def get_wind_field_format(file_path: Union[str, Path]):
+    """Storage format of a wind field file, from its suffix."""
+    suffix = Path(file_path).suffix
+    for wind_format, format_suffix in WIND_FIELD_FORMATS.items():
+        if suffix == format_suffix:
+            return wind_format
+    raise ValueError(f"Unrecognised wind field file format: {file_path}")
+
+
+def get_centroid_region_id(hazard: Hazard):
+    """
+    Country code of each centroid that sees non-zero wind, 0 for all other centroids.
+
+    Only centroids with wind are looked up, since get_country_code is slow on
+    large centroid sets.
+    """
+    region_id = np.zeros(hazard.centroids.size, dtype=int)
+    idx_non_zero_wind = hazard.intensity.max(axis=0).nonzero()[1]
+    with timed('get_country_code', centroids=idx_non_zero_wind.size):
+        region_id[idx_non_zero_wind] = get_country_code(
+            hazard.centroids.lat[idx_non_zero_wind],
+            hazard.centroids.lon[idx_non_zero_wind]
+        )
+    return region_id
+
+
+def write_wind_field(file_path: Union[str, Path],
+                     hazard: Hazard,
+                     wind_format: str = 'tiled',
+                     tile_size: float = TILE_SIZE_DEG):
+    """
+    Save a wind field hazard in one of the WIND_FIELD_FORMATS.
+
+    The file suffix is set from the format, replacing any given suffix.
+
+    Returns
+    -------
+    file_path : Path
+        The path that was written.
+    """
+    file_path = Path(file_path).with_suffix(WIND_FIELD_FORMATS[wind_format])
+    if wind_format == 'hdf5':
+        hazard.write_hdf5(file_path)
+    elif wind_format == 'memmap':
+        write_hazard_memmap(file_path, hazard, get_centroid_region_id(hazard))
+    else:
+        write_hazard_tiles(file_path, hazard, get_centroid_region_id(hazard), tile_size)
+    return file_path
+
+
+def read_wind_field(file_path: Union[str, Path], region_id: int = None, bounds: tuple = None):
+    """
+    Read a wind field hazard stored in any of the WIND_FIELD_FORMATS.
+
+    Parameters
+    ----------
+    file_path : Union[str, Path]
+        The wind field file.
+    region_id : int
+        Country code. If given, tiled files are read only for the tiles
+        containing the country's centroids with wind. Memory-mapped files are
+        always mapped in full, at no memory cost until pages are touched.
+        Files in the hdf5 format are always read in full.
+    bounds : tuple
+        (lon_min, lat_min, lon_max, lat_max). If given instead, tiled files
+        are read for the tiles overlapping these bounds, e.g. from
+        exposure_bounds.
+
+    Returns
+    -------
+    hazard : climada.hazard.Hazard
+        The (partial) wind field.
+    centroid_region_id : np.ndarray
+        Country code of each of the hazard's centroids, 0 where there is no wind.
+    """
+    wind_format = get_wind_field_format(file_path)
+    if wind_format == 'tiled':
+        return read_hazard_tiles(file_path, region_id, bounds)
+    if wind_format == 'memmap':
+        return read_hazard_memmap(file_path)
+    hazard = Hazard.from_hdf5(file_path)
+    return hazard, get_centroid_region_id(hazard)
+
+
+def read_wind_field_regions(file_path: Union[str, Path]):
+    """
+    Country codes of the countries that see wind in a wind field file.
+
+    For tiled and memory-mapped files only the region index is read.
+    """
+    wind_format = get_wind_field_format(file_path)
+    if wind_format == 'tiled':
+        with h5py.File(file_path, 'r') as f:
+            regions = f['index/region_tile'][:, 0]
+    elif wind_format == 'memmap':
+        regions = np.load(Path(file_path, 'region_id.npy'), mmap_mode='r')
+    else:
+        regions = read_wind_field(file_path)[1]
+    return np.trim_zeros(np.unique(regions))
+
+
+def write_hazard_tiles(file_path: Union[str, Path],
+                       hazard: Hazard,
+                       region_id: np.ndarray,
+                       tile_size: float = TILE_SIZE_DEG):
+    """
+    Save a hazard split into compressed spatial tiles with a region index.
+
+    Centroids are grouped into tiles of tile_size degrees. Each tile is its
+    own HDF5 group holding the tile's centroids and the intensity of those
+    centroids as compressed CSC arrays (data, event indices, column pointers),
+    so a reader can load any set of tiles without touching the rest of the
+    file. The index lists the tiles and which regions occur in which tile.
+
+    The fraction matrix is not stored: for tropical cyclone wind fields it is
+    1 wherever there is wind, which is what ImpactCalc assumes when the
+    fraction is empty.
+
+    Parameters
+    ----------
+    file_path : Union[str, Path]
+        Output HDF5 file.
+    hazard : climada.hazard.Hazard
+        Wind field hazard.
+    region_id : np.ndarray
+        Country code of each centroid, e.g. from get_centroid_region_id.
+    tile_size : float
+        Tile edge length in degrees. Default: TILE_SIZE_DEG
+    """
+    lat = hazard.centroids.lat
+    lon = lon_normalize(hazard.centroids.lon.copy())
+    n_tile_cols = int(np.ceil(360 / tile_size))
+    tile = (
+        np.floor((lat + 90) / tile_size).astype(int) * n_tile_cols
+        + np.clip(np.floor((lon + 180) / tile_size).astype(int), 0, n_tile_cols - 1)
+    )
+    order = np.argsort(tile, kind='stable')
+    tile_id, tile_start = np.unique(tile[order], return_index=True)
+    tile_stop = np.append(tile_start[1:], order.size)
+
+    intensity = hazard.intensity.tocsc()
+    region_tile = np.unique(np.stack([region_id, tile], axis=1), axis=0)
+    region_tile = region_tile[region_tile[:, 0] != 0]
+
+    with h5py.File(file_path, 'w') as f:
+        f.attrs['format'] = 'tiled'
+        f.attrs['haz_type'] = hazard.haz_type
+        f.attrs['units'] = hazard.units
+        f.attrs['frequency_unit'] = hazard.frequency_unit
+        f.attrs['crs'] = str(hazard.centroids.crs)
+        f.attrs['tile_size'] = tile_size
+        f.attrs['n_events'] = intensity.shape[0]
+        f.attrs['n_centroids'] = intensity.shape[1]
+
+        f.create_dataset('event/event_id', data=hazard.event_id)
+        f.create_dataset('event/event_name', data=[str(name) for name in hazard.event_name],
+                         dtype=h5py.string_dtype())
+        f.create_dataset('event/date', data=hazard.date)
+        f.create_dataset('event/frequency', data=hazard.frequency)
+        f.create_dataset('event/orig', data=hazard.orig)
+
+        f.create_dataset('index/tile_id', data=tile_id)
+        f.create_dataset('index/region_tile', data=region_tile.reshape(-1, 2))
+
+        for t, start, stop in zip(tile_id, tile_start, tile_stop):
+            cols = order[start:stop]
+            tile_intensity = intensity[:, cols]
+            group = f.create_group(f'tiles/{t}')
+            group.create_dataset('lat', data=lat[cols], **TILE_COMPRESSION)
+            group.create_dataset('lon', data=hazard.centroids.lon[cols], **TILE_COMPRESSION)
+            group.create_dataset('region_id', data=region_id[cols], **TILE_COMPRESSION)
+            group.create_dataset('indptr', data=tile_intensity.indptr, **TILE_COMPRESSION)
+            if tile_intensity.nnz > 0:
+                group.create_dataset('data', data=tile_intensity.data, **TILE_COMPRESSION)
+                group.create_dataset('indices', data=tile_intensity.indices, **TILE_COMPRESSION)
+            else:
+                group.create_dataset('data', data=tile_intensity.data)
+                group.create_dataset('indices', data=tile_intensity.indices)
+
+
+def read_hazard_tiles(file_path: Union[str, Path], region_id: int = None, bounds: tuple = None):
+    """
+    Read a hazard saved with write_hazard_tiles, optionally only some of its tiles.
+
+    The region index only covers centroids with wind, so the tiles of a
+    region hold all of the region's windy centroids but not necessarily the
+    centroids its exposure points are nearest to. For an impact calculation
+    read the tiles within bounds from exposure_bounds instead: these hold
+    every centroid within the assignment distance of every exposure point,
+    so each point is assigned the same centroid as with the full hazard.
+
+    Parameters
+    ----------
+    file_path : Union[str, Path]
+        The tiled hazard file.
+    region_id : int
+        Country code: read the tiles holding the country's centroids with wind.
+    bounds : tuple
+        (lon_min, lat_min, lon_max, lat_max): read the tiles overlapping
+        these bounds. Default: None, and if no region_id either, read all tiles.
+
+    Returns
+    -------
+    hazard : climada.hazard.Hazard
+        The hazard on the centroids of the tiles read.
+    centroid_region_id : np.ndarray
+        Country code of each of the hazard's centroids, 0 where there is no wind.
+    """
+    with h5py.File(file_path, 'r') as f:
+        if region_id is not None:
+            region_tile = f['index/region_tile'][:]
+            tiles = region_tile[region_tile[:, 0] == region_id, 1]
+        elif bounds is not None:
+            tiles = tiles_in_bounds(f['index/tile_id'][:], bounds, float(f.attrs['tile_size']))
+        else:
+            tiles = f['index/tile_id'][:]
+
+        lat, lon, centroid_region_id = [], [], []
+        data, indices, indptr = [], [], [np.zeros(1, dtype=np.int64)]
+        for t in tiles:
+            group = f[f'tiles/{t}']
+            lat.append(group['lat'][:])
+            lon.append(group['lon'][:])
+            centroid_region_id.append(group['region_id'][:])
+            data.append(group['data'][:])
+            indices.append(group['indices'][:])
+            indptr.append(group['indptr'][1:] + indptr[-1][-1])
+
+        n_events = int(f.attrs['n_events'])
+        lat = np.concatenate(lat) if lat else np.zeros(0)
+        intensity = sparse.csc_matrix(
+            (np.concatenate(data) if data else np.zeros(0),
+             np.concatenate(indices) if indices else np.zeros(0, dtype=int),
+             np.concatenate(indptr)),
+            shape=(n_events, lat.size)
+        ).tocsr()
+
+        hazard = Hazard(
+            haz_type=f.attrs['haz_type'],
+            units=f.attrs['units'],
+            centroids=Centroids(
+                lat=lat,
+                lon=np.concatenate(lon) if lon else np.zeros(0),
+                crs=f.attrs['crs']
+            ),
+            event_id=f['event/event_id'][:],
+            event_name=list(f['event/event_name'].asstr()[:]),
+            date=f['event/date'][:],
+            frequency=f['event/frequency'][:],
+            frequency_unit=f.attrs['frequency_unit'],
+            orig=f['event/orig'][:],
+            intensity=intensity
+        )
+    return hazard, np.concatenate(centroid_region_id) if centroid_region_id else np.zeros(0, dtype=int)
+
+
+def tiles_in_bounds(tile_id: np.ndarray, bounds: tuple, tile_size: float):
+    """The tiles of write_hazard_tiles that overlap (lon_min, lat_min, lon_max, lat_max)"""
+    lon_min, lat_min, lon_max, lat_max = bounds
+    n_tile_cols = int(np.ceil(360 / tile_size))
+    tile_lat = (tile_id // n_tile_cols) * tile_size - 90
+    tile_lon = (tile_id % n_tile_cols) * tile_size - 180
+    overlaps = (
+        (tile_lat <= lat_max) & (tile_lat + tile_size >= lat_min)
+        & (tile_lon <= lon_max) & (tile_lon + tile_size >= lon_min)
+    )
+    return tile_id[overlaps]
+
+
+def exposure_bounds(lat: np.ndarray, lon: np.ndarray, distance_km: float = ASSIGNMENT_DISTANCE_KM):
+    """
+    Bounds (lon_min, lat_min, lon_max, lat_max) of exposure points, widened by
+    the distance within which ImpactCalc assigns them to centroids. Longitudes
+    are normalised to [-180, 180), as in the tile index, so a country crossing
+    the antimeridian gets bounds spanning all longitudes.
+    """
+    lon = lon_normalize(np.asarray(lon, dtype=float).copy())
+    lat = np.asarray(lat, dtype=float)
+    buffer_lat = distance_km / 111.
+    max_abs_lat = min(np.abs(lat).max() + buffer_lat, 89.)
+    buffer_lon = distance_km / (111. * np.cos(np.radians(max_abs_lat)))
+    return (lon.min() - buffer_lon, max(lat.min() - buffer_lat, -90.),
+            lon.max() + buffer_lon, min(lat.max() + buffer_lat, 90.))
+
+
+def write_hazard_memmap(dir_path: Union[str, Path],
+                        hazard: Hazard,
+                        region_id: np.ndarray):
+    """
+    Save a hazard as a directory of raw arrays that can be memory-mapped.
+
+    The CSR intensity and fraction matrices are written as their raw data,
+    indices and indptr arrays in .npy files, together with the centroid and
+    event arrays. Small metadata goes to meta.json.
+
+    Parameters
+    ----------
+    dir_path : Union[str, Path]
+        Output directory, created if needed.
+    hazard : climada.hazard.Hazard
+        Wind field hazard.
+    region_id : np.ndarray
+        Country code of each centroid, e.g. from get_centroid_region_id.
+    """
+    os.makedirs(dir_path, exist_ok=True)
+    for name in ['intensity', 'fraction']:
+        matrix = getattr(hazard, name).tocsr()
+        np.save(Path(dir_path, f'{name}_data.npy'), matrix.data)
+        np.save(Path(dir_path, f'{name}_indices.npy'), matrix.indices)
+        np.save(Path(dir_path, f'{name}_indptr.npy'), matrix.indptr)
+
+    np.save(Path(dir_path, 'lat.npy'), hazard.centroids.lat)
+    np.save(Path(dir_path, 'lon.npy'), hazard.centroids.lon)
+    np.save(Path(dir_path, 'region_id.npy'), region_id)
+    np.save(Path(dir_path, 'event_id.npy'), hazard.event_id)
+    np.save(Path(dir_path, 'date.npy'), hazard.date)
+    np.save(Path(dir_path, 'frequency.npy'), hazard.frequency)
+    np.save(Path(dir_path, 'orig.npy'), hazard.orig)
+
+    meta = {
+        'haz_type': hazard.haz_type,
+        'units': hazard.units,
+        'frequency_unit': hazard.frequency_unit,
+        'crs': str(hazard.centroids.crs),
+        'shape': list(hazard.intensity.shape),
+        'event_name': [str(name) for name in hazard.event_name]
+    }
+    with open(Path(dir_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def read_hazard_memmap(dir_path: Union[str, Path]):
+    """
+    Open a hazard saved with write_hazard_memmap without reading its matrices.
+
+    The arrays behind the intensity and fraction matrices are memory-mapped
+    copy-on-write: all processes opening the same file share one copy in the
+    page cache, and only the pages actually touched are read from disk.
+
+    Returns
+    -------
+    hazard : climada.hazard.Hazard
+        The hazard, with memory-mapped intensity and fraction matrices.
+    centroid_region_id : np.ndarray
+        Country code of each of the hazard's centroids, 0 where there is no wind.
+    """
+    def load(name):
+        return np.load(Path(dir_path, f'{name}.npy'), mmap_mode='c')
+
+    with open(Path(dir_path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    shape = tuple(meta['shape'])
+
+    intensity, fraction = [
+        sparse.csr_matrix(
+            (load(f'{name}_data'), load(f'{name}_indices'), load(f'{name}_indptr')),
+            shape=shape,
+            copy=False
+        )
+        for name in ['intensity', 'fraction']
+    ]
+
+    hazard = Hazard(
+        haz_type=meta['haz_type'],
+        units=meta['units'],
+        centroids=Centroids(lat=np.load(Path(dir_path, 'lat.npy')),
+                            lon=np.load(Path(dir_path, 'lon.npy')),
+                            crs=meta['crs']),
+        event_id=np.load(Path(dir_path, 'event_id.npy')),
+        event_name=meta['event_name'],
+        date=np.load(Path(dir_path, 'date.npy')),
+        frequency=np.load(Path(dir_path, 'frequency.npy')),
+        frequency_unit=meta['frequency_unit'],
+        orig=np.load(Path(dir_path, 'orig.npy')),
+        intensity=intensity,
+        fraction=fraction
+    )
+    return hazard, load('region_id')
+
+
+def exceedance_probability(hazard: Hazard,
+                           thresholds=EXCEEDANCE_THRESHOLDS):
+    """
+    Probability of each centroid exceeding each wind threshold, computed
+    directly from the sparse intensity matrix.
+
+    All thresholds are evaluated in a single pass over the stored intensities:
+    each value is binned against the sorted thresholds, the event frequencies
+    are accumulated per (centroid, bin), and a reverse cumulative sum over the
+    bins gives the exceedance. With the forecast frequency of 1/N_ENSEMBLE per
+    member this is the fraction of ensemble members reaching each threshold.
+
+    Parameters
+    ----------
+    hazard : climada.hazard.Hazard
+        Wind field hazard with one event per ensemble member.
+    thresholds : list of float
+        Wind thresholds in m/s. Default: the Saffir-Simpson category bounds.
+
+    Returns
+    -------
+    probability : np.ndarray
+        Array of shape (n_centroids, n_thresholds). Columns follow the order
+        of the thresholds as given.
+    """
+    thresholds = np.asarray(thresholds, dtype=float)
+    order = np.argsort(thresholds)
+    n_thresholds = thresholds.size
+
+    intensity = hazard.intensity.tocsr()
+    n_events, n_centroids = intensity.shape
+    event_idx = np.repeat(np.arange(n_events), np.diff(intensity.indptr))
+
+    # number of (sorted) thresholds reached by each stored value, 0 to n_thresholds
+    level = np.searchsorted(thresholds[order], intensity.data, side='right')
+    weight_per_level = np.bincount(
+        intensity.indices * (n_thresholds + 1) + level,
+        weights=np.asarray(hazard.frequency, dtype=float)[event_idx],
+        minlength=n_centroids * (n_thresholds + 1)
+    ).reshape(n_centroids, n_thresholds + 1)
+
+    probability_sorted = np.cumsum(weight_per_level[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    probability = np.empty_like(probability_sorted)
+    probability[:, order] = probability_sorted
+    return probability
+
+
+def write_exceedance_probability(file_path: Union[str, Path],
+                                 hazard: Hazard,
+                                 probability: np.ndarray,
+                                 thresholds=EXCEEDANCE_THRESHOLDS):
+    """
+    Save exceedance probabilities as a compact, compressed HDF5 array product.
+
+    Only centroids with a non-zero probability for at least one threshold are
+    written, with their coordinates.
+
+    Parameters
+    ----------
+    file_path : Union[str, Path]
+        Output HDF5 file.
+    hazard : climada.hazard.Hazard
+        The hazard the probabilities were computed from.
+    probability : np.ndarray
+        Output of exceedance_probability, shape (n_centroids, n_thresholds).
+    thresholds : list of float
+        The wind thresholds in m/s, in the order of the probability columns.
+    """
+    idx = np.flatnonzero(probability.max(axis=1) > 0)
+    with h5py.File(file_path, 'w') as f:
+        f.attrs['haz_type'] = hazard.haz_type
+        f.attrs['units'] = hazard.units
+        f.create_dataset('threshold', data=np.asarray(thresholds, dtype=float))
+        f.create_dataset('centroid_idx', data=idx, compression='gzip')
+        f.create_dataset('lat', data=hazard.centroids.lat[idx], compression='gzip')
+        f.create_dataset('lon', data=hazard.centroids.lon[idx], compression='gzip')
+        f.create_dataset('probability', data=probability[idx].astype(np.float32), compression='gzip')
+
+
+def exceedance_impact(hazard: Hazard,
+                      centroid_idx: np.ndarray,
+                      threshold: float,
+                      value_unit: str = "unitless"):
+    """
+    Impact of a wind threshold on a flat exposure located at hazard centroids.
+
+    Equivalent to an ImpactCalc with a step impact function at the threshold
+    on an exposure of value 1 at each selected centroid, but computed with a
+    single sparse comparison instead of the exposure-to-centroid assignment
+    and impact function interpolation.
+
+    Parameters
+    ----------
+    hazard : climada.hazard.Hazard
+        Wind field hazard.
+    centroid_idx : np.ndarray
+        Indices of the hazard centroids making up the flat exposure.
+    threshold : float
+        Wind threshold in m/s.
+    value_unit : str
+        Unit of the flat exposure. Default: "unitless"
+
+    Returns
+    -------
+    impact : climada.engine.Impact
+        Impact where each exposure point is 1 in events reaching the threshold,
+        so eai_exp is the probability of the threshold being reached.
+    """
+    intensity = hazard.intensity[:, centroid_idx].tocsr()
+    imp_mat = sparse.csr_matrix(
+        ((intensity.data >= threshold).astype(float), intensity.indices, intensity.indptr),
+        shape=intensity.shape
+    )
+    imp_mat.eliminate_zeros()
+
+    frequency = np.asarray(hazard.frequency, dtype=float)
+    at_event = np.asarray(imp_mat.sum(axis=1)).ravel()
+    eai_exp = imp_mat.T @ frequency
+
+    return Impact(
+        event_id=hazard.event_id,
+        event_name=hazard.event_name,
+        date=hazard.date,
+        frequency=frequency,
+        frequency_unit=hazard.frequency_unit,
+        coord_exp=np.stack([hazard.centroids.lat[centroid_idx], hazard.centroids.lon[centroid_idx]], axis=1),
+        crs=hazard.centroids.crs,
+        eai_exp=eai_exp,
+        at_event=at_event,
+        tot_value=float(len(centroid_idx)),
+        aai_agg=float(at_event @ frequency),
+        unit=value_unit,
+        imp_mat=imp_mat,
+        haz_type=hazard.haz_type
+    )
+
+
+def windfield_arrival_time(windfield: sparse.csr_matrix,
+                           lead_hours: np.ndarray,
+                           threshold: float):
+    """
+    Lead time at which each centroid first reaches a wind threshold during one track.
+
+    Parameters
+    ----------
+    windfield : scipy.sparse.csr_matrix
+        Wind vectors of one track as stored by TropCyclone.from_tracks with
+        store_windfields=True: shape (n_positions, n_centroids * 2), with the
+        two components of each centroid in adjacent columns.
+    lead_hours : np.ndarray
+        Lead time in hours of each track position.
+    threshold : float
+        Wind threshold in m/s.
+
+    Returns
+    -------
+    arrival : scipy.sparse.csr_matrix
+        Shape (1, n_centroids). Lead time in hours of the first position at
+        which the threshold is reached, stored explicitly (also when 0) for
+        the centroids that reach it and absent for all others.
+    """
+    n_centroids = windfield.shape[1] // 2
+    windfield = windfield.tocoo()
+    speed_squared = sparse.csr_matrix(
+        (windfield.data ** 2, (windfield.row, windfield.col // 2)),
+        shape=(windfield.shape[0], n_centroids)
+    ).tocoo()
+
+    reached = speed_squared.data >= threshold ** 2
+    first = np.full(n_centroids, np.inf)
+    np.minimum.at(first, speed_squared.col[reached], np.asarray(lead_hours)[speed_squared.row[reached]])
+
+    idx = np.flatnonzero(np.isfinite(first))
+    return sparse.csr_matrix(
+        (first[idx].astype(np.float32), idx, np.array([0, idx.size])),
+        shape=(1, n_centroids)
+    )
+
+
+def write_arrival_times(file_path: Union[str, Path],
+                        arrival: sparse.csr_matrix,
+                        event_id: np.ndarray,
+                        threshold: float,
+                        forecast_time: str):
+    """
+    Save the arrival times of threshold winds, one row per ensemble member.
+
+    The raw CSR arrays are written so that arrivals at lead time 0, which are
+    stored explicitly, survive the round trip.
+
+    Parameters
+    ----------
+    file_path : Union[str, Path]
+        Output HDF5 file, saved alongside the wind field hazard.
+    arrival : scipy.sparse.csr_matrix
+        Arrival lead times in hours, shape (n_events, n_centroids) with the
+        same event and centroid order as the hazard.
+    event_id : np.ndarray
+        Event ids of the hazard, one per row.
+    threshold : float
+        The wind threshold in m/s.
+    forecast_time : str
+        Forecast initialisation time the lead times refer to.
+    """
+    with h5py.File(file_path, 'w') as f:
+        f.attrs['threshold'] = threshold
+        f.attrs['forecast_time'] = forecast_time
+        f.attrs['shape'] = arrival.shape
+        f.create_dataset('event_id', data=event_id)
+        f.create_dataset('data', data=arrival.data, compression='gzip')
+        f.create_dataset('indices', data=arrival.indices, compression='gzip')
+        f.create_dataset('indptr', data=arrival.indptr)
+
+
+def read_arrival_times(file_path: Union[str, Path]):
+    """
+    Read arrival times saved with write_arrival_times.
+
+    Returns
+    -------
+    arrival : scipy.sparse.csr_matrix
+        Arrival lead times in hours, shape (n_events, n_centroids).
+    event_id : np.ndarray
+        Event ids of the hazard, one per row.
+    threshold : float
+        The wind threshold in m/s.
+    """
+    with h5py.File(file_path, 'r') as f:
+        arrival = sparse.csr_matrix(
+            (f['data'][:], f['indices'][:], f['indptr'][:]),
+            shape=tuple(f.attrs['shape'])
+        )
+        return arrival, f['event_id'][:], float(f.attrs['threshold'])
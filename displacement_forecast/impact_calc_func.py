@@ -7,9 +7,13 @@ Useful functions for impact calculations.
 """
 import os
 import glob
+import h5py
 import numpy as np
 import pandas as pd
 import json
+import geopandas as gpd
+import shapely
+from scipy import sparse
 from typing import Union, List, Tuple
 from pathlib import Path
 
@@ -17,6 +21,32 @@ from climada.hazard import TCTracks
 from climada.entity import ImpactFunc, ImpfTropCyclone, ImpactFuncSet
 from climada.engine import Impact
 
+from displacement_forecast.projection_func import get_projected_coordinates, mercator_to_lonlat
+
+COMPACT_IMPACT_SUFFIX = "_impacts.h5"
+"""Suffix of the single compact impact file written per storm: <tc_name>_impacts.h5"""
+
+IMPACT_FILE_SUFFIXES = {
+    'cat1': 'cat1_affected',
+    'cat3': 'cat3_affected',
+    'exposed': 'exposed_population',
+    'displaced': 'displaced_population'
+}
+"""Impact types and the suffix of their full Impact files: <tc_name>_<country_iso3>_<suffix>.h5"""
+
+POINT_FORMATS = {
+    'geojson': '.json',       # one GeoJSON per storm, country and impact type
+    'flatgeobuf': '.fgb',     # one file per forecast with a packed R-tree spatial index
+    'geoparquet': '.parquet', # one file per forecast, Hilbert-sorted with bounding box columns
+}
+"""Formats of the ensemble average impact points and their file suffixes."""
+
+GRID_CELL_FACTOR = {'sum': 4, 'max': 2}
+"""Edge length of the map grid cells in multiples of the exposure point spacing, per aggregation."""
+
+DEFAULT_GRID_CELL_SIZE = 10000.
+"""Edge length (m) of the map grid cells when the point spacing is unknown, e.g. for a single point."""
+
 #  List of regions and the countries
 iso3_to_basin = {'NA1': ['AIA', 'ATG', 'ARG', 'ABW', 'BHS', 'BRB', 'BLZ', 'BMU',
                  'BOL', 'CPV', 'CYM', 'CHL', 'COL', 'CRI', 'CUB', 'DMA',
@@ -247,10 +277,147 @@ def make_save_filename(imp_summary_dict: dict,
         )
     return forecast_filename
 
+def aggregate_to_grid(x: np.ndarray,
+                      y: np.ndarray,
+                      values: np.ndarray,
+                      cell_size: float,
+                      reduce: str = 'sum'):
+    """
+    Aggregate point values onto a square grid in projected coordinates.
+
+    Cells are aligned to multiples of cell_size so that the grid of a country
+    is the same for every storm. Only points with non-zero values are binned
+    and only cells containing such points are returned.
+
+    Parameters
+    ----------
+    x, y: np.ndarray
+        Projected point coordinates.
+    values: np.ndarray
+        Value of each point.
+    cell_size: float
+        Cell edge length, in the units of x and y.
+    reduce: str
+        How the values in a cell are combined: 'sum' or 'max'.
+
+    Returns
+    -------
+    grid: dict
+        cell_size: the cell edge length.
+        ix, iy: integer cell indices of the non-empty cells; cell (ix, iy)
+            spans [ix * cell_size, (ix + 1) * cell_size) in x, likewise in y.
+        value: aggregated value of each cell.
+    """
+    nonzero = values != 0
+    x, y, values = x[nonzero], y[nonzero], values[nonzero]
+    ix = np.floor(x / cell_size).astype(np.int64)
+    iy = np.floor(y / cell_size).astype(np.int64)
+
+    cells, cell_of_point = np.unique(np.stack([ix, iy], axis=1), axis=0, return_inverse=True)
+    cell_of_point = cell_of_point.ravel()
+    if reduce == 'sum':
+        cell_values = np.bincount(cell_of_point, weights=values, minlength=len(cells))
+    elif reduce == 'max':
+        order = np.argsort(cell_of_point, kind='stable')
+        starts = np.searchsorted(cell_of_point[order], np.arange(len(cells)))
+        cell_values = np.maximum.reduceat(values[order], starts) if len(cells) > 0 else np.zeros(0)
+    else:
+        raise ValueError(f"Unknown grid aggregation {reduce}: use 'sum' or 'max'")
+
+    return {
+        "cell_size": cell_size,
+        "ix": cells[:, 0],
+        "iy": cells[:, 1],
+        "value": cell_values
+    }
+
+def grid_bounds(grid: dict):
+    """(xmin, ymin, xmax, ymax) of the non-empty cells of a grid, like GeoDataFrame.total_bounds"""
+    if len(grid["value"]) == 0:
+        return np.full(4, np.nan)
+    size = grid["cell_size"]
+    return np.array([grid["ix"].min() * size, grid["iy"].min() * size,
+                     (grid["ix"].max() + 1) * size, (grid["iy"].max() + 1) * size])
+
+def grid_to_raster(grid: dict):
+    """
+    Dense array of a grid for image plotting, NaN in empty cells.
+
+    Returns
+    -------
+    raster: np.ndarray
+        Cell values with rows ordered from south to north (imshow origin='lower').
+    extent: tuple
+        (xmin, xmax, ymin, ymax) of the raster.
+    """
+    xmin, ymin, xmax, ymax = grid_bounds(grid)
+    raster = np.full((grid["iy"].max() - grid["iy"].min() + 1,
+                      grid["ix"].max() - grid["ix"].min() + 1), np.nan)
+    raster[grid["iy"] - grid["iy"].min(), grid["ix"] - grid["ix"].min()] = grid["value"]
+    return raster, (xmin, xmax, ymin, ymax)
+
+def grid_to_geodataframe(grid: dict):
+    """
+    Grid cells as a GeoDataFrame of polygons in lat/lon (EPSG:4326), with column 'value'.
+
+    Web Mercator is separable in x and y, so each square cell is a lat/lon rectangle.
+    """
+    size = grid["cell_size"]
+    lon_min, lat_min = mercator_to_lonlat(grid["ix"] * size, grid["iy"] * size)
+    lon_max, lat_max = mercator_to_lonlat((grid["ix"] + 1) * size, (grid["iy"] + 1) * size)
+    return gpd.GeoDataFrame(
+        {"value": grid["value"]},
+        geometry=shapely.box(lon_min, lat_min, lon_max, lat_max),
+        crs="EPSG:4326"
+    )
+
+def build_impact_analysis(impact: Impact, reduce: str = 'sum'):
+    """
+    Intermediates shared by all summaries, writers and plots of one impact.
+
+    Building the exposure GeoDataFrame and aggregating the impact for mapping
+    are the costly parts of analysing an impact, so they are done once here
+    and the result is passed to every consumer instead of each of them
+    rebuilding it.
+
+    Parameters
+    ----------
+    impact: climada.engine.Impact
+
+    reduce: str
+        How the ensemble average impact is aggregated onto the map grid: 'sum'
+        for people, 'max' for the share of members exceeding a wind threshold.
+        Default: 'sum'
+
+    Returns
+    -------
+    impact_analysis: dict
+        gdf: GeoDataFrame of the ensemble average impact (column 'value') per
+            exposure point in the impact's CRS.
+        grid: the ensemble average impact aggregated onto a square Web
+            Mercator grid (see aggregate_to_grid), for maps and gridded output.
+        max: largest ensemble average impact of a single exposure point, which
+            sets the colour scale of the maps.
+        mean, std: mean and standard deviation of the impact over the members.
+        at_event: the impact of each member, for histograms.
+    """
+    gdf = impact._build_exp().gdf
+    x, y, spacing = get_projected_coordinates(impact.coord_exp[:, 0], impact.coord_exp[:, 1])
+    cell_size = GRID_CELL_FACTOR[reduce] * spacing if np.isfinite(spacing) else DEFAULT_GRID_CELL_SIZE
+    return {
+        "gdf": gdf,
+        "grid": aggregate_to_grid(x, y, impact.eai_exp, cell_size, reduce),
+        "max": np.max(impact.eai_exp),
+        "mean": np.mean(impact.at_event),
+        "std": np.std(impact.at_event),
+        "at_event": impact.at_event
+    }
+
 def save_average_impact_geospatial_points(save_dir: Union[str, Path],
                                           imp_summary_dict: dict,
                                           impact: Impact,
-                                          include_zeros: bool = False):
+                                          include_zeros: bool = False,
+                                          impact_analysis: dict = None):
     """
     Save the average impact of each grid points into a geoJSON file.
 
@@ -267,16 +434,166 @@ def save_average_impact_geospatial_points(save_dir: Union[str, Path],
     include_zeros: bool
         Whether inclode grid points with impact equals to 0.
         Default: False
-    """
 
-    imp_gdf = impact._build_exp().gdf
+    impact_analysis: dict
+        Output of build_impact_analysis for this impact, if already computed.
+    """
+    if impact_analysis is None:
+        impact_analysis = build_impact_analysis(impact)
+    imp_gdf = impact_analysis["gdf"]
 
     if include_zeros:
         imp_gdf.to_file(Path(save_dir, make_save_filename(imp_summary_dict, save_file_type="gdf")))
     else:
-        imp_gdf.drop(imp_gdf[imp_gdf['value'] == 0].index, inplace=True)
+        imp_gdf = imp_gdf[imp_gdf['value'] != 0]
         imp_gdf.to_file(Path(save_dir, make_save_filename(imp_summary_dict, save_file_type="gdf")))
 
+def impact_points_frame(imp_summary_dict: dict,
+                        impact: Impact,
+                        impact_analysis: dict = None):
+    """
+    Non-zero ensemble average impact points of one impact, labelled with the
+    storm, country and impact type, for the consolidated point file.
+
+    Parameters
+    ----------
+    imp_summary_dict: dict
+        Summary of the forecast.
+
+    impact: climada.engine.Impact
+
+    impact_analysis: dict
+        Output of build_impact_analysis for this impact, if already computed.
+
+    Returns
+    -------
+    gdf: GeoDataFrame with columns eventName, countryISO3, impactType, value
+        and the point geometry.
+    """
+    if impact_analysis is None:
+        impact_analysis = build_impact_analysis(impact)
+    imp_gdf = impact_analysis["gdf"]
+    imp_gdf = imp_gdf.loc[imp_gdf['value'] != 0, ['value', 'geometry']]
+    return imp_gdf.assign(
+        eventName=imp_summary_dict["eventName"],
+        countryISO3=imp_summary_dict["countryISO3"],
+        impactType=imp_summary_dict["impactType"],
+    )[['eventName', 'countryISO3', 'impactType', 'value', 'geometry']]
+
+def make_save_points_filename(forecast_time: str, point_format: str):
+    """File name of the consolidated impact point file of a forecast"""
+    return f'impact-points_TC_ECMWF_ens_{forecast_time}{POINT_FORMATS[point_format]}'
+
+def save_impact_points(save_dir: Union[str, Path],
+                       forecast_time: str,
+                       point_frames: list,
+                       point_format: str = 'flatgeobuf'):
+    """
+    Save the impact points of all storms, countries and impact types of a
+    forecast into one spatially indexed file.
+
+    Parameters
+    ----------
+    save_dir: Union[str, Path],
+        Directory where the output is saved to.
+
+    forecast_time: str
+        Forecast initialisation time, as in the forecast summaries.
+
+    point_frames: list
+        GeoDataFrames from impact_points_frame.
+
+    point_format: str
+        'flatgeobuf' (with a spatial index) or 'geoparquet' (sorted along a
+        Hilbert curve with bounding box columns). Default: 'flatgeobuf'
+
+    Returns
+    -------
+    save_path: Path of the written file.
+    """
+    if point_format not in ('flatgeobuf', 'geoparquet'):
+        raise ValueError(f"Unknown consolidated point format {point_format}: use 'flatgeobuf' or 'geoparquet'")
+
+    save_path = Path(save_dir, make_save_points_filename(forecast_time, point_format))
+    if len(point_frames) > 0:
+        points = pd.concat(point_frames, ignore_index=True)
+    else:
+        points = gpd.GeoDataFrame(
+            {'eventName': [], 'countryISO3': [], 'impactType': [], 'value': []},
+            geometry=gpd.GeoSeries([], crs="EPSG:4326"))
+    points = gpd.GeoDataFrame(points, geometry='geometry')
+    for col in ['eventName', 'countryISO3', 'impactType']:
+        points[col] = points[col].astype(str)
+
+    if point_format == 'flatgeobuf':
+        points.to_file(save_path, driver="FlatGeobuf", SPATIAL_INDEX="YES")
+    else:
+        # neighbouring points end up in the same row groups, so bounding box
+        # reads only touch a few of them
+        if len(points) > 0:
+            points = points.iloc[np.argsort(points.hilbert_distance().values)]
+        points.to_parquet(save_path, index=False, write_covering_bbox=True)
+    return save_path
+
+def read_impact_points(file_path: Union[str, Path],
+                       bbox: tuple = None,
+                       tc_name: str = None,
+                       country_iso3: str = None,
+                       impact_type: str = None):
+    """
+    Read impact points from a consolidated point file, optionally only those
+    in a bounding box, using the file's spatial index.
+
+    Parameters
+    ----------
+    file_path: Union[str, Path]
+        A file written by save_impact_points.
+
+    bbox: tuple
+        (lon min, lat min, lon max, lat max). Default: everything
+
+    tc_name, country_iso3, impact_type: str
+        Only return points of this storm, country or impact type.
+
+    Returns
+    -------
+    gdf: GeoDataFrame
+    """
+    if Path(file_path).suffix == POINT_FORMATS['geoparquet']:
+        points = gpd.read_parquet(file_path, bbox=bbox)
+    else:
+        points = gpd.read_file(file_path, bbox=bbox)
+
+    for col, value in [('eventName', tc_name), ('countryISO3', country_iso3), ('impactType', impact_type)]:
+        if value is not None:
+            points = points[points[col] == value]
+    return points
+
+def save_average_impact_geospatial_grid(save_dir: Union[str, Path],
+                                        imp_summary_dict: dict,
+                                        impact: Impact,
+                                        impact_analysis: dict = None):
+    """
+    Save the average impact aggregated onto the map grid into a geoJSON file.
+
+    Parameters
+    ----------
+    save_dir: Union[str, Path],
+        Directory where the output is saved to.
+
+    imp_summary_dict: dict
+        Summary of the forecast.
+
+    impact: climada.engine.Impact
+
+    impact_analysis: dict
+        Output of build_impact_analysis for this impact, if already computed.
+    """
+    if impact_analysis is None:
+        impact_analysis = build_impact_analysis(impact)
+    grid_gdf = grid_to_geodataframe(impact_analysis["grid"])
+    grid_gdf.to_file(Path(save_dir, make_save_filename(imp_summary_dict, save_file_type="grid")))
+
 def save_impact_at_event(save_dir: Union[str, Path],
                         imp_summary_dict: dict,
                         impact: Impact):
@@ -324,3 +641,198 @@ def _check_event_no(impact: Impact):
         new_imp_at_event = np.pad(imp_at_event, pad_width=(0, no_missing_zeros),
                                   mode='constant', constant_values=0)
         return new_imp_at_event
+
+
+def compact_impact(impact: Impact, top_k: int = None):
+    """
+    Reduce an impact to what the analyses need, dropping the per-centroid imp_mat.
+
+    Parameters
+    ----------
+    impact : climada.engine.Impact
+        Impact with a full imp_mat.
+    top_k : int
+        If given, keep the imp_mat rows of the top_k ensemble members with the
+        largest total impact. Default: None, keep no rows.
+
+    Returns
+    -------
+    compact : dict
+        at_event per member, eai_exp and coordinates of the exposure points,
+        event data and scalar attributes, and optionally the top-k rows.
+    """
+    compact = {
+        'event_id': np.asarray(impact.event_id),
+        'frequency': np.asarray(impact.frequency),
+        'at_event': np.asarray(impact.at_event),
+        'eai_exp': np.asarray(impact.eai_exp),
+        'lat': np.asarray(impact.coord_exp[:, 0]),
+        'lon': np.asarray(impact.coord_exp[:, 1]),
+        'attrs': {
+            'aai_agg': float(impact.aai_agg),
+            'tot_value': float(impact.tot_value),
+            'unit': impact.unit,
+            'haz_type': impact.haz_type,
+            'frequency_unit': impact.frequency_unit,
+            'crs': str(impact.crs)
+        }
+    }
+    if top_k is not None and impact.imp_mat.shape[0] > 0:
+        member_idx = np.sort(np.argsort(impact.at_event)[::-1][:top_k])
+        compact['top_k'] = {
+            'member_idx': member_idx,
+            'imp_mat': sparse.csr_matrix(impact.imp_mat)[member_idx]
+        }
+    return compact
+
+
+def write_compact_impacts(file_path: Union[str, Path],
+                          compact_impacts: dict):
+    """
+    Save the compact impacts of one storm, all countries and impact types, in one file.
+
+    Parameters
+    ----------
+    file_path : Union[str, Path]
+        Output HDF5 file, usually <tc_name>_impacts.h5
+    compact_impacts : dict
+        Maps (country_iso3, impact_type) to the output of compact_impact.
+    """
+    with h5py.File(file_path, 'w') as f:
+        for (country_iso3, impact_type), compact in compact_impacts.items():
+            group = f.create_group(f'{country_iso3}/{impact_type}')
+            for key in ['event_id', 'frequency', 'at_event', 'eai_exp', 'lat', 'lon']:
+                group.create_dataset(key, data=compact[key], compression='gzip')
+            for key, value in compact['attrs'].items():
+                group.attrs[key] = value
+            if 'top_k' in compact:
+                top_k = group.create_group('top_k')
+                top_k.create_dataset('member_idx', data=compact['top_k']['member_idx'])
+                top_k.create_dataset('data', data=compact['top_k']['imp_mat'].data, compression='gzip')
+                top_k.create_dataset('indices', data=compact['top_k']['imp_mat'].indices, compression='gzip')
+                top_k.create_dataset('indptr', data=compact['top_k']['imp_mat'].indptr)
+
+
+def read_compact_impacts(file_path: Union[str, Path]):
+    """
+    Read a compact impact file as climada Impact objects.
+
+    The Impacts have everything the analyses use (at_event, eai_exp,
+    coord_exp, aai_agg) but no imp_mat, except for the rows of the top-k
+    members when they were saved.
+
+    Returns
+    -------
+    impacts : dict
+        Maps (country_iso3, impact_type) to a climada.engine.Impact
+    """
+    impacts = {}
+    with h5py.File(file_path, 'r') as f:
+        for country_iso3, country_group in f.items():
+            for impact_type, group in country_group.items():
+                n_events = group['at_event'].size
+                n_exp = group['eai_exp'].size
+                imp_mat = sparse.csr_matrix((0, 0))
+                if 'top_k' in group:
+                    top_k = sparse.csr_matrix(
+                        (group['top_k/data'][:], group['top_k/indices'][:], group['top_k/indptr'][:]),
+                        shape=(group['top_k/member_idx'].size, n_exp)
+                    )
+                    expand = sparse.csr_matrix(
+                        (np.ones(top_k.shape[0]), (group['top_k/member_idx'][:], np.arange(top_k.shape[0]))),
+                        shape=(n_events, top_k.shape[0])
+                    )
+                    imp_mat = (expand @ top_k).tocsr()
+
+                impacts[(country_iso3, impact_type)] = Impact(
+                    event_id=group['event_id'][:],
+                    frequency=group['frequency'][:],
+                    frequency_unit=group.attrs['frequency_unit'],
+                    coord_exp=np.stack([group['lat'][:], group['lon'][:]], axis=1),
+                    crs=group.attrs['crs'],
+                    eai_exp=group['eai_exp'][:],
+                    at_event=group['at_event'][:],
+                    tot_value=group.attrs['tot_value'],
+                    aai_agg=group.attrs['aai_agg'],
+                    unit=group.attrs['unit'],
+                    imp_mat=imp_mat,
+                    haz_type=group.attrs['haz_type']
+                )
+    return impacts
+
+
+def list_impacts(impact_dir: Union[str, Path]):
+    """
+    List the impacts available in a forecast's impact directory.
+
+    Handles both the compact per-storm files and the full per-country Impact
+    files. Compact files are only opened to read their group names. If a
+    storm has a compact file, any per-country files left from an earlier
+    calculation of that storm are ignored.
+
+    Returns
+    -------
+    impact_list : pd.DataFrame
+        One row per impact with columns tc_name, country_iso3, impact_type and file.
+    """
+    impact_files = sorted(os.listdir(impact_dir))
+    compact_storms = {f[:-len(COMPACT_IMPACT_SUFFIX)] for f in impact_files if f.endswith(COMPACT_IMPACT_SUFFIX)}
+    rows = []
+    for impact_file in impact_files:
+        if impact_file.endswith(COMPACT_IMPACT_SUFFIX):
+            tc_name = impact_file[:-len(COMPACT_IMPACT_SUFFIX)]
+            with h5py.File(Path(impact_dir, impact_file), 'r') as f:
+                for country_iso3, country_group in f.items():
+                    for impact_type in country_group.keys():
+                        rows.append((tc_name, country_iso3, impact_type, impact_file))
+        elif impact_file.endswith('.h5'):
+            tc_name, country_iso3, impact_type = impact_file.split('_')[:3]
+            if tc_name in compact_storms:
+                continue
+            rows.append((tc_name, country_iso3, impact_type, impact_file))
+    return pd.DataFrame(rows, columns=['tc_name', 'country_iso3', 'impact_type', 'file'])
+
+
+def remove_impacts(impact_dir: Union[str, Path]):
+    """
+    Delete the impact files of a forecast, compact and per-country, before
+    its impacts are calculated again.
+    """
+    for impact_file in os.listdir(impact_dir):
+        if impact_file.endswith('.h5'):
+            os.remove(Path(impact_dir, impact_file))
+
+
+def impact_keys(impact_list: pd.DataFrame):
+    """'tc_name/country_iso3/impact_type' of every impact in a list from list_impacts, as recorded in manifests"""
+    return [f"{r.tc_name}/{r.country_iso3}/{r.impact_type}" for r in impact_list.itertuples()]
+
+
+def iter_impacts(impact_dir: Union[str, Path],
+                 impact_list: pd.DataFrame = None):
+    """
+    Read all impacts in a forecast's impact directory, one at a time.
+
+    Each compact file is read once for all the impacts it holds.
+
+    Parameters
+    ----------
+    impact_dir: Union[str, Path]
+        The forecast's impact directory.
+    impact_list: pd.DataFrame
+        Output of list_impacts, if already available.
+
+    Yields
+    ------
+    tc_name, country_iso3, impact_type, impact : str, str, str, climada.engine.Impact
+    """
+    if impact_list is None:
+        impact_list = list_impacts(impact_dir)
+    for impact_file, file_impacts in impact_list.groupby('file', sort=False):
+        if impact_file.endswith(COMPACT_IMPACT_SUFFIX):
+            compact_impacts = read_compact_impacts(Path(impact_dir, impact_file))
+            for _, row in file_impacts.iterrows():
+                yield row['tc_name'], row['country_iso3'], row['impact_type'], compact_impacts[(row['country_iso3'], row['impact_type'])]
+        else:
+            row = file_impacts.iloc[0]
+            yield row['tc_name'], row['country_iso3'], row['impact_type'], Impact.from_hdf5(Path(impact_dir, impact_file))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Manifests of the outputs of each pipeline stage.
+
+When a stage finishes it writes FORECAST_DIR/manifests/<stage>.json listing
+every file it produced with its size and modification time (and checksum,
+if asked for), and what it expected to
+produce (e.g. the storms and the storm/country/impact type combinations).
+Whether a forecast is complete can then be checked from the manifests and
+one stat per file, without opening any outputs or repeating the listings.
+
+Manifests are kept apart from the stage outputs, so functions listing the
+outputs of a stage never see them.
+
+@author: Chris Fairless
+"""
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Union
+from datetime import datetime, timezone
+
+MANIFEST_DIR_NAME = "manifests"
+
+STAGE_OUTPUT_DIRS = {
+    'download_tracks': ['bufr', 'tracks'],
+    'analyse_tracks': ['analysis_tracks'],
+    'calculate_windfields': ['wind_fields'],
+    'analyse_windfields': ['analysis_wind_fields'],
+    'calculate_impacts': ['impacts'],
+    'analyse_impacts': ['analysis_impacts'],
+    'build_report': ['report'],
+}
+"""Output directories of each stage, relative to the forecast directory, in pipeline order."""
+
+PIPELINE_STAGES = list(STAGE_OUTPUT_DIRS)
+
+RECORD_CHECKSUMS = False
+"""Default for recording file checksums in manifests: checksums read every output again, so are off by default."""
+
+
+def file_digest(file_path: Union[str, Path]):
+    """SHA-256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_manifest_path(forecast_dir: Union[str, Path], stage: str):
+    return Path(forecast_dir, MANIFEST_DIR_NAME, f"{stage}.json")
+
+
+def list_stage_files(forecast_dir: Union[str, Path], stage: str):
+    """Files in a stage's output directories, relative to the forecast directory, sorted"""
+    files = []
+    for output_dir in STAGE_OUTPUT_DIRS[stage]:
+        for root, _, names in os.walk(Path(forecast_dir, output_dir)):
+            files.extend(Path(root, name).relative_to(forecast_dir).as_posix() for name in names)
+    return sorted(files)
+
+
+def write_stage_manifest(forecast_dir: Union[str, Path],
+                         stage: str,
+                         expected: dict = None,
+                         checksums: bool = None):
+    """
+    Record the outputs of a stage that has just finished.
+
+    Parameters
+    ----------
+    forecast_dir: Union[str, Path]
+        The forecast directory.
+    stage: str
+        One of PIPELINE_STAGES.
+    expected: dict
+        What the stage expected to produce, as lists of JSON-serialisable
+        values, e.g. {'storms': [...]}. Compared between stages by the checker.
+    checksums: bool
+        Also record the SHA-256 of every file, which means reading all of
+        them. Default: RECORD_CHECKSUMS
+
+    Returns
+    -------
+    manifest: dict
+    """
+    checksums = RECORD_CHECKSUMS if checksums is None else checksums
+    files = {}
+    for rel_path in list_stage_files(forecast_dir, stage):
+        path = Path(forecast_dir, rel_path)
+        stat = path.stat()
+        files[rel_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if checksums:
+            files[rel_path]['sha256'] = file_digest(path)
+
+    manifest = {
+        'stage': stage,
+        'time_str': Path(forecast_dir).name,
+        'created': datetime.now(timezone.utc).isoformat(timespec='microseconds'),
+        'expected': {key: sorted(values) for key, values in (expected or {}).items()},
+        'files': files
+    }
+    manifest_path = make_manifest_path(forecast_dir, stage)
+    os.makedirs(manifest_path.parent, exist_ok=True)
+    tmp_path = Path(manifest_path.parent, f".{manifest_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+
+def read_stage_manifest(forecast_dir: Union[str, Path], stage: str):
+    """The manifest of a stage, None if there is none"""
+    manifest_path = make_manifest_path(forecast_dir, stage)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def check_stage_files(forecast_dir: Union[str, Path],
+                      manifest: dict,
+                      verify_checksums: bool = False):
+    """
+    Compare a stage's outputs on disk with its manifest.
+
+    Parameters
+    ----------
+    forecast_dir: Union[str, Path]
+        The forecast directory.
+    manifest: dict
+        The stage's manifest, from read_stage_manifest.
+    verify_checksums: bool
+        Also read every file and compare its checksum, where the manifest
+        has one. Otherwise only existence, sizes and modification times are
+        checked, which needs one stat per file.
+
+    Returns
+    -------
+    problems: list of str
+        Empty if the outputs match the manifest.
+    """
+    problems = []
+    for rel_path, entry in manifest['files'].items():
+        path = Path(forecast_dir, rel_path)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            problems.append(f"missing file {rel_path}")
+            continue
+        if stat.st_size != entry['size']:
+            problems.append(f"size of {rel_path} is {stat.st_size}, expected {entry['size']}")
+        elif 'mtime_ns' in entry and stat.st_mtime_ns != entry['mtime_ns']:
+            problems.append(f"{rel_path} was modified after the manifest was written")
+        elif verify_checksums and 'sha256' in entry and file_digest(path) != entry['sha256']:
+            problems.append(f"checksum of {rel_path} does not match")
+
+    unlisted = set(list_stage_files(forecast_dir, manifest['stage'])) - set(manifest['files'])
+    problems.extend(f"file not in manifest {rel_path}" for rel_path in sorted(unlisted))
+    return problems
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timing and resource instrumentation of the pipeline stages.
+
+Stage functions are wrapped with instrument_stage, which directs metrics to
+FORECAST_DIR/metrics.jsonl for the duration of the stage. Inside a stage,
+key operations are wrapped with the timed context manager. Each stage and
+each operation appends one JSON line with its wall time, CPU time (of this
+process and of child processes that finished meanwhile), the peak resident
+memory of the process since the stage began, and item counts such as
+storms, members, centroids and countries.
+
+Outside a stage, timed does nothing, so instrumented functions can be
+called from anywhere. Worker processes forked while a stage runs log to the
+same file; each record is appended with a single write.
+
+@author: Chris Fairless
+"""
+import os
+import sys
+import json
+import time
+import resource
+import functools
+import pandas as pd
+from pathlib import Path
+from typing import Union
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+METRICS_FILE_NAME = "metrics.jsonl"
+
+_ACTIVE_LOG = None
+"""Metrics file of the stage running in this process, None outside stages."""
+
+_OPEN_TIMERS = []
+"""Names of the operations being timed, innermost last."""
+
+_OPEN_INFO = []
+"""Counts and labels of the operations being timed, innermost last."""
+
+
+def _reset_peak_rss():
+    """Reset the peak resident memory reported by the kernel (Linux only)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    """Peak resident memory of this process in MB: since the last reset where supported, else since it started"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 ** 2 if os.uname().sysname == "Darwin" else maxrss / 1024
+
+
+def _children_cpu_s():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def add_info(**info):
+    """Add counts or labels to the innermost operation being timed, e.g. add_info(storms=3)"""
+    if len(_OPEN_INFO) > 0:
+        _OPEN_INFO[-1].update(info)
+
+
+@contextmanager
+def timed(operation: str, **info):
+    """
+    Time an operation and append its metrics to the active metrics file.
+
+    Parameters
+    ----------
+    operation: str
+        Name of the operation, e.g. 'from_tracks'.
+    **info
+        Counts and labels, e.g. storm='MELISSA', members=51, centroids=120000.
+        More can be added while the operation runs with add_info.
+    """
+    if _ACTIVE_LOG is None:
+        yield
+        return
+
+    record = {
+        'time_str': Path(_ACTIVE_LOG).parent.name,
+        'stage': _OPEN_TIMERS[0] if len(_OPEN_TIMERS) > 0 else operation,
+        'operation': operation,
+        'parent': _OPEN_TIMERS[-1] if len(_OPEN_TIMERS) > 0 else None,
+        'pid': os.getpid(),
+        'start': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+    }
+    info = dict(info)
+    _OPEN_TIMERS.append(operation)
+    _OPEN_INFO.append(info)
+    wall_start, cpu_start, children_start = time.perf_counter(), time.process_time(), _children_cpu_s()
+    status, error = 'ok', None
+    try:
+        yield
+    except BaseException as e:
+        status, error = 'error', f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _OPEN_TIMERS.pop()
+        _OPEN_INFO.pop()
+        record.update({
+            'wall_s': round(time.perf_counter() - wall_start, 4),
+            'cpu_s': round(time.process_time() - cpu_start, 4),
+            'cpu_children_s': round(_children_cpu_s() - children_start, 4),
+            'peak_rss_mb': round(_peak_rss_mb(), 1),
+            'status': status,
+            'error': error,
+            'info': info
+        })
+        write_metrics_record(_ACTIVE_LOG, record)
+
+
+@contextmanager
+def stage_timer(forecast_dir: Union[str, Path], stage: str, **info):
+    """
+    Time a pipeline stage, directing the metrics of all operations timed
+    inside it to forecast_dir/metrics.jsonl.
+    """
+    global _ACTIVE_LOG
+    previous_log, previous_timers, previous_info = _ACTIVE_LOG, _OPEN_TIMERS[:], _OPEN_INFO[:]
+    _ACTIVE_LOG = Path(forecast_dir, METRICS_FILE_NAME)
+    _OPEN_TIMERS.clear()
+    _OPEN_INFO.clear()
+    _reset_peak_rss()
+    try:
+        with timed(stage, **info):
+            yield
+    finally:
+        _ACTIVE_LOG = previous_log
+        _OPEN_TIMERS[:] = previous_timers
+        _OPEN_INFO[:] = previous_info
+
+
+def instrument_stage(stage: str):
+    """
+    Decorator timing a stage function stage_func(time_str, ...) with stage_timer.
+
+    The metrics are written to WORKING_DIR/time_str/metrics.jsonl, with the
+    WORKING_DIR of the stage's module looked up when the stage runs, so that
+    it follows the module if it is pointed elsewhere (e.g. by the benchmarks).
+    """
+    def decorator(stage_func):
+        @functools.wraps(stage_func)
+        def wrapper(time_str, *args, **kwargs):
+            working_dir = sys.modules[stage_func.__module__].WORKING_DIR
+            with stage_timer(Path(working_dir, time_str), stage):
+                return stage_func(time_str, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_metrics_record(metrics_path: Union[str, Path], record: dict):
+    """
+    Append one record to a metrics file in a single write. Nothing is written
+    if the forecast directory does not exist, e.g. a stage failing its checks.
+    """
+    if not os.path.isdir(Path(metrics_path).parent):
+        return
+    line = json.dumps(record, default=str) + "\n"
+    with open(metrics_path, "a", encoding="utf-8") as f:
+        f.write(line)
+
+
+def read_metrics(metrics_path: Union[str, Path]):
+    """
+    Read a metrics file.
+
+    Returns
+    -------
+    df: DataFrame with one row per record, the info dicts in column 'info'.
+        Empty if the file does not exist.
+    """
+    if not os.path.exists(metrics_path):
+        return pd.DataFrame()
+    with open(metrics_path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return pd.DataFrame(records)
+
+
+def collect_metrics(working_dir: Union[str, Path]):
+    """
+    Read the metrics files of all forecasts in the working directory.
+
+    Returns
+    -------
+    df: DataFrame with one row per record, sorted by start time.
+    """
+    frames = [
+        read_metrics(Path(working_dir, p, METRICS_FILE_NAME))
+        for p in sorted(os.listdir(working_dir))
+        if p[0].isdigit() and len(p) == 14
+    ]
+    frames = [df for df in frames if len(df) > 0]
+    if len(frames) == 0:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True).sort_values('start', ignore_index=True)
+
+
+def latest_stage_runs(metrics: pd.DataFrame):
+    """
+    The last successful run of each stage of each forecast that did not skip
+    the work, from collect_metrics, with the forecast time as a datetime.
+    """
+    is_stage = (metrics['operation'] == metrics['stage']) & (metrics['status'] == 'ok')
+    skipped = metrics['info'].apply(lambda info: bool(info.get('skipped', False)))
+    runs = metrics[is_stage & ~skipped]
+    runs = runs.groupby(['time_str', 'stage'], sort=False).tail(1).reset_index(drop=True)
+    runs['forecast_time'] = pd.to_datetime(runs['time_str'], format='%Y%m%d%H%M%S')
+    return runs
+
+
+def find_outliers(stage_runs: pd.DataFrame, threshold: float = 3.5, min_wall_s: float = 60.):
+    """
+    Stage runs that took unusually long compared with the other runs of the stage.
+
+    A run is an outlier if its robust z-score, 0.6745 * (t - median) / MAD of
+    the stage's wall times t, exceeds threshold and it took at least min_wall_s.
+
+    Returns
+    -------
+    outliers: DataFrame of the outlying runs with the stage's median wall
+        time and the ratio to it, slowest relative to its stage first.
+    """
+    grouped = stage_runs.groupby('stage')['wall_s']
+    median = grouped.transform('median')
+    mad = (stage_runs['wall_s'] - median).abs().groupby(stage_runs['stage']).transform('median')
+    z = 0.6745 * (stage_runs['wall_s'] - median) / mad.where(mad > 0)
+    outliers = stage_runs.assign(median_wall_s=median, ratio=stage_runs['wall_s'] / median, z=z)
+    outliers = outliers[(outliers['z'] > threshold) & (outliers['wall_s'] >= min_wall_s)]
+    return outliers.sort_values('ratio', ascending=False)
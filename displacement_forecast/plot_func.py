@@ -6,10 +6,12 @@ Useful functions for plotting.
 @author: Pui Man (Mannie) Kam
 """
 
+import os
 import numpy as np
 import pandas as pd
 from typing import Union
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -20,25 +22,16 @@ from matplotlib.lines import Line2D
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import cartopy.crs as ccrs
 import cartopy.feature as cf
-import contextily as ctx
 import plotly.graph_objects as go
 
 from climada.hazard import TCTracks
 from climada.engine import Impact
 import climada.util.coordinates as u_coord
 
-SAFFIR_SIM_CAT = [17.49, 32.92, 42.7, 49.39, 58.13, 70.48, 1000]
-
-CAT_NAMES = {
-    -1: "Tropical Depression",
-    0: "Tropical Storm",
-    1: "Hurricane Cat. 1",
-    2: "Hurricane Cat. 2",
-    3: "Hurricane Cat. 3",
-    4: "Hurricane Cat. 4",
-    5: "Hurricane Cat. 5",
-}
-"""Saffir-Simpson category names."""
+from displacement_forecast.tc_tracks_func import SAFFIR_SIM_CAT, CAT_NAMES, categorize_wind
+from displacement_forecast.impact_calc_func import build_impact_analysis, grid_bounds, grid_to_raster
+from displacement_forecast.basemap_func import add_basemap
+from displacement_forecast.metrics_func import timed
 
 CAT_COLORS = cm_mp.rainbow(np.linspace(0, 1, len(SAFFIR_SIM_CAT)))
 """Color scale to plot the Saffir-Simpson scale."""
@@ -47,6 +40,12 @@ CUSTOM_LEGEND = ["Tropical Depression", "Tropical Storm",
                  "Hurricane Cat. 1", "Hurricane Cat. 2", "Hurricane Cat. 3",
                  "Hurricane Cat. 4", "Hurricane Cat. 5"]
 
+N_RENDER_WORKERS = 1
+"""Default number of worker processes used to render figures. With 1, figures are drawn in the calling process."""
+
+GLOBAL_EXTENT = [-180, 180, -80, 80]
+"""Extent of the global track maps (lon min, lon max, lat min, lat max)."""
+
 cmap = ListedColormap(colors=CAT_COLORS)
 cmap_hex = []
 for i in range(cmap.N):
@@ -55,34 +54,15 @@ for i in range(cmap.N):
     cmap_hex.append(mpl.colors.rgb2hex(rgba))
 
 
-def categorize_wind(speed):
-    """Saffir-Simpson Hurricane Scale"""
-    if speed < 17.49:
-        return -1  # Tropical depression
-    elif speed < 32.92:
-        return 0  # Tropical storm
-    elif speed < 42.7:
-        return 1  # Category 1
-    elif speed < 49.39:
-        return 2  # Category 2
-    elif speed < 58.13:
-        return 3  # Category 3
-    elif speed < 70.48:
-        return 4  # Category 4
-    elif speed < 1000:
-        return 5  # Category 5
-    else:
-        return 999
-
-def plot_global_tracks(tc_tracks: TCTracks, figsize=(15,8)):
-    """Plot the global forecast TC tracks"""
+def draw_base_map(figsize=(15,8)):
+    """Draw the global cartopy base map: coastlines, borders, land, grid lines and legend"""
     # define the figure and figure extent
     fig = plt.figure(figsize=figsize)
     axis = plt.axes(projection=ccrs.PlateCarree())
     axis.add_feature(cf.COASTLINE, color='k',lw=.5)
     axis.add_feature(cf.BORDERS, color="k", lw=.3)
     axis.add_feature(cf.LAND, facecolor="rosybrown", alpha=.2)
-    axis.set_extent([-180, 180, -80, 80], crs=ccrs.PlateCarree())
+    axis.set_extent(GLOBAL_EXTENT, crs=ccrs.PlateCarree())
 
     # grid lines on the lat lon
     gl = axis.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
@@ -92,8 +72,20 @@ def plot_global_tracks(tc_tracks: TCTracks, figsize=(15,8)):
     axis.xlabels_top = False
     axis.ylabels_right = False
 
+    leg_lines = [Line2D([0], [0], color=CAT_COLORS[i_col], lw=2)
+                for i_col in range(len(SAFFIR_SIM_CAT))]
+    leg_names = [CAT_NAMES[i_col] for i_col in sorted(CAT_NAMES.keys())]
+    axis.legend(leg_lines, leg_names, loc=3, fontsize=12)
+
+    plt.tight_layout()
+
+    return axis
+
+def plot_global_tracks(tc_tracks: TCTracks, figsize=(15,8)):
+    """Plot the global forecast TC tracks"""
+    axis = draw_base_map(figsize)
+
     # plot the tracks
-    synth_flag = False
     cmap = ListedColormap(colors=CAT_COLORS)
     norm = BoundaryNorm([0] + SAFFIR_SIM_CAT, len(SAFFIR_SIM_CAT))
 
@@ -109,41 +101,11 @@ def plot_global_tracks(tc_tracks: TCTracks, figsize=(15,8)):
         track_lc.set_array(track.max_sustained_wind.values)
         axis.add_collection(track_lc)
 
-    leg_lines = [Line2D([0], [0], color=CAT_COLORS[i_col], lw=2)
-                for i_col in range(len(SAFFIR_SIM_CAT))]
-    leg_names = [CAT_NAMES[i_col] for i_col in sorted(CAT_NAMES.keys())]
-    axis.legend(leg_lines, leg_names, loc=3, fontsize=12)
-
-    plt.tight_layout()
-
     return axis
 
 def plot_empty_base_map(figsize=(15,8)):
     """Empty base map if no active storm"""
-    # define the figure and figure extent
-    fig = plt.figure(figsize=figsize)
-    axis = plt.axes(projection=ccrs.PlateCarree())
-    axis.add_feature(cf.COASTLINE, color='k',lw=.5)
-    axis.add_feature(cf.BORDERS, color="k", lw=.3)
-    axis.add_feature(cf.LAND, facecolor="rosybrown", alpha=.2)
-    axis.set_extent([-180, 180, -80, 80], crs=ccrs.PlateCarree())
-
-    # grid lines on the lat lon
-    gl = axis.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
-                  linewidth=.5, color='gray', alpha = 0.25,
-                  linestyle='--')
-    # labels on bottom and left axes
-    axis.xlabels_top = False
-    axis.ylabels_right = False
-
-    leg_lines = [Line2D([0], [0], color=CAT_COLORS[i_col], lw=2)
-                for i_col in range(len(SAFFIR_SIM_CAT))]
-    leg_names = [CAT_NAMES[i_col] for i_col in sorted(CAT_NAMES.keys())]
-    axis.legend(leg_lines, leg_names, loc=3, fontsize=12)
-
-    plt.tight_layout()
-
-    return axis
+    return draw_base_map(figsize)
 
 def plot_interactive_map(tc_tracks: TCTracks, figsize=(15,8)):
     """Interactive map for global forecast TC tracks"""
@@ -154,7 +116,7 @@ def plot_interactive_map(tc_tracks: TCTracks, figsize=(15,8)):
             'lon': track['lon'],
             'lat': track['lat'],
             'wind_speed': track['max_sustained_wind'],
-            'category': [categorize_wind(ws) for ws in track['max_sustained_wind']]
+            'category': categorize_wind(track['max_sustained_wind'].values)
         })
 
         for i in range(len(df) - 1):
@@ -274,18 +236,20 @@ def make_save_histogram_file_name(imp_summary_dict: dict):
     return forecast_filename
 
 def plot_imp_map_exposed(impact_summary_dict: dict,
-                         impact: Impact):
-    """Plot the ensemble average map for exposed population"""
+                         impact: Impact,
+                         impact_analysis: dict = None):
+    """
+    Plot the ensemble average map for exposed population. The impact is
+    only used if impact_analysis is None.
+    """
 
-    impact_exp = impact._build_exp()
+    if impact_analysis is None:
+        impact_analysis = build_impact_analysis(impact)
+    grid = impact_analysis["grid"]
 
-    # extent = impact_exp.gdf[impact_exp.gdf['value'] != 0].geometry.to_crs(epsg=3857).total_bounds
-    extent = impact_exp.gdf[impact.eai_exp > 0].geometry.to_crs(epsg=3857).total_bounds
+    extent = grid_bounds(grid)
     extent = standardise_extent(extent)
 
-    impact_exp.to_crs("EPSG:3857", inplace=True)
-    gdf = impact_exp.gdf
-
     cmap = plt.get_cmap("YlOrBr")
     n = 256  # Number of discrete colors in the colormap
     vals = cmap(np.linspace(0, 1, n))
@@ -294,38 +258,21 @@ def plot_imp_map_exposed(impact_summary_dict: dict,
     # Make values below 10 transparent
     threshold = 10
     alphas = np.ones(n) * 0.7
-    alphas[:int(threshold / np.max(gdf["value"]) * n)] = 0.0
+    alphas[:int(threshold / impact_analysis["max"] * n)] = 0.0
     vals[:, -1] = alphas
 
     transparent_cmap = ListedColormap(vals)
 
     fig, ax = plt.subplots()
 
-    vmax = np.max(gdf["value"])
+    vmax = impact_analysis["max"]
     vmin = threshold  # Start normalization from threshold
 
     norm = Normalize(vmin=vmin, vmax=vmax)
 
-    if gdf.shape[0] > 1:
-        d_lat = np.diff(np.sort(gdf.geometry.x))
-        d_lat = d_lat[d_lat != 0].min()
-        gridsize = int(np.ceil((extent[2] - extent[0]) / (4 * d_lat)))
-    else:
-        gridsize = 0.2
-
-    hb = ax.hexbin(
-        x=gdf.geometry.x,
-        y=gdf.geometry.y,
-        C=gdf["value"],
-        reduce_C_function=np.sum,
-        norm=norm,
-        gridsize=gridsize,
-        extent=(extent[0], extent[2], extent[1], extent[3]),
-        lw=0.0,
-        cmap=transparent_cmap,
-    )
+    hb = plot_grid(ax, grid, extent, norm, transparent_cmap)
 
-    ctx.add_basemap(ax, source=ctx.providers.CartoDB.Positron)
+    add_basemap(ax)
 
     ax.tick_params(left=False, labelleft=False, bottom=False, labelbottom=False)
 
@@ -337,8 +284,8 @@ def plot_imp_map_exposed(impact_summary_dict: dict,
     )
 
     # get information for the title
-    mean = int(np.mean(impact.at_event))
-    std = int(np.std(impact.at_event))
+    mean = int(impact_analysis["mean"])
+    std = int(impact_analysis["std"])
 
     # box with information
     ax.text(
@@ -356,17 +303,20 @@ def plot_imp_map_exposed(impact_summary_dict: dict,
     return ax
 
 def plot_imp_map_displacement(impact_summary_dict: dict,
-                              impact: Impact):
-    """Plot the ensemble average map for displacement"""
+                              impact: Impact,
+                              impact_analysis: dict = None):
+    """
+    Plot the ensemble average map for displacement. The impact is only used
+    if impact_analysis is None.
+    """
 
-    impact_exp = impact._build_exp()
+    if impact_analysis is None:
+        impact_analysis = build_impact_analysis(impact)
+    grid = impact_analysis["grid"]
 
-    extent = impact_exp.gdf[impact_exp.gdf['value'] != 0].geometry.to_crs(epsg=3857).total_bounds
+    extent = grid_bounds(grid)
     extent = standardise_extent(extent)
 
-    impact_exp.to_crs("EPSG:3857", inplace=True)
-    gdf = impact_exp.gdf
-
     cmap = plt.get_cmap("YlOrBr")
     n = 256  # Number of discrete colors in the colormap
     vals = cmap(np.linspace(0, 1, n))
@@ -375,39 +325,21 @@ def plot_imp_map_displacement(impact_summary_dict: dict,
     # Make values below 10 transparent
     threshold = 10
     alphas = np.ones(n) * 0.7
-    alphas[:int(threshold / np.max(gdf["value"]) * n)] = 0.0
+    alphas[:int(threshold / impact_analysis["max"] * n)] = 0.0
     vals[:, -1] = alphas
 
     transparent_cmap = ListedColormap(vals)
 
     fig, ax = plt.subplots()
 
-    vmax = np.max(gdf["value"])
+    vmax = impact_analysis["max"]
     vmin = threshold  # Start normalization from threshold
 
     norm = Normalize(vmin=vmin, vmax=vmax)
 
-    d_lat = np.diff(np.sort(gdf.geometry.x))
+    hb = plot_grid(ax, grid, extent, norm, transparent_cmap)
 
-    if gdf.shape[0] > 1:
-        d_lat = d_lat[d_lat != 0].min()
-        gridsize = int(np.ceil((extent[2] - extent[0]) / (4 * d_lat)))
-    else:
-        gridsize = 0.2
-    
-    hb = ax.hexbin(
-        x=gdf.geometry.x,
-        y=gdf.geometry.y,
-        C=gdf["value"],
-        reduce_C_function=np.sum,
-        norm=norm,
-        gridsize=gridsize,
-        extent=(extent[0], extent[2], extent[1], extent[3]),
-        lw=0.0,
-        cmap=transparent_cmap,
-    )
-
-    ctx.add_basemap(ax, source=ctx.providers.CartoDB.Positron)
+    add_basemap(ax)
 
     ax.tick_params(left=False, labelleft=False, bottom=False, labelbottom=False)
 
@@ -419,8 +351,8 @@ def plot_imp_map_displacement(impact_summary_dict: dict,
     )
 
     # get information for the title
-    mean = int(np.mean(impact.at_event))
-    std = int(np.std(impact.at_event))
+    mean = int(impact_analysis["mean"])
+    std = int(impact_analysis["std"])
 
     # box with information
     ax.text(
@@ -440,17 +372,20 @@ def plot_imp_map_displacement(impact_summary_dict: dict,
 
 def plot_map_cat(impact_summary_dict: dict,
                  impact: Impact,
-                 category: int):
-    """Plot the proportion of ensemble members exceeding cat 1"""
+                 category: int,
+                 impact_analysis: dict = None):
+    """
+    Plot the proportion of ensemble members exceeding cat 1. The impact is
+    only used if impact_analysis is None.
+    """
 
-    impact_exp = impact._build_exp()
+    if impact_analysis is None:
+        impact_analysis = build_impact_analysis(impact, reduce='max')
+    grid = impact_analysis["grid"]
 
-    extent = impact_exp.gdf[impact_exp.gdf['value'] != 0].geometry.to_crs(epsg=3857).total_bounds
+    extent = grid_bounds(grid)
     extent = standardise_extent(extent)
 
-    impact_exp.to_crs("EPSG:3857", inplace=True)
-    gdf = impact_exp.gdf
-
     cmap = plt.get_cmap("turbo")
     n = 256  # Number of discrete colors in the colormap
     vals = cmap(np.linspace(0, 1, n))
@@ -459,39 +394,21 @@ def plot_map_cat(impact_summary_dict: dict,
     # Make values below 0.01 transparent
     threshold = 0.01
     alphas = np.ones(n) * 0.7
-    alphas[:int(threshold / np.max(gdf["value"]) * n)] = 0.0
+    alphas[:int(threshold / impact_analysis["max"] * n)] = 0.0
     vals[:, -1] = alphas
 
     transparent_cmap = ListedColormap(vals)
 
     fig, ax = plt.subplots()
 
-    vmax = np.max(gdf["value"])
+    vmax = impact_analysis["max"]
     vmin = threshold  # Start normalization from threshold
 
     norm = Normalize(vmin=0, vmax=1)
 
-    d_lat = np.diff(np.sort(gdf.geometry.x))
+    hb = plot_grid(ax, grid, extent, norm, transparent_cmap)
 
-    if gdf.shape[0] > 1:
-        d_lat = d_lat[d_lat != 0].min()
-        gridsize = int(np.ceil((extent[2] - extent[0]) / (2 * d_lat)))
-    else:
-        gridsize = 0.2
-
-    hb = ax.hexbin(
-        x=gdf.geometry.x,
-        y=gdf.geometry.y,
-        C=gdf["value"],
-        reduce_C_function=np.max,
-        norm=norm,
-        gridsize=gridsize,
-        extent=(extent[0], extent[2], extent[1], extent[3]),
-        lw=0.0,
-        cmap=transparent_cmap,
-    )
-
-    ctx.add_basemap(ax, source=ctx.providers.CartoDB.Positron)
+    add_basemap(ax)
 
     ax.tick_params(left=False, labelleft=False, bottom=False, labelbottom=False)
 
@@ -519,20 +436,24 @@ def plot_map_cat(impact_summary_dict: dict,
 
 
 def plot_histogram(impact_summary_dict: dict,
-                    impact: Impact):
+                    impact: Impact,
+                    impact_analysis: dict = None):
     
-    """plot the histogram"""
+    """plot the histogram. The impact is only used if impact_analysis is None."""
+    at_event = impact.at_event if impact_analysis is None else impact_analysis["at_event"]
+    mean = np.mean(at_event) if impact_analysis is None else impact_analysis["mean"]
+
     num_bins = 40
-    data_range = impact.at_event.max() - impact.at_event.min()
+    data_range = at_event.max() - at_event.min()
     bin_width = data_range / num_bins
 
     # Calculate adaptive bins based on the data range
-    bins = np.arange(impact.at_event.min(), 
-                     impact.at_event.max() + bin_width, 
+    bins = np.arange(at_event.min(), 
+                     at_event.max() + bin_width, 
                      bin_width)
     
     # Calculate histogram values and normalize them to probabilities
-    hist_values, bin_edges = np.histogram(impact.at_event, bins=bins)
+    hist_values, bin_edges = np.histogram(at_event, bins=bins)
     bin_probabilities = hist_values / hist_values.sum() *100  # Normalize to probabilities
     
     fig, ax = plt.subplots(1,1,figsize=(6,4))
@@ -552,7 +473,7 @@ def plot_histogram(impact_summary_dict: dict,
                 impact_summary_dict["initializationTime"],
                 color='red', fontsize=10, ha='right')
     plt.figtext(0.9,0.9,
-                f'Mean: {int(np.mean(impact.at_event))}',
+                f'Mean: {int(mean)}',
                 color='k', fontsize=10, ha='right')
     
     spines = ["top","right","left","bottom"]
@@ -562,6 +483,88 @@ def plot_histogram(impact_summary_dict: dict,
     return ax
 
 
+def plot_inputs(impact_analysis: dict):
+    """
+    The parts of an impact analysis (see impact_calc_func.build_impact_analysis)
+    used by the impact maps and histograms: all but the exposure GeoDataFrame.
+    Jobs pass this with impact None, so that render workers receive only the
+    gridded values and member impacts, and the impact can be released before
+    rendering.
+    """
+    return {key: value for key, value in impact_analysis.items() if key != "gdf"}
+
+
+def plot_stage_durations(stage_runs: pd.DataFrame, stages: list = None, figsize=(12,6)):
+    """
+    Wall time of each pipeline stage per forecast (see metrics_func.latest_stage_runs),
+    with a rolling median over 14 forecasts.
+    """
+    stages = list(stage_runs['stage'].unique()) if stages is None else stages
+    fig, ax = plt.subplots(1,1,figsize=figsize)
+    for i, stage in enumerate(stages):
+        runs = stage_runs[stage_runs['stage'] == stage].sort_values('forecast_time')
+        if len(runs) == 0:
+            continue
+        minutes = runs['wall_s'] / 60
+        color = plt.cm.tab10(i % 10)
+        ax.scatter(runs['forecast_time'], minutes, s=8, color=color, alpha=0.4)
+        ax.plot(runs['forecast_time'], minutes.rolling(14, min_periods=1, center=True).median(),
+                color=color, lw=1.5, label=stage)
+    ax.set_yscale('log')
+    ax.set_ylabel('Wall time (minutes)')
+    ax.set_xlabel('Forecast time')
+    ax.set_title('Stage durations per forecast (points) and 14-forecast rolling median (lines)')
+    ax.grid(visible=True, which='major', alpha=0.5)
+    ax.legend(loc='upper left', fontsize=8)
+    fig.autofmt_xdate()
+    return ax
+
+
+def plot_windfield_scaling(wind_runs: pd.DataFrame, figsize=(7,5)):
+    """
+    Wall time of each storm's wind field calculation ('from_tracks' metrics)
+    against its number of members x centroids, with a power law fit.
+    """
+    size = wind_runs['members'] * wind_runs['centroids']
+    fig, ax = plt.subplots(1,1,figsize=figsize)
+    ax.scatter(size, wind_runs['wall_s'], s=10, color='steelblue', alpha=0.6)
+    valid = (size > 0) & (wind_runs['wall_s'] > 0)
+    if valid.sum() >= 3:
+        slope, intercept = np.polyfit(np.log10(size[valid]), np.log10(wind_runs['wall_s'][valid]), 1)
+        x = np.logspace(np.log10(size[valid].min()), np.log10(size[valid].max()), 50)
+        ax.plot(x, 10 ** intercept * x ** slope, color='k', lw=1,
+                label=f'time ~ (members x centroids)^{slope:.2f}')
+        ax.legend(loc='upper left', fontsize=8)
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    ax.set_xlabel('Members x centroids')
+    ax.set_ylabel('Wall time (s)')
+    ax.set_title('Wind field calculation time per storm')
+    ax.grid(visible=True, which='major', alpha=0.5)
+    return ax
+
+
+def plot_grid(ax, grid: dict, extent, norm, cmap):
+    """
+    Draw a gridded impact layer (see impact_calc_func.aggregate_to_grid) as an
+    image and set the axis limits to extent (xmin, ymin, xmax, ymax).
+    """
+    raster, raster_extent = grid_to_raster(grid)
+    im = ax.imshow(
+        raster,
+        extent=raster_extent,
+        origin="lower",
+        aspect="auto",
+        interpolation="nearest",
+        zorder=1,
+        norm=norm,
+        cmap=cmap,
+    )
+    ax.set_xlim(extent[0], extent[2])
+    ax.set_ylim(extent[1], extent[3])
+    return im
+
+
 def standardise_extent(extent, min_dimension = 500000):
     plot_size = np.max([min_dimension, extent[2] - extent[0], extent[3] - extent[1]])
     extent[0], extent[2] = buffer_dimension((extent[0], extent[2]), plot_size)
@@ -575,3 +578,80 @@ def buffer_dimension(bounds, target_size):
     new_min = midpoint - 0.5 * target_size
     new_max = midpoint + 0.5 * target_size
     return (new_min, new_max)
+
+
+def _init_render_worker():
+    """Render worker setup: draw with the non-interactive Agg backend."""
+    mpl.use("Agg")
+
+
+def render_plot(plot_func, args, save_path):
+    """
+    Draw one figure with plot_func(*args), save it to save_path and close it.
+
+    Every pyplot figure opened while drawing is closed, also when drawing
+    fails.
+
+    Returns
+    -------
+    save_path: the path of the saved figure.
+    """
+    open_figures = set(plt.get_fignums())
+    try:
+        with timed('plot', plot=plot_func.__name__, file=os.path.basename(save_path)):
+            ax = plot_func(*args)
+            ax.figure.savefig(save_path)
+    finally:
+        for num in set(plt.get_fignums()) - open_figures:
+            plt.close(num)
+    return save_path
+
+
+def render_plots(jobs: list, n_workers: int = None):
+    """
+    Render a batch of figures, in parallel worker processes when there is more than one.
+
+    Each job is a tuple (plot_func, args, save_path) where plot_func is a
+    module-level function returning a matplotlib axis and save_path is its
+    output file, named with make_save_map_file_name or
+    make_save_histogram_file_name so that output does not depend on which
+    worker draws it. matplotlib and cartopy are imported once per
+    worker when this module loads, and every worker uses the Agg backend.
+
+    Parameters
+    ----------
+    jobs: list
+        Figure jobs (plot_func, args, save_path).
+    n_workers: int
+        Number of worker processes. Default: N_RENDER_WORKERS. With 1, or a
+        single job, figures are drawn in this process.
+
+    Returns
+    -------
+    failures: list
+        (save_path, exception) for every job that failed. All other jobs are
+        rendered regardless of failures.
+    """
+    n_workers = N_RENDER_WORKERS if n_workers is None else n_workers
+    failures = []
+
+    if n_workers <= 1 or len(jobs) <= 1:
+        for plot_func, args, save_path in jobs:
+            try:
+                render_plot(plot_func, args, save_path)
+            except Exception as e:
+                failures.append((save_path, e))
+        return failures
+
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(jobs)),
+                             initializer=_init_render_worker) as pool:
+        futures = [
+            (save_path, pool.submit(render_plot, plot_func, args, save_path))
+            for plot_func, args, save_path in jobs
+        ]
+        for save_path, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failures.append((save_path, e))
+    return failures
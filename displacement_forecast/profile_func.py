@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of the pipeline stages.
+
+A stage run inside profile_stage with one or more PROFILE_MODES writes its
+profiles to FORECAST_DIR/profiles:
+    'cprofile': <stage>.prof, a cProfile dump for pstats or snakeviz, and
+        <stage>_cprofile.txt, the functions with the most cumulative time.
+    'pyspy': <stage>_flamegraph.svg, a sampling flame graph recorded by
+        py-spy, including worker processes. Needs the py-spy executable and
+        permission to trace the process (in Docker: --cap-add SYS_PTRACE).
+    'tracemalloc': <stage>_tracemalloc.txt, the peak traced memory and the
+        lines and call stacks that allocated the most memory still held at
+        the end of the stage.
+
+cProfile and tracemalloc only see the main process, not pool workers.
+Each profiled run replaces the stage's previous profiles. Without any modes
+profile_stage is a nullcontext, so profiling costs nothing unless asked for.
+
+@author: Chris Fairless
+"""
+import io
+import os
+import time
+import shutil
+import signal
+import pstats
+import cProfile
+import subprocess
+import tracemalloc
+from pathlib import Path
+from typing import Union
+from contextlib import contextmanager, nullcontext, ExitStack
+
+PROFILE_DIR_NAME = "profiles"
+
+PROFILE_MODES = ['cprofile', 'pyspy', 'tracemalloc']
+
+DEFAULT_PROFILE_MODES = ['cprofile', 'tracemalloc']
+"""Modes used when profiling is requested without naming any: those that need nothing installed."""
+
+N_TOP = 40
+"""Functions and allocation sites listed in the text summaries."""
+
+TRACEMALLOC_FRAMES = 10
+"""Depth of the call stacks recorded by tracemalloc. Deeper stacks are slower to record."""
+
+PYSPY_RATE = 100
+"""py-spy samples per second."""
+
+
+def profile_stage(forecast_dir: Union[str, Path], stage: str, modes: list = None):
+    """
+    Context manager profiling the code run inside it as one pipeline stage.
+
+    Parameters
+    ----------
+    forecast_dir: Union[str, Path]
+        The forecast directory: profiles go to its profiles subdirectory.
+    stage: str
+        Name of the stage, used in the file names.
+    modes: list
+        Any of PROFILE_MODES. If empty or None, nothing is profiled.
+    """
+    if not modes:
+        return nullcontext()
+    unknown = set(modes) - set(PROFILE_MODES)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown profile modes {sorted(unknown)}: use any of {PROFILE_MODES}")
+    return _profile_stage(Path(forecast_dir, PROFILE_DIR_NAME), stage, modes)
+
+
+@contextmanager
+def _profile_stage(profile_dir: Path, stage: str, modes: list):
+    os.makedirs(profile_dir, exist_ok=True)
+    with ExitStack() as stack:
+        # cProfile innermost, so that it doesn't profile the other profilers starting and writing out
+        if 'pyspy' in modes:
+            stack.enter_context(_pyspy_profile(Path(profile_dir, f"{stage}_flamegraph.svg")))
+        if 'tracemalloc' in modes:
+            stack.enter_context(_tracemalloc_profile(Path(profile_dir, f"{stage}_tracemalloc.txt")))
+        if 'cprofile' in modes:
+            stack.enter_context(_cprofile_profile(Path(profile_dir, f"{stage}.prof"),
+                                                  Path(profile_dir, f"{stage}_cprofile.txt")))
+        yield
+    print(f"Profiles of {stage} written to {profile_dir}")
+
+
+@contextmanager
+def _cprofile_profile(dump_path: Path, summary_path: Path):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(dump_path)
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(N_TOP)
+        stats.sort_stats('tottime').print_stats(N_TOP)
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            f.write(stream.getvalue())
+
+
+@contextmanager
+def _tracemalloc_profile(summary_path: Path):
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        if not already_tracing:
+            tracemalloc.stop()
+        write_tracemalloc_summary(summary_path, snapshot, current, peak, seconds)
+
+
+def write_tracemalloc_summary(summary_path: Union[str, Path], snapshot, current: int, peak: int, seconds: float):
+    """Write the peak traced memory and the top allocation sites and call stacks of a tracemalloc snapshot"""
+    lines = [
+        f"Traced for {seconds:.1f}s",
+        f"Peak traced memory: {peak / 1024 ** 2:.1f} MB",
+        f"Traced memory at the end: {current / 1024 ** 2:.1f} MB",
+        "",
+        f"Top {N_TOP} lines by memory held at the end:",
+    ]
+    for stat in snapshot.statistics('lineno')[:N_TOP]:
+        frame = stat.traceback[0]
+        lines.append(f"{stat.size / 1024 ** 2:10.1f} MB {stat.count:9d} blocks  {frame.filename}:{frame.lineno}")
+
+    lines += ["", f"Top {N_TOP // 4} call stacks by memory held at the end:"]
+    for stat in snapshot.statistics('traceback')[:N_TOP // 4]:
+        lines.append(f"{stat.size / 1024 ** 2:.1f} MB in {stat.count} blocks")
+        lines.extend("    " + line for line in stat.traceback.format(most_recent_first=True))
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+@contextmanager
+def _pyspy_profile(output_path: Path):
+    pyspy = shutil.which('py-spy')
+    if pyspy is None:
+        print("py-spy is not installed: no flame graph recorded. Install it with pip install py-spy")
+        yield
+        return
+    process = subprocess.Popen(
+        [pyspy, 'record', '--pid', str(os.getpid()), '--output', str(output_path), '--format', 'flamegraph',
+         '--rate', str(PYSPY_RATE), '--subprocesses', '--nonblocking'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    try:
+        yield
+    finally:
+        # py-spy writes the flame graph when interrupted
+        process.send_signal(signal.SIGINT)
+        try:
+            _, stderr = process.communicate(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            _, stderr = process.communicate()
+        if not os.path.exists(output_path):
+            print(f"py-spy did not record a flame graph: {stderr.strip()}")
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Web Mercator (EPSG:3857) coordinates for mapping.
+
+The impact maps and gridded outputs project the exposure points of a
+country with the spherical Web Mercator formulas, vectorised over all
+points. This is as fast as looking the points up in a cache keyed by their
+coordinates would be, so nothing is cached.
+
+@author: Chris Fairless
+"""
+import numpy as np
+
+EARTH_RADIUS = 6378137.
+"""Sphere radius (m) of Web Mercator."""
+
+MAX_LAT = 85.0511287798
+"""Latitude limit of Web Mercator: points further north or south are clipped to it."""
+
+
+def lonlat_to_mercator(lon: np.ndarray, lat: np.ndarray):
+    """Web Mercator x, y (m) of lon/lat coordinates (degrees)"""
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -MAX_LAT, MAX_LAT)
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def mercator_to_lonlat(x: np.ndarray, y: np.ndarray):
+    """lon/lat coordinates (degrees) of Web Mercator x, y (m)"""
+    lon = np.degrees(np.asarray(x, dtype=np.float64) / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(np.asarray(y, dtype=np.float64) / EARTH_RADIUS)) - np.pi / 2)
+    return lon, lat
+
+
+def get_projected_coordinates(lat: np.ndarray, lon: np.ndarray):
+    """
+    Web Mercator coordinates of a set of points and their spacing.
+
+    Parameters
+    ----------
+    lat, lon: np.ndarray
+        Point coordinates (degrees).
+
+    Returns
+    -------
+    x, y: np.ndarray
+        Projected coordinates (m).
+    spacing: float
+        Smallest non-zero distance (m) between distinct x coordinates, NaN for
+        a single column of points.
+    """
+    x, y = lonlat_to_mercator(lon, lat)
+    dx = np.diff(np.unique(x))
+    spacing = dx.min() if dx.size > 0 else np.nan
+    return x, y, spacing
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Useful functions for building the forecast reports.
+
+A report is modelled in memory as a list of sections, each a template
+fragment from reporting_templates/report and the values to fill it with.
+The whole report is rendered once with jinja2 and written in a single write.
+
+Markdown is converted to HTML in-process with the markdown package. The
+'pandoc' renderer runs the pandoc executable instead, e.g. to compare output.
+
+Images are added to reports with add_report_asset: copied, symlinked to the
+analysis output, or (by default) hard-linked from a content-addressed store
+so that identical images are stored once however often reports are rebuilt.
+
+Every report built is recorded in a catalog, a SQLite database with one row
+of summary statistics per forecast, from which the index pages are built
+without visiting the forecast directories.
+
+@author: Chris Fairless
+"""
+import os
+import json
+import shutil
+import sqlite3
+import subprocess
+import pandas as pd
+from pathlib import Path
+from typing import Union
+from functools import lru_cache
+
+import jinja2
+import markdown
+
+from displacement_forecast.manifest_func import file_digest
+from displacement_forecast.metrics_func import timed
+
+REPORT_TEMPLATE_DIR = Path(Path(__file__).parent.parent, 'reporting_templates', 'report')
+
+HTML_RENDERERS = ['markdown', 'pandoc']
+"""Ways of converting Markdown reports to HTML: in-process, or with the pandoc executable."""
+
+MARKDOWN_EXTENSIONS = ['tables']
+
+_MARKDOWN = None
+"""Markdown converter, created once per process and reset between documents."""
+
+ASSET_MODES = ['hardlink', 'symlink', 'copy']
+"""Ways of adding images to a report: hard link from the asset store, symlink to the analysis output, or copy."""
+
+REPORT_CATALOG_NAME = "report_catalog.sqlite"
+
+REPORT_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    time_str TEXT PRIMARY KEY,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    forecast_time TEXT,
+    number_active INTEGER,
+    storm_names TEXT,
+    number_affecting_people INTEGER,
+    number_displacing_people INTEGER,
+    storms_affecting_people TEXT,
+    storms_displacing_people TEXT,
+    url TEXT
+);
+CREATE INDEX IF NOT EXISTS reports_year_month ON reports (year, month, time_str);
+CREATE TABLE IF NOT EXISTS catalog_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+CATALOG_LIST_COLUMNS = ['storm_names', 'storms_affecting_people', 'storms_displacing_people']
+"""Catalog columns holding lists, stored as JSON."""
+
+
+@lru_cache(maxsize=None)
+def get_template_environment(template_dir: Union[str, Path] = REPORT_TEMPLATE_DIR):
+    """jinja2 environment loading the templates of a directory. Templates are compiled once per process."""
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(str(template_dir)),
+        undefined=jinja2.StrictUndefined,
+        keep_trailing_newline=True,
+        autoescape=False
+    )
+
+
+def report_section(template_name: str, **context):
+    """
+    One section of a report.
+
+    Parameters
+    ----------
+    template_name: str
+        File name of the template fragment, e.g. 'exposed.md'.
+    **context
+        Values of the placeholders in the fragment.
+
+    Returns
+    -------
+    section: dict
+    """
+    return {'template': template_name, 'context': context}
+
+
+def render_report(sections: list, template_dir: Union[str, Path] = REPORT_TEMPLATE_DIR):
+    """
+    Render the sections of a report, in order, into one Markdown document.
+    Each fragment is followed by a blank line.
+    """
+    env = get_template_environment(template_dir)
+    return ''.join(
+        env.get_template(section['template']).render(**section['context']) + '\n'
+        for section in sections
+    )
+
+
+def write_report(file_path: Union[str, Path],
+                 sections: list,
+                 template_dir: Union[str, Path] = REPORT_TEMPLATE_DIR):
+    """Render the sections of a report and write it to file_path in one write"""
+    content = render_report(sections, template_dir)
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    return content
+
+
+def markdown_to_html(text: str):
+    """Convert a Markdown document to an HTML fragment, in-process"""
+    global _MARKDOWN
+    if _MARKDOWN is None:
+        _MARKDOWN = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+    html = _MARKDOWN.reset().convert(text)
+    return html + '\n'
+
+
+def write_html(md_path: Union[str, Path],
+               html_path: Union[str, Path],
+               renderer: str = 'markdown',
+               text: str = None):
+    """
+    Convert a Markdown file to HTML.
+
+    Parameters
+    ----------
+    md_path: Union[str, Path]
+        Markdown file.
+    html_path: Union[str, Path]
+        HTML file to write.
+    renderer: str
+        'markdown' to convert in-process, 'pandoc' to run pandoc. Default: 'markdown'
+    text: str
+        Content of md_path, if already in memory, to save reading it again.
+    """
+    if renderer not in HTML_RENDERERS:
+        raise ValueError(f"Unknown HTML renderer {renderer}: use one of {HTML_RENDERERS}")
+
+    with timed('html', renderer=renderer, file=os.path.basename(html_path)):
+        if renderer == 'pandoc':
+            subprocess.run(['pandoc', md_path, '-o', html_path], check=True)
+            return
+
+        if text is None:
+            with open(md_path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        with open(html_path, 'w', encoding='utf-8') as f:
+            f.write(markdown_to_html(text))
+
+
+def connect_report_catalog(db_path: Union[str, Path]):
+    """Open the report catalog, creating it if needed"""
+    os.makedirs(Path(db_path).parent, exist_ok=True)
+    con = sqlite3.connect(db_path, timeout=60)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.executescript(REPORT_CATALOG_SCHEMA)
+    return con
+
+
+def update_report_catalog(db_path: Union[str, Path],
+                          time_str: str,
+                          summary_stats: dict):
+    """
+    Record the summary statistics of a built report in the catalog,
+    replacing any earlier entry for the forecast, in a single transaction.
+
+    Parameters
+    ----------
+    db_path: Union[str, Path]
+        Path of the catalog.
+
+    time_str: str
+        Forecast time as in the forecast directory name, e.g. 20250811000000.
+
+    summary_stats: dict
+        The report's summary statistics, as written to summary_stats.json.
+    """
+    row = {
+        'time_str': time_str,
+        'year': int(time_str[:4]),
+        'month': int(time_str[4:6]),
+        'forecast_time': summary_stats['forecast_time'],
+        'number_active': summary_stats['number_active'],
+        'number_affecting_people': summary_stats['number_affecting_people'],
+        'number_displacing_people': summary_stats['number_displacing_people'],
+        'url': str(Path(time_str, 'report', 'report.html')),
+        **{col: json.dumps(list(summary_stats[col])) for col in CATALOG_LIST_COLUMNS}
+    }
+    con = connect_report_catalog(db_path)
+    try:
+        with con:
+            con.execute(
+                f"INSERT OR REPLACE INTO reports ({', '.join(row)}) VALUES ({', '.join(['?'] * len(row))})",
+                list(row.values()))
+    finally:
+        con.close()
+
+
+def read_catalog_meta(db_path: Union[str, Path], key: str):
+    """A value recorded about the catalog itself, e.g. 'backfilled', None if not set"""
+    con = connect_report_catalog(db_path)
+    try:
+        row = con.execute("SELECT value FROM catalog_meta WHERE key = ?", [key]).fetchone()
+    finally:
+        con.close()
+    return None if row is None else row[0]
+
+
+def write_catalog_meta(db_path: Union[str, Path], key: str, value: str):
+    """Record a value about the catalog itself"""
+    con = connect_report_catalog(db_path)
+    try:
+        with con:
+            con.execute("INSERT OR REPLACE INTO catalog_meta (key, value) VALUES (?, ?)", [key, value])
+    finally:
+        con.close()
+
+
+def read_report_catalog(db_path: Union[str, Path],
+                        year: int = None,
+                        month: int = None):
+    """
+    Read catalog entries, newest first, optionally of one year or month only.
+
+    Returns
+    -------
+    df: DataFrame with one row per report, list columns decoded.
+    """
+    conditions, params = [], []
+    if year is not None:
+        conditions.append("year = ?")
+        params.append(year)
+    if month is not None:
+        conditions.append("month = ?")
+        params.append(month)
+    where = f"WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ""
+
+    con = connect_report_catalog(db_path)
+    try:
+        df = pd.read_sql_query(f"SELECT * FROM reports {where} ORDER BY time_str DESC", con, params=params)
+    finally:
+        con.close()
+    for col in CATALOG_LIST_COLUMNS:
+        df[col] = df[col].apply(json.loads)
+    return df
+
+
+def list_catalog_months(db_path: Union[str, Path]):
+    """(year, month, number of reports) of every month in the catalog, newest first"""
+    con = connect_report_catalog(db_path)
+    try:
+        return con.execute(
+            "SELECT year, month, COUNT(*) FROM reports GROUP BY year, month ORDER BY year DESC, month DESC"
+        ).fetchall()
+    finally:
+        con.close()
+
+
+def _replace_file(make_func, source, dst: Path):
+    """
+    Create a link or copy at a temporary path with make_func(source, path) and
+    move it over dst. An existing dst is never written in place, since it may
+    be a hard link to the asset store shared with other reports.
+    """
+    tmp_path = Path(dst.parent, f".{dst.name}.{os.getpid()}.tmp")
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    make_func(source, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def add_report_asset(src: Union[str, Path],
+                     dst: Union[str, Path],
+                     mode: str = 'hardlink',
+                     store_dir: Union[str, Path] = None):
+    """
+    Add an image to a report directory.
+
+    Parameters
+    ----------
+    src: Union[str, Path]
+        The image, as written by an analysis stage.
+    dst: Union[str, Path]
+        Its path in the report directory.
+    mode: str
+        'hardlink': copy the image into a content-addressed store (once per
+            distinct content) and hard-link dst to the stored file. An
+            unchanged image is detected from its size and modification time
+            and not read or written again. Falls back to a copy if the store
+            is on another file system.
+        'symlink': make dst a relative symbolic link to src.
+        'copy': copy src to dst.
+        Default: 'hardlink'
+    store_dir: Union[str, Path]
+        Directory of the asset store, required for 'hardlink'. It should be
+        on the same file system as the reports.
+    """
+    src, dst = Path(src), Path(dst)
+    if mode == 'copy':
+        _replace_file(shutil.copy, src, dst)
+        return
+    if mode == 'symlink':
+        _replace_file(os.symlink, os.path.relpath(src, dst.parent), dst)
+        return
+    if mode != 'hardlink':
+        raise ValueError(f"Unknown asset mode {mode}: use one of {ASSET_MODES}")
+    if store_dir is None:
+        raise ValueError("An asset store directory is needed to hard-link report assets")
+
+    # stored files keep the modification time of the image they were copied
+    # from, so a report image linked to the store is up to date if it matches
+    src_stat = src.stat()
+    if dst.exists() and not dst.is_symlink():
+        dst_stat = dst.stat()
+        if (dst_stat.st_size, dst_stat.st_mtime_ns) == (src_stat.st_size, src_stat.st_mtime_ns):
+            return
+
+    digest = file_digest(src)
+    stored = Path(store_dir, digest[:2], f"{digest}{src.suffix}")
+    if not stored.exists():
+        os.makedirs(stored.parent, exist_ok=True)
+        tmp_path = Path(stored.parent, f".{stored.name}.{os.getpid()}.tmp")
+        shutil.copy2(src, tmp_path)
+        os.replace(tmp_path, stored)
+
+    if dst.exists() and os.path.samefile(dst, stored):
+        return
+    try:
+        _replace_file(os.link, stored, dst)
+    except OSError:
+        _replace_file(shutil.copy2, stored, dst)
@@ -7,29 +7,168 @@ Useful functions for extracting TC tracks from ECMWF.
 
 @author: Pui Man (Mannie) Kam
 """
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
 from climada_petals.hazard import TCForecast
 from climada.hazard import TCTracks
 
 WIND_CONVERSION_FACTOR = 1. / 0.88
 
-# Function to categorize wind speed
+SAFFIR_SIM_CAT = [17.49, 32.92, 42.7, 49.39, 58.13, 70.48, 1000]
+"""Upper bounds (m/s) of the Saffir-Simpson categories -1 (tropical depression) to 5."""
+
+CAT_NAMES = {
+    -1: "Tropical Depression",
+    0: "Tropical Storm",
+    1: "Hurricane Cat. 1",
+    2: "Hurricane Cat. 2",
+    3: "Hurricane Cat. 3",
+    4: "Hurricane Cat. 4",
+    5: "Hurricane Cat. 5",
+}
+"""Saffir-Simpson category names."""
+
+CAT_OUT_OF_RANGE = 999
+"""Category returned for wind speeds beyond the last Saffir-Simpson bin."""
+
+
 def categorize_wind(speed):
-    if speed < 17.49:
-        return -1  # Tropical depression
-    elif speed < 32.92:
-        return 0  # Tropical storm
-    elif speed < 42.7:
-        return 1  # Category 1
-    elif speed < 49.39:
-        return 2  # Category 2
-    elif speed < 58.13:
-        return 3  # Category 3
-    elif speed < 70.48:
-        return 4  # Category 4
-    elif speed < 1000:
-        return 5  # Category 5
-    else:
-        return 999
+    """
+    Saffir-Simpson Hurricane Scale category of one or many wind speeds.
+
+    Vectorised lookup of the SAFFIR_SIM_CAT bins: works on scalars, track
+    arrays, stacked ensembles and dense hazard intensity arrays alike.
+
+    Parameters
+    ----------
+    speed : float or array_like
+        Wind speed(s) in m/s.
+
+    Returns
+    -------
+    category : int or np.ndarray
+        -1 (tropical depression) to 5, or 999 for speeds above the last bin.
+        Has the same shape as the input; a Python int for scalar input.
+    """
+    speed = np.asarray(speed)
+    category = np.digitize(speed, SAFFIR_SIM_CAT) - 1
+    category = np.where(category == len(SAFFIR_SIM_CAT) - 1, CAT_OUT_OF_RANGE, category)
+    if category.ndim == 0:
+        return int(category)
+    return category
+
+
+def max_category(intensity, axis=0):
+    """
+    Category of the maximum wind speed along one axis of a (sparse) intensity matrix.
+
+    The maximum is reduced in sparse form before categorising, so a hazard
+    intensity matrix is never densified.
+
+    Parameters
+    ----------
+    intensity : scipy.sparse matrix or np.ndarray
+        Wind speeds in m/s, e.g. Hazard.intensity with shape (n_events, n_centroids).
+    axis : int
+        0 for the category per centroid over all events, 1 for the category
+        per event over all centroids.
+
+    Returns
+    -------
+    category : np.ndarray
+        One category per row (axis=1) or column (axis=0).
+    """
+    max_speed = intensity.max(axis=axis)
+    if sparse.issparse(max_speed):
+        max_speed = max_speed.toarray()
+    return categorize_wind(np.asarray(max_speed).ravel())
+
+
+def get_peak_category(tc_tracks: TCTracks):
+    """
+    Peak Saffir-Simpson category reached by every ensemble member of every storm.
+
+    Parameters
+    ----------
+    tc_tracks : climada.TCTracks
+        Forecast tracks, possibly containing several storms.
+
+    Returns
+    -------
+    peak_category : pd.DataFrame
+        One row per track with columns name, ensemble_number,
+        max_sustained_wind and category.
+    """
+    peak_wind = np.array([track.max_sustained_wind.values.max() for track in tc_tracks.data])
+    return pd.DataFrame({
+        'name': [track.name for track in tc_tracks.data],
+        'ensemble_number': [track.attrs.get('ensemble_number', i) for i, track in enumerate(tc_tracks.data)],
+        'max_sustained_wind': peak_wind,
+        'category': categorize_wind(peak_wind)
+    })
+
+
+def get_category_probabilities(tc_tracks: TCTracks,
+                               forecast_time: datetime,
+                               lead_time_step: int = 12,
+                               n_ensemble: int = None):
+    """
+    Probability of each Saffir-Simpson category per lead time window for one storm.
+
+    The maximum wind of each member within each lead time window is
+    categorised in one array operation over the whole ensemble.
+
+    Parameters
+    ----------
+    tc_tracks : climada.TCTracks
+        Ensemble tracks of a single storm.
+    forecast_time : datetime
+        Forecast initialisation time, the origin of the lead times.
+    lead_time_step : int
+        Width of the lead time windows in hours. Default: 12
+    n_ensemble : int
+        Number of ensemble members to normalise by. Members missing from the
+        forecast count as having no storm. Default: the number of tracks.
+
+    Returns
+    -------
+    cat_probabilities : pd.DataFrame
+        Index: start of the lead time window in hours. Columns: categories -1 to 5.
+        Values: fraction of ensemble members in that category during the window.
+    """
+    n_tracks = len(tc_tracks.data)
+    n_ensemble = n_tracks if n_ensemble is None else n_ensemble
+    if n_tracks == 0:
+        return pd.DataFrame(columns=sorted(CAT_NAMES.keys()), dtype=float)
+
+    forecast_time = np.datetime64(pd.Timestamp(forecast_time).tz_localize(None))
+    member = np.concatenate([np.full(track.time.size, i) for i, track in enumerate(tc_tracks.data)])
+    wind = np.concatenate([track.max_sustained_wind.values for track in tc_tracks.data])
+    lead_hours = np.concatenate([
+        (track.time.values - forecast_time) / np.timedelta64(1, 'h') for track in tc_tracks.data
+    ])
+    keep = lead_hours >= 0
+    member, wind = member[keep], wind[keep]
+    lead_bin = (lead_hours[keep] // lead_time_step).astype(int)
+    n_bins = lead_bin.max() + 1 if lead_bin.size > 0 else 0
+
+    # max wind per member and lead time window, -inf where the member has no data
+    window_max = np.full((n_tracks, n_bins), -np.inf)
+    np.maximum.at(window_max, (member, lead_bin), wind)
+    has_data = np.isfinite(window_max)
+    window_cat = categorize_wind(np.where(has_data, window_max, 0))
+
+    categories = sorted(CAT_NAMES.keys())
+    counts = np.stack([((window_cat == cat) & has_data).sum(axis=0) for cat in categories], axis=1)
+    return pd.DataFrame(
+        counts / n_ensemble,
+        index=pd.Index(np.arange(n_bins) * lead_time_step, name='lead_time_hours'),
+        columns=categories
+    )
+
 
 def filter_storm(fcast: TCForecast):
     """
@@ -2,13 +2,20 @@ from displacement_forecast import (
     download_tracks,
     analyse_tracks,
     calculate_windfields,
-    # analyse_windfields,
+    analyse_windfields,
     calculate_impacts,
     analyse_impacts,
     build_report,
-    build_index_page
+    build_index_page,
+    build_performance_page
 )
+from displacement_forecast.profile_func import profile_stage, PROFILE_MODES, DEFAULT_PROFILE_MODES
+from displacement_forecast.hazard_func import WIND_FIELD_FORMATS
+from displacement_forecast.impact_calc_func import POINT_FORMATS
+from displacement_forecast.archive_func import SUMMARY_FORMATS
+from seed_basemap_tiles import seed_forecast_tiles
 import os
+import argparse
 from pathlib import Path
 from climada import CONFIG
 
@@ -19,7 +26,26 @@ overwrite=False
 WORKING_DIR = CONFIG.forecast_sandbox.dir.str()
 
 
-def process_all_forecasts(overwrite=False):
+def process_all_forecasts(overwrite=False, profile=None, n_workers=1, wind_format='tiled',
+                          arrival_threshold=None, point_format='geojson', summary_format='geojson',
+                          seed_tiles=False):
+    """
+    Run the pipeline for every forecast on the ECMWF server without a report.
+
+    With profile, a list of profile_func.PROFILE_MODES, every stage of every
+    forecast is profiled into the forecast's profiles directory.
+
+    n_workers is the number of processes calculate_impacts and analyse_impacts
+    use, and wind_format the wind field format (see
+    hazard_func.WIND_FIELD_FORMATS) calculate_windfields writes.
+
+    arrival_threshold is passed to calculate_windfields, and point_format
+    and summary_format to analyse_impacts.
+
+    With seed_tiles, the base map tiles of the countries with impacts are
+    downloaded into the tile cache before the impact maps are drawn (see
+    seed_basemap_tiles.py).
+    """
 
     print("Processing all forecasts...")
 
@@ -39,32 +65,77 @@ def process_all_forecasts(overwrite=False):
         print("---------------------\n")
 
         print("--- STEP 1: Downloading ---")
-        download_tracks.download_and_process_forecast(time_str, overwrite=overwrite)
+        with profile_stage(FORECAST_DIR, 'download_tracks', profile):
+            download_tracks.download_and_process_forecast(time_str, overwrite=overwrite)
         if download_tracks.count_named_storms(time_str) == 0:
             print(f"No named storms found in forecast {time_str}. Finished.")
             continue
 
         print("--- STEP 2: Analysing forecast tracks ---")
-        analyse_tracks.analyse_tracks(time_str, overwrite=overwrite)
+        with profile_stage(FORECAST_DIR, 'analyse_tracks', profile):
+            analyse_tracks.analyse_tracks(time_str, overwrite=overwrite)
 
         print("--- STEP 3: Generating wind fields ---")
-        calculate_windfields.calculate_windfields(time_str, overwrite=overwrite)
+        with profile_stage(FORECAST_DIR, 'calculate_windfields', profile):
+            calculate_windfields.calculate_windfields(time_str, overwrite=overwrite, wind_format=wind_format,
+                                                      arrival_threshold=arrival_threshold)
 
-        # print("Analysing wind fields...")
-        # analyse_windfields.analyse_windfields(time_Str, overwrite=overwrite)
+        print("--- STEP 3b: Analysing wind fields ---")
+        with profile_stage(FORECAST_DIR, 'analyse_windfields', profile):
+            analyse_windfields.analyse_windfields(time_str, overwrite=overwrite)
 
         print("--- STEP 4: Calculating impacts ---")
-        calculate_impacts.calculate_impacts(time_str, overwrite=overwrite)
+        with profile_stage(FORECAST_DIR, 'calculate_impacts', profile):
+            calculate_impacts.calculate_impacts(time_str, overwrite=overwrite, n_workers=n_workers)
+
+        if seed_tiles:
+            print("--- STEP 4b: Seeding base map tiles ---")
+            seed_forecast_tiles(time_str)
 
         print("--- STEP 5: Analysing impacts ---")
-        analyse_impacts.analyse_impacts(time_str, overwrite=overwrite)
+        with profile_stage(FORECAST_DIR, 'analyse_impacts', profile):
+            analyse_impacts.analyse_impacts(time_str, overwrite=overwrite, n_workers=n_workers,
+                                            point_format=point_format, summary_format=summary_format)
 
         print("--- STEP 6: Building report ---")
-        build_report.build_report(time_str, overwrite=overwrite)
+        with profile_stage(FORECAST_DIR, 'build_report', profile):
+            build_report.build_report(time_str, overwrite=overwrite)
 
-    print("--- STEP 7: Rebuilding index page ---")
+    print("--- STEP 7: Rebuilding performance and index pages ---")
+    build_performance_page.build_performance_page()
     build_index_page.build_index_page()
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the pipeline for every forecast available from ECMWF.")
+    parser.add_argument('--overwrite', action='store_true', default=overwrite,
+                        help="Reprocess forecasts that already have a report")
+    parser.add_argument('--profile', nargs='*', choices=PROFILE_MODES,
+                        help=f"Profile every stage into the forecast's profiles directory. "
+                             f"Without modes: {' '.join(DEFAULT_PROFILE_MODES)}")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Processes used to calculate and analyse the impacts of each storm. Default: 1")
+    parser.add_argument('--wind-format', choices=list(WIND_FIELD_FORMATS), default='tiled',
+                        help="Format of the saved wind fields. With memmap or tiled, impact workers read the "
+                             "wind fields themselves instead of receiving a copy. Default: tiled")
+    parser.add_argument('--arrival-threshold', type=float,
+                        help="Record when each member first brings winds of this speed (m/s) to each centroid")
+    parser.add_argument('--point-format', choices=list(POINT_FORMATS), default='geojson',
+                        help="Format of the ensemble average impact points. Default: geojson")
+    parser.add_argument('--summary-format', choices=SUMMARY_FORMATS, default='geojson',
+                        help="Format of the impact summaries. Default: geojson")
+    parser.add_argument('--seed-tiles', action='store_true',
+                        help="Download the base map tiles of the countries with impacts into the tile cache, "
+                             "for drawing their maps offline later")
+    args = parser.parse_args(argv)
+    if args.profile is not None and len(args.profile) == 0:
+        args.profile = DEFAULT_PROFILE_MODES
+    return args
+
+
 if __name__ == "__main__":
-    process_all_forecasts(overwrite)
+    args = parse_args()
+    process_all_forecasts(args.overwrite, profile=args.profile, n_workers=args.workers,
+                          wind_format=args.wind_format, arrival_threshold=args.arrival_threshold,
+                          point_format=args.point_format, summary_format=args.summary_format,
+                          seed_tiles=args.seed_tiles)
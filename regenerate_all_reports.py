@@ -1,58 +1,291 @@
 import os
+import sys
+import json
+import time
+import argparse
+import traceback
 from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from climada import CONFIG
 
 from displacement_forecast import (
     download_tracks,
     analyse_tracks,
     calculate_windfields,
-    # analyse_windfields,
+    analyse_windfields,
     calculate_impacts,
     analyse_impacts,
-    build_report
+    build_report,
+    build_index_page,
+    build_performance_page
 )
+from displacement_forecast.hazard_func import WIND_FIELD_FORMATS
+from displacement_forecast.impact_calc_func import POINT_FORMATS
+from displacement_forecast.archive_func import SUMMARY_FORMATS
 
 WORKING_DIR = CONFIG.forecast_sandbox.dir.str()
+REGENERATE_DIR = Path(WORKING_DIR, "regenerate")
 
-def get_forecast_times():
+STAGES = {
+    'download_tracks': download_tracks.download_and_process_forecast,
+    'analyse_tracks': analyse_tracks.analyse_tracks,
+    'calculate_windfields': calculate_windfields.calculate_windfields,
+    'analyse_windfields': analyse_windfields.analyse_windfields,
+    'calculate_impacts': calculate_impacts.calculate_impacts,
+    'analyse_impacts': analyse_impacts.analyse_impacts,
+    'build_report': build_report.build_report,
+}
+
+STAGE_OPTIONS = {
+    'calculate_impacts': {'n_workers': 1},
+    'analyse_impacts': {'n_workers': 1},
+}
+"""Stage arguments used when regenerating: forecasts are processed in parallel, so each stage runs in one process."""
+
+
+def get_forecast_times(start=None, end=None, storms=None):
+    """
+    Forecast times available locally, oldest first.
+
+    Parameters
+    ----------
+    start, end: str
+        Only forecasts from/until these times (inclusive), as YYYYMMDD or
+        YYYYMMDDHH0000.
+    storms: list
+        Only forecasts with at least one of these named storms (case-insensitive).
+    """
     forecast_time_list = os.listdir(WORKING_DIR)
-    forecast_time_list = [p for p in forecast_time_list if p[0].isdigit() and len(p) == 14]
+    forecast_time_list = sorted([p for p in forecast_time_list if p[0].isdigit() and len(p) == 14])
     print(f"There are {len(forecast_time_list)} forecast times available locally.")
+
+    if start is not None:
+        forecast_time_list = [t for t in forecast_time_list if t >= start.ljust(14, '0')]
+    if end is not None:
+        forecast_time_list = [t for t in forecast_time_list if t <= end.ljust(14, '9')]
+    if storms is not None:
+        storms = {s.upper() for s in storms}
+        forecast_time_list = [t for t in forecast_time_list if len(storms & set(get_storm_names(t))) > 0]
+    if start is not None or end is not None or storms is not None:
+        print(f"{len(forecast_time_list)} of them match the filters.")
     return forecast_time_list
-    
 
-def regenerate(func):
-    print(f"Regenerating with {func.__name__}...")
-    forecast_time_list = get_forecast_times()
 
-    for time_str in forecast_time_list:
-        print("FORECAST TIME: " + time_str)
-        try:
-            func(time_str, overwrite=True)
-        except Exception as e:
-            print(f"Error processing {time_str}: {e}")
-            continue
+def get_storm_names(time_str):
+    """Named storms of a forecast, from its downloaded BUFR files"""
+    try:
+        return [s.upper() for s in download_tracks.list_named_storms(time_str)]
+    except (FileNotFoundError, IndexError):
+        return []
+
+
+def make_state_path(stage):
+    return Path(REGENERATE_DIR, f"{stage}_state.json")
+
+
+def make_failures_path(stage):
+    return Path(REGENERATE_DIR, f"{stage}_failures.json")
+
+
+def read_state(stage):
+    """Forecast times already regenerated for a stage in an earlier run"""
+    state_path = make_state_path(stage)
+    if not os.path.exists(state_path):
+        return set()
+    with open(state_path, 'r') as f:
+        return set(json.load(f)['completed'])
+
+
+def write_json(path, content):
+    """Write JSON to a temporary file and move it into place, so an interrupted run leaves the last complete file"""
+    os.makedirs(Path(path).parent, exist_ok=True)
+    tmp_path = Path(Path(path).parent, f".{Path(path).name}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(content, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def regenerate_forecast(stage, time_str, overwrite=True, stage_func=None, options=None):
+    """
+    Run one stage for one forecast. Errors are returned, not raised, so that
+    they reach the parent process with their traceback.
+
+    options are further arguments of the stage, on top of STAGE_OPTIONS.
+    stage_func, if given, is run instead of the stage's function in STAGES,
+    with time_str and overwrite, e.g. to redo only part of a stage.
+
+    Returns
+    -------
+    result: dict
+        time_str, seconds taken and, if the stage failed, the error and traceback.
+    """
+    start = time.perf_counter()
+    result = {'time_str': time_str, 'stage': stage}
+    try:
+        if stage_func is None:
+            STAGES[stage](time_str, overwrite=overwrite, **STAGE_OPTIONS.get(stage, {}), **(options or {}))
+        else:
+            stage_func(time_str, overwrite=overwrite)
+        result['error'] = None
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+        result['traceback'] = traceback.format_exc()
+    result['seconds'] = round(time.perf_counter() - start, 1)
+    return result
+
+
+def regenerate(stage, start=None, end=None, storms=None, n_workers=1, resume=False, overwrite=True, options=None):
+    """
+    Run a pipeline stage for all forecasts available locally.
+
+    Parameters
+    ----------
+    stage: str
+        One of STAGES, e.g. 'analyse_impacts'.
+    start, end: str
+        Only forecasts from/until these times, as YYYYMMDD or YYYYMMDDHH0000.
+    storms: list
+        Only forecasts with one of these named storms.
+    n_workers: int
+        Number of forecasts processed in parallel, each in its own process.
+    resume: bool
+        Skip forecasts completed by an earlier run of this stage, e.g. after
+        an interruption. Otherwise the earlier run's state is discarded.
+    overwrite: bool
+        Passed to the stage. Default: True
+    options: dict
+        Further arguments of the stage, e.g. {'wind_format': 'memmap'}.
+
+    Returns
+    -------
+    failures: list
+        One dict per failed forecast with the error and traceback. These are
+        also written to regenerate/<stage>_failures.json in the working directory.
+    """
+    if stage not in STAGES:
+        raise ValueError(f"Unknown stage {stage}: use one of {list(STAGES)}")
+    print(f"Regenerating with {stage}...")
+    forecast_time_list = get_forecast_times(start, end, storms)
+
+    completed = read_state(stage) if resume else set()
+    if resume:
+        print(f"Resuming: {len(completed & set(forecast_time_list))} forecasts already completed.")
+    todo = [t for t in forecast_time_list if t not in completed]
+    state = {'stage': stage, 'started': datetime.now().isoformat(timespec='seconds'), 'completed': sorted(completed)}
+    write_json(make_state_path(stage), state)
+
+    failures = []
+    run_start = time.perf_counter()
+
+    def record(i, result):
+        if result['error'] is None:
+            completed.add(result['time_str'])
+            state['completed'] = sorted(completed)
+            write_json(make_state_path(stage), state)
+            status = "done"
+        else:
+            failures.append(result)
+            status = f"FAILED: {result['error']}"
+        elapsed = time.perf_counter() - run_start
+        remaining = elapsed / i * (len(todo) - i)
+        print(f"[{i}/{len(todo)}] {result['time_str']} {status} ({result['seconds']}s, "
+              f"{len(failures)} failed, about {remaining / 60:.0f} min remaining)")
+
+    if n_workers <= 1 or len(todo) <= 1:
+        for i, time_str in enumerate(todo, start=1):
+            print("FORECAST TIME: " + time_str)
+            record(i, regenerate_forecast(stage, time_str, overwrite, options=options))
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(todo))) as pool:
+            futures = [pool.submit(regenerate_forecast, stage, time_str, overwrite, options=options) for time_str in todo]
+            for i, future in enumerate(as_completed(futures), start=1):
+                record(i, future.result())
+
+    failures = sorted(failures, key=lambda f: f['time_str'])
+    write_json(make_failures_path(stage), {
+        'stage': stage,
+        'n_forecasts': len(forecast_time_list),
+        'n_run': len(todo),
+        'n_failed': len(failures),
+        'failures': failures
+    })
+    print(f"Regenerated {len(todo) - len(failures)} of {len(todo)} forecasts with {stage} "
+          f"in {(time.perf_counter() - run_start) / 60:.1f} min.")
+    if len(failures) > 0:
+        print(f"{len(failures)} failed, see {make_failures_path(stage)}:")
+        for failure in failures:
+            print(f"  {failure['time_str']}: {failure['error']}")
+    return failures
 
 
 def regenerate_all_forecasts():
-    regenerate(download_tracks.download_and_process_forecast)
+    regenerate('download_tracks')
 
 def regenerate_all_track_analyses():
-    regenerate(analyse_tracks.analyse_tracks)
+    regenerate('analyse_tracks')
 
 def regenerate_all_windfields():
-    regenerate(calculate_windfields.calculate_windfields)
+    regenerate('calculate_windfields')
+
+def regenerate_all_windfield_analyses():
+    regenerate('analyse_windfields')
 
 def regenerate_all_impacts():
-    regenerate(calculate_impacts.calculate_impacts)
+    regenerate('calculate_impacts')
 
 def regenerate_all_impact_analyses():
-    regenerate(analyse_impacts.analyse_impacts)
+    regenerate('analyse_impacts')
 
 def regenerate_all_reports():
-    regenerate(build_report.build_report)
+    regenerate('build_report')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Rerun a pipeline stage for all forecasts available locally.")
+    parser.add_argument('stages', nargs='*', metavar='stage',
+                        help=f"Stages to rerun, in order, from {', '.join(STAGES)}. Default: build_report")
+    parser.add_argument('--start', help="First forecast time, YYYYMMDD or YYYYMMDDHH0000")
+    parser.add_argument('--end', help="Last forecast time, YYYYMMDD or YYYYMMDDHH0000")
+    parser.add_argument('--storm', action='append', dest='storms',
+                        help="Only forecasts with this named storm. Can be repeated.")
+    parser.add_argument('-j', '--workers', type=int, default=1, help="Forecasts processed in parallel")
+    parser.add_argument('--resume', action='store_true', help="Skip forecasts completed by an interrupted run")
+    parser.add_argument('--wind-format', choices=list(WIND_FIELD_FORMATS), default='tiled',
+                        help="Format of regenerated wind fields. Default: tiled")
+    parser.add_argument('--arrival-threshold', type=float,
+                        help="Record when each member first brings winds of this speed (m/s) to each centroid")
+    parser.add_argument('--point-format', choices=list(POINT_FORMATS), default='geojson',
+                        help="Format of regenerated ensemble average impact points. Default: geojson")
+    parser.add_argument('--summary-format', choices=SUMMARY_FORMATS, default='geojson',
+                        help="Format of regenerated impact summaries. Default: geojson")
+    parser.add_argument('--no-index', action='store_true', help="Don't rebuild the index and performance pages afterwards")
+    args = parser.parse_args(argv)
+    # checked here rather than with choices, which rejects an empty list of stages before Python 3.12
+    unknown = [stage for stage in args.stages if stage not in STAGES]
+    if len(unknown) > 0:
+        parser.error(f"unknown stages {', '.join(unknown)}: use any of {', '.join(STAGES)}")
+    if len(args.stages) == 0:
+        args.stages = ['build_report']
+    return args
+
 
+def stage_options(args):
+    """Arguments of each stage given on the command line"""
+    return {
+        'calculate_windfields': {'wind_format': args.wind_format, 'arrival_threshold': args.arrival_threshold},
+        'analyse_impacts': {'point_format': args.point_format, 'summary_format': args.summary_format},
+    }
 
 
 if __name__ == "__main__":
-    regenerate_all_reports()
\ No newline at end of file
+    args = parse_args()
+    n_failed = 0
+    for stage in args.stages:
+        n_failed += len(regenerate(stage, start=args.start, end=args.end, storms=args.storms,
+                                   n_workers=args.workers, resume=args.resume,
+                                   options=stage_options(args).get(stage)))
+    if 'build_report' in args.stages and not args.no_index:
+        build_performance_page.build_performance_page()
+        build_index_page.build_index_page()
+    sys.exit(1 if n_failed > 0 else 0)
@@ -0,0 +1,59 @@
+from displacement_forecast.basemap_func import seed_tile_cache, BASEMAP_TILE_DIR, MAX_ZOOM
+from displacement_forecast.impact_calc_func import list_impacts
+import os
+import sys
+import argparse
+from pathlib import Path
+from climada import CONFIG
+
+WORKING_DIR = CONFIG.forecast_sandbox.dir.str()
+
+
+def forecast_countries(time_str):
+    """ISO3 codes of the countries a forecast has impacts for"""
+    IMPACT_DIR = Path(WORKING_DIR, time_str, "impacts")
+    if not os.path.exists(IMPACT_DIR):
+        return []
+    return sorted(list_impacts(IMPACT_DIR)['country_iso3'].unique())
+
+
+def seed_forecast_tiles(time_str, zooms=None, tile_dir=None):
+    """
+    Seed the base map tile cache for the countries of a forecast's impacts, so
+    that their maps can later be drawn offline. Returns the number of tiles
+    that could not be downloaded.
+    """
+    iso3_list = forecast_countries(time_str)
+    if len(iso3_list) == 0:
+        print(f"No impacts for forecast {time_str}: no tiles to seed")
+        return 0
+    print(f"Seeding base map tiles for {', '.join(iso3_list)}")
+    return seed_tile_cache(iso3_list, zooms=zooms, tile_dir=tile_dir)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Download the base map tiles of the impact maps into the local tile cache."
+    )
+    parser.add_argument('countries', nargs='*', help="ISO3 codes of the countries to seed")
+    parser.add_argument('--forecast', action='append', default=[], metavar='TIME_STR',
+                        help="Also seed the countries a forecast has impacts for. Can be repeated")
+    parser.add_argument('--zooms', type=int, nargs='+', choices=range(MAX_ZOOM + 1), metavar='ZOOM',
+                        help="Zoom levels to seed. Default: 3 up to 7")
+    parser.add_argument('--tile-dir', help=f"Tile cache directory. Default: {BASEMAP_TILE_DIR}")
+    args = parser.parse_args(argv)
+    if len(args.countries) == 0 and len(args.forecast) == 0:
+        parser.error("give at least one country or --forecast")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    iso3_list = {iso3.upper() for iso3 in args.countries}
+    for time_str in args.forecast:
+        iso3_list.update(forecast_countries(time_str))
+    if len(iso3_list) == 0:
+        print("No countries to seed")
+        sys.exit(0)
+    n_missing = seed_tile_cache(sorted(iso3_list), zooms=args.zooms, tile_dir=args.tile_dir)
+    sys.exit(1 if n_missing > 0 else 0)
@@ -14,6 +14,10 @@ setup(
         'climada_petals',
         'beautifulsoup4',
 	    'contextily',
+	    'mercantile',
+	    'pyarrow',
+	    'jinja2',
+	    'markdown',
 	    'plotly'
     ],
     packages=find_packages(),
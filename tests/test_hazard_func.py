@@ -0,0 +1,76 @@
+import numpy as np
+from scipy import sparse
+from geopandas import GeoDataFrame, points_from_xy
+
+from climada.hazard import Hazard, Centroids
+from climada.entity import Exposures, ImpactFunc, ImpactFuncSet
+from climada.engine import ImpactCalc
+from climada.util.constants import DEF_CRS
+
+from displacement_forecast import hazard_func
+from displacement_forecast.hazard_func import read_wind_field, write_wind_field, exposure_bounds
+
+COUNTRY = 332
+N_EVENTS = 3
+
+
+def fake_country_code(lat, lon, *args, **kwargs):
+    """One country, lon -78 to -71 and lat 16 to 19, straddling the tile edge at lon -75"""
+    return np.where((lon >= -78) & (lon < -71) & (lat >= 16) & (lat < 19), COUNTRY, 0)
+
+
+def make_hazard():
+    """Wind on a 0.1 degree grid only east of the tile edge at lon -75"""
+    lon, lat = np.meshgrid(np.round(np.arange(-80., -66., 0.1), 2), np.round(np.arange(14., 21., 0.1), 2))
+    lon, lat = lon.ravel(), lat.ravel()
+    wind = np.where((lon >= -75.) & (lat >= 15.) & (lat < 20.), 40., 0.)
+    intensity = sparse.csr_matrix(np.vstack([wind * (1 + 0.1 * i) for i in range(N_EVENTS)]))
+    return Hazard(
+        haz_type='TC',
+        units='m/s',
+        centroids=Centroids(lat=lat, lon=lon, crs=DEF_CRS),
+        event_id=np.arange(1, N_EVENTS + 1),
+        event_name=[str(i) for i in range(1, N_EVENTS + 1)],
+        date=np.ones(N_EVENTS, dtype=int),
+        frequency=np.ones(N_EVENTS) / N_EVENTS,
+        orig=np.ones(N_EVENTS, dtype=bool),
+        intensity=intensity
+    )
+
+
+def make_exposures():
+    """Exposure points all over the country, between the centroids"""
+    lon, lat = np.meshgrid(np.arange(-77.95, -71., 0.1), np.arange(16.05, 19., 0.1))
+    gdf = GeoDataFrame({'value': 100., 'impf_TC': 1},
+                       geometry=points_from_xy(lon.ravel(), lat.ravel()), crs=DEF_CRS)
+    return Exposures(gdf)
+
+
+def make_impf_set():
+    impf_set = ImpactFuncSet()
+    impf_set.append(ImpactFunc(haz_type='TC', id=1, intensity=np.array([0., 30., 100.]),
+                               mdd=np.array([0., 1., 1.]), paa=np.ones(3), intensity_unit='m/s'))
+    return impf_set
+
+
+def test_tiled_partial_read_matches_full_hazard(tmp_path, monkeypatch):
+    monkeypatch.setattr(hazard_func, 'get_country_code', fake_country_code)
+    hazard = make_hazard()
+    hazard.write_hdf5(tmp_path / 'full.hdf5')
+    tiled_path = write_wind_field(tmp_path / 'tiled', hazard, 'tiled')
+
+    exp = make_exposures()
+    full_impact = ImpactCalc(exp.copy(), make_impf_set(), Hazard.from_hdf5(tmp_path / 'full.hdf5')).impact()
+    assert full_impact.aai_agg > 0
+
+    # the tiles of the country's windy centroids miss the centroids nearest to its western exposures
+    region_hazard, _ = read_wind_field(tiled_path, region_id=COUNTRY)
+    region_impact = ImpactCalc(exp.copy(), make_impf_set(), region_hazard).impact()
+    assert region_impact.aai_agg > full_impact.aai_agg
+
+    bounds = exposure_bounds(exp.gdf.geometry.y.values, exp.gdf.geometry.x.values)
+    partial_hazard, _ = read_wind_field(tiled_path, bounds=bounds)
+    assert partial_hazard.centroids.size < hazard.centroids.size
+    partial_impact = ImpactCalc(exp.copy(), make_impf_set(), partial_hazard).impact()
+    np.testing.assert_allclose(partial_impact.at_event, full_impact.at_event)
+    np.testing.assert_allclose(partial_impact.eai_exp, full_impact.eai_exp)
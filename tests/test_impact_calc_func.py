@@ -0,0 +1,55 @@
+import numpy as np
+
+from displacement_forecast.impact_calc_func import (
+    write_compact_impacts, list_impacts, iter_impacts, remove_impacts,
+    COMPACT_IMPACT_SUFFIX, IMPACT_FILE_SUFFIXES
+)
+
+IMPACT_TYPES = ['cat1', 'exposed', 'displaced']
+
+
+def make_compact(n_events=3, n_exp=4):
+    """A compact impact as returned by compact_impact, without the top-k rows"""
+    return {
+        'event_id': np.arange(1, n_events + 1),
+        'frequency': np.ones(n_events) / n_events,
+        'at_event': np.arange(n_events, dtype=float),
+        'eai_exp': np.ones(n_exp),
+        'lat': np.linspace(17., 18., n_exp),
+        'lon': np.linspace(-78., -77., n_exp),
+        'attrs': {'aai_agg': 1., 'tot_value': 10., 'unit': 'people', 'haz_type': 'TC', 'frequency_unit': '1/year',
+                  'crs': 'EPSG:4326'},
+    }
+
+
+def write_per_country_files(impact_dir, tc_name, country_iso3):
+    """Per-country files as written before compact impacts. list_impacts only reads their names"""
+    for impact_type in IMPACT_TYPES:
+        (impact_dir / f"{tc_name}_{country_iso3}_{IMPACT_FILE_SUFFIXES[impact_type]}.h5").touch()
+
+
+def test_list_impacts_ignores_per_country_files_of_compact_storms(tmp_path):
+    write_compact_impacts(tmp_path / f"MELISSA{COMPACT_IMPACT_SUFFIX}",
+                          {('JAM', impact_type): make_compact() for impact_type in IMPACT_TYPES})
+    write_per_country_files(tmp_path, 'MELISSA', 'JAM')
+    write_per_country_files(tmp_path, 'NOEL', 'HTI')
+
+    impact_list = list_impacts(tmp_path)
+    melissa = impact_list[impact_list['tc_name'] == 'MELISSA']
+    assert len(melissa) == 3
+    assert set(melissa['file']) == {f"MELISSA{COMPACT_IMPACT_SUFFIX}"}
+    assert sorted(melissa['impact_type']) == sorted(IMPACT_TYPES)
+    # storms without a compact file are still read from their per-country files
+    assert sorted(impact_list.loc[impact_list['tc_name'] == 'NOEL', 'impact_type']) == sorted(IMPACT_TYPES)
+
+    impacts = [(tc_name, country_iso3, impact_type) for tc_name, country_iso3, impact_type, _ in
+               iter_impacts(tmp_path, melissa)]
+    assert sorted(impacts) == sorted(('MELISSA', 'JAM', impact_type) for impact_type in IMPACT_TYPES)
+
+
+def test_remove_impacts_deletes_both_layouts(tmp_path):
+    write_compact_impacts(tmp_path / f"MELISSA{COMPACT_IMPACT_SUFFIX}", {('JAM', 'cat1'): make_compact()})
+    write_per_country_files(tmp_path, 'MELISSA', 'JAM')
+
+    remove_impacts(tmp_path)
+    assert len(list_impacts(tmp_path)) == 0